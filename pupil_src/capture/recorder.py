@@ -16,7 +16,7 @@ from plugin import Plugin
 from time import strftime,localtime,time,gmtime
 from shutil import copy2
 from audio import Audio_Input_Dict
-from file_methods import save_object
+from pupil_data_columns import Pupil_Data_Writer
 from av_writer import JPEG_Writer, AV_Writer, Audio_Capture
 #logging
 import logging
@@ -170,7 +170,7 @@ class Recorder(Plugin):
 
         # notification wants to be recorded
         if notification.get('record',False) and self.running:
-            self.data['notifications'].append(notification)
+            self.data_writer.append_notification(notification)
 
 
         # Remote has started recording, we should start as well.
@@ -193,11 +193,6 @@ class Recorder(Plugin):
         return strftime("%H:%M:%S", rec_time)
 
     def start(self,network_propagate=True):
-        self.timestamps = []
-        self.data = {'pupil_positions':[],'gaze_positions':[],'notifications':[]}
-        self.pupil_pos_list = []
-        self.gaze_pos_list = []
-
         self.frame_count = 0
         self.running = True
         self.menu.read_only = True
@@ -229,6 +224,10 @@ class Recorder(Plugin):
             f.write("Recording Name\t"+self.session_name+ "\n")
             f.write("Start Date\t"+ strftime("%d.%m.%Y", localtime(self.start_time))+ "\n")
             f.write("Start Time\t"+ strftime("%H:%M:%S", localtime(self.start_time))+ "\n")
+            #written now so Player can open recordings that were not stopped properly.
+            f.write("Capture Software Version\t%s\n"%self.g_pool.version)
+
+        self.data_writer = Pupil_Data_Writer(self.rec_path)
 
 
         if self.audio_src != 'No Audio':
@@ -242,7 +241,7 @@ class Recorder(Plugin):
             self.writer = JPEG_Writer(self.video_path,self.g_pool.capture.frame_rate)
         else:
             self.video_path = os.path.join(self.rec_path, "world.mp4")
-            self.writer = AV_Writer(self.video_path,fps=self.g_pool.capture.frame_rate)
+            self.writer = AV_Writer(self.video_path,fps=self.g_pool.capture.frame_rate,threaded=True)
 
         # positions path to eye process
         if self.record_eye:
@@ -281,9 +280,11 @@ class Recorder(Plugin):
 
     def update(self,frame,events):
         if self.running:
-            self.data['pupil_positions'] += events['pupil_positions']
-            self.data['gaze_positions'] += events.get('gaze_positions',[])
-            self.timestamps.append(frame.timestamp)
+            if self.data_writer.error is not None:
+                logger.error("Could not write pupil and gaze data: %s. Stopping the recording."%self.data_writer.error)
+                self.stop()
+                return
+            self.data_writer.append(events['pupil_positions'],events.get('gaze_positions',[]),frame.timestamp)
             self.writer.write_video_frame(frame)
             self.frame_count += 1
 
@@ -301,12 +302,11 @@ class Recorder(Plugin):
                 if alive.value:
                     pipe.send(('Rec_Stop',None))
 
-        save_object(self.data,os.path.join(self.rec_path, "pupil_data"))
-
-        timestamps_path = os.path.join(self.rec_path, "world_timestamps.npy")
-        # ts = sanitize_timestamps(np.array(self.timestamps))
-        ts = np.array(self.timestamps)
-        np.save(timestamps_path,ts)
+        try:
+            self.data_writer.close()
+        except Exception as e:
+            logger.error("Pupil and gaze data of this recording are incomplete: %s"%e)
+        self.data_writer = None
 
         try:
             copy2(os.path.join(self.g_pool.user_dir,"surface_definitions"),os.path.join(self.rec_path,"surface_definitions"))
@@ -326,7 +326,6 @@ class Recorder(Plugin):
                 f.write("Duration Time\t"+ self.get_rec_time_str()+ "\n")
                 f.write("World Camera Frames\t"+ str(self.frame_count)+ "\n")
                 f.write("World Camera Resolution\t"+ str(self.g_pool.capture.frame_size[0])+"x"+str(self.g_pool.capture.frame_size[1])+"\n")
-                f.write("Capture Software Version\t%s\n"%self.g_pool.version)
                 if platform.system() == "Windows":
                     username = os.environ["USERNAME"]
                     sysname, nodename, release, version, machine, _ = platform.uname()
@@ -361,12 +360,6 @@ class Recorder(Plugin):
         self.menu.read_only = False
         self.button.status_text = ''
 
-        self.timestamps = []
-        self.data = {'pupil_positions':[],'gaze_positions':[]}
-        self.pupil_pos_list = []
-        self.gaze_pos_list = []
-
-
         self.notify_all( {'subject':'rec_stopped','rec_path':self.rec_path,'network_propagate':network_propagate} )
 
 
@@ -13,6 +13,9 @@ import numpy as np
 from pyglui import ui
 import os,sys, platform
 import time
+from threading import Thread,Event,RLock
+import psutil
+from uuid import uuid4
 
 import logging
 logger = logging.getLogger(__name__)
@@ -22,8 +25,10 @@ from ctypes import c_bool, c_int
 from export_launcher import Export_Process,Value,forking_enable,cpu_count
 
 
-from exporter import export
+from exporter import export,export_parallel
+from av_writer import encoder_presets
 from player_methods import is_pupil_rec_dir
+from file_methods import save_object,load_object
 
 def get_recording_dirs(data_dir):
     '''
@@ -39,27 +44,220 @@ def get_recording_dirs(data_dir):
     logger.debug("Filtered Recording Dirs: %s" %filtered_recording_dirs)
     return filtered_recording_dirs
 
+def count_frames(rec_dir):
+    try: # 0.4
+        return len(np.load(os.path.join(rec_dir,'world_timestamps.npy')))
+    except: # <0.4
+        return len(np.load(os.path.join(rec_dir,'timestamps.npy')))
+
+
+class Export_Scheduler(object):
+    """
+    runs export jobs in a pool of processes, independent of the gui loop.
+    the job queue is saved to queue_path so unfinished jobs resume after a restart.
+    a job is a dict:
+        uid: identifies the job, also across restarts
+        rec_dir,out_file_path,user_dir,plugins,encoder_preset,parallel: export arguments
+        state: 'queued','running','done','failed' or 'canceled'
+        attempts, frames_to_export, current_frame, start_time, end_time
+    """
+    def __init__(self,queue_path,max_attempts=3,memory_per_job=600*1024**2):
+        super(Export_Scheduler, self).__init__()
+        self.queue_path = queue_path
+        self.max_attempts = max_attempts
+        self.memory_per_job = memory_per_job
+        self.lock = RLock()
+        self.running = {} # job uid:Export_Process
+        self.changed = Event()
+        self.should_stop = Event()
+        self.thread = None
+        try:
+            self.jobs = load_object(queue_path)
+        except:
+            self.jobs = []
+        for job in self.jobs:
+            if job['state'] == 'running':
+                job['state'] = 'queued'
+            #queues saved by older versions
+            job.setdefault('uid',uuid4().hex)
+            job.setdefault('encoder_preset','mpeg4')
+            job.setdefault('parallel',False)
+
+    def worker_count(self):
+        available = psutil.virtual_memory().available
+        return max(1,min(cpu_count(),int(available/self.memory_per_job)))
+
+    def add(self,rec_dir,out_file_path,user_dir,plugins,encoder_preset='mpeg4',parallel=False):
+        job = {'uid':uuid4().hex,'rec_dir':rec_dir,'out_file_path':out_file_path,'user_dir':user_dir,'plugins':plugins,
+                'encoder_preset':encoder_preset,'parallel':parallel,
+                'state':'queued','attempts':0,'frames_to_export':count_frames(rec_dir),'current_frame':0,
+                'start_time':None,'end_time':None}
+        with self.lock:
+            self.jobs.append(job)
+            self.save()
+        self.changed.set()
+        return job
+
+    def clear(self):
+        with self.lock:
+            for job in self.jobs:
+                self.cancel(job)
+            #the canceled jobs are dropped, so their processes have to be finished here.
+            for process in self.running.values():
+                process.join()
+            self.running = {}
+            self.jobs = []
+            self.save()
+        self.changed.set()
+
+    def cancel(self,job):
+        with self.lock:
+            process = self.running.get(job['uid'])
+            if process:
+                process.cancel()
+            if job['state'] in ('queued','running'):
+                job['state'] = 'canceled'
+            self.save()
+        self.changed.set()
+
+    def save(self):
+        try:
+            save_object(self.jobs,self.queue_path)
+        except IOError:
+            logger.warning("Could not save the export queue to %s"%self.queue_path)
+
+    @property
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        if not self.is_running:
+            self.should_stop.clear()
+            self.thread = Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self,requeue=True):
+        """
+        stop scheduling. running exports are aborted and requeued for the next start.
+        """
+        self.should_stop.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        with self.lock:
+            jobs = dict((j['uid'],j) for j in self.jobs)
+            for uid,process in self.running.items():
+                process.cancel()
+                process.join()
+                job = jobs.get(uid)
+                if job and job['state'] == 'running':
+                    job['state'] = 'queued' if requeue else 'canceled'
+                    job['current_frame'] = 0
+            self.running = {}
+            self.save()
+
+    def _launch(self,job):
+        forking_enable(0)
+        should_terminate = Value(c_bool,False)
+        frames_to_export = Value(c_int,job['frames_to_export'])
+        current_frame = Value(c_int,0)
+        target = export_parallel if job['parallel'] else export
+        process = Export_Process(target=target, args=(should_terminate,frames_to_export,current_frame,job['rec_dir'],job['user_dir'],None,None,job['plugins'],job['out_file_path']),
+                                 kwargs={'encoder_preset':job['encoder_preset']})
+        process.start()
+        job['state'] = 'running'
+        job['attempts'] += 1
+        job['current_frame'] = 0
+        job['start_time'] = time.time()
+        job['end_time'] = None
+        self.running[job['uid']] = process
+        logger.info("Starting export of '%s' (attempt %s)"%(job['rec_dir'],job['attempts']))
+
+    def _finish(self,job,process):
+        del self.running[job['uid']]
+        job['end_time'] = time.time()
+        if job['state'] == 'canceled':
+            return
+        if process.exitcode == 0:
+            job['state'] = 'done'
+        elif job['attempts'] < self.max_attempts:
+            logger.warning("Export of '%s' failed. Retrying."%job['rec_dir'])
+            job['state'] = 'queued'
+        else:
+            logger.error("Export of '%s' failed %s times. Giving up."%(job['rec_dir'],job['attempts']))
+            job['state'] = 'failed'
+
+    def _run(self):
+        while not self.should_stop.is_set():
+            with self.lock:
+                changed = False
+                for job in self.jobs:
+                    process = self.running.get(job['uid'])
+                    if process:
+                        job['current_frame'] = process.current_frame.value
+                        job['frames_to_export'] = process.frames_to_export.value
+                        if not process.is_alive():
+                            process.join()
+                            self._finish(job,process)
+                            changed = True
+                queued = [j for j in self.jobs if j['state'] == 'queued']
+                free_workers = self.worker_count()-len(self.running)
+                for job in queued[:max(0,free_workers)]:
+                    self._launch(job)
+                    changed = True
+                if changed:
+                    self.save()
+                    self.changed.set()
+                if not queued and not self.running:
+                    logger.info("Batch export finished.")
+                    break
+            self.should_stop.wait(.5)
+
+    def job_fps(self,job):
+        if not job['start_time']:
+            return 0.
+        duration = (job['end_time'] or time.time())-job['start_time']
+        return job['current_frame']/max(duration,1e-6)
+
+    def status(self):
+        """
+        aggregate throughput in frames/s and estimated seconds left.
+        """
+        with self.lock:
+            fps = sum(self.job_fps(j) for j in self.jobs if j['state'] == 'running')
+            frames_left = sum(j['frames_to_export']-j['current_frame'] for j in self.jobs if j['state'] in ('queued','running'))
+        eta = frames_left/fps if fps else None
+        return fps,eta
+
+
 class Batch_Exporter(Plugin):
     """docstring for Export_Launcher
     this plugin can export videos in a seperate process using exporter
     """
-    def __init__(self, g_pool):
+    reads_image = False
+    writes_image = False
+    needs_events = False
+
+    def __init__(self, g_pool,parallel=False,encoder_preset='mpeg4'):
         super(Batch_Exporter, self).__init__(g_pool)
+        self.parallel = parallel
+        self.encoder_preset = encoder_preset
 
         # initialize empty menu
         # and load menu configuration of last session
         self.menu = None
 
-        self.exports = []
         self.new_exports = []
-        self.active_exports = []
         default_path = os.path.expanduser('~/')
         self.destination_dir = default_path
         self.source_dir = default_path
 
-        self.run = False
-        self.workers = [None for x in range(cpu_count())]
-        logger.info("Using a maximum of %s CPUs to process visualizations in parallel..." %cpu_count())
+        self.scheduler = Export_Scheduler(os.path.join(g_pool.user_dir,'batch_export_queue'))
+        logger.info("Using a maximum of %s CPUs to process visualizations in parallel..." %self.scheduler.worker_count())
+        if [j for j in self.scheduler.jobs if j['state'] == 'queued']:
+            logger.info("Resuming unfinished batch export.")
+            self.scheduler.start()
 
     def unset_alive(self):
         self.alive = False
@@ -77,19 +275,35 @@ class Batch_Exporter(Plugin):
         self.menu.append(ui.Button('Close',self.unset_alive))
         self.menu.append(ui.Text_Input('source_dir',self,label='Recording Source Directory',setter=self.set_src_dir))
         self.menu.append(ui.Text_Input('destination_dir',self,label='Recording Destination Directory',setter=self.set_dest_dir))
+        self.menu.append(ui.Switch('parallel',self,label='use all CPU cores per export'))
+        self.menu.append(ui.Selector('encoder_preset',self,selection=sorted(encoder_presets),label='encoder'))
         self.menu.append(ui.Button('start export',self.start))
-
-        for idx,job  in enumerate(self.exports[::-1]):
-            submenu = ui.Growing_Menu("Export Job %s: '%s'"%(idx,job.out_file_path))
-            progress_bar = ui.Slider('progress', getter=job.status, min=0, max=job.frames_to_export.value)
+        self.menu.append(ui.Button('clear queue',self.scheduler.clear))
+        status = ui.Text_Input('status',getter=self.get_status_string,label='throughput')
+        status.read_only = True
+        self.menu.append(status)
+
+        for idx,job  in enumerate(self.scheduler.jobs[::-1]):
+            submenu = ui.Growing_Menu("Export Job %s: '%s'"%(idx,job['out_file_path']))
+            progress_bar = ui.Slider('progress', getter=lambda job=job:job['current_frame'], min=0, max=job['frames_to_export'])
             progress_bar.read_only = True
             submenu.append(progress_bar)
-            submenu.append(ui.Button('cancel',job.cancel))
+            job_status = ui.Text_Input('state',getter=lambda job=job:self.get_job_string(job),label='status')
+            job_status.read_only = True
+            submenu.append(job_status)
+            submenu.append(ui.Button('cancel',lambda job=job:self.scheduler.cancel(job)))
             self.menu.append(submenu)
-        if not self.exports:
+        if not self.scheduler.jobs:
             self.menu.append(ui.Info_Text('Please select a Recording Source directory from with to pull all recordings for export.'))
 
+    def get_status_string(self):
+        fps,eta = self.scheduler.status()
+        if eta is None:
+            return '%s workers idle'%self.scheduler.worker_count()
+        return '%.1f frames/s, %s left'%(fps,time.strftime('%H:%M:%S',time.gmtime(eta)))
 
+    def get_job_string(self,job):
+        return '%s, %.1f frames/s, attempt %s'%(job['state'],self.scheduler.job_fps(job),job['attempts'])
 
     def deinit_gui(self):
         if self.menu:
@@ -97,12 +311,11 @@ class Batch_Exporter(Plugin):
             self.menu = None
 
     def get_init_dict(self):
-        return {}
+        return {'parallel':self.parallel,'encoder_preset':self.encoder_preset}
 
     def set_src_dir(self,new_dir):
         new_dir = new_dir
         self.new_exports = []
-        self.exports = []
         new_dir = os.path.expanduser(new_dir)
         if os.path.isdir(new_dir):
             self.source_dir = new_dir
@@ -127,36 +340,20 @@ class Batch_Exporter(Plugin):
             logger.warning('"%s" is not a directory'%new_dir)
             return
 
-        self.exports = []
         self.add_exports()
         self._update_gui()
 
     def add_exports(self):
-        # on MacOS we will not use os.fork, elsewhere this does nothing.
-        forking_enable(0)
-
-        outfiles = set()
+        outfiles = set(j['out_file_path'] for j in self.scheduler.jobs if j['state'] != 'canceled')
         for d in self.new_exports:
             logger.debug("Adding new export.")
-            should_terminate = Value(c_bool,False)
-            frames_to_export  = Value(c_int,0)
-            current_frame = Value(c_int,0)
-            start_frame = None
-            end_frame = None
             export_dir = d
             user_dir = self.g_pool.user_dir
 
-            #we need to know the timestamps of our exports.
-            try: # 0.4
-                frames_to_export.value = len(np.load(os.path.join(export_dir,'world_timestamps.npy')))
-            except: # <0.4
-                frames_to_export.value = len(np.load(os.path.join(export_dir,'timestamps.npy')))
-
             # Here we make clones of every plugin that supports it.
             # So it runs in the current config when we lauch the exporter.
             plugins = self.g_pool.plugins.get_initializers()
 
-
             #make a unique name created from rec_session and dir name
             rec_session, rec_dir = export_dir.rsplit(os.path.sep,2)[1:]
             out_name = rec_session+"_"+rec_dir+".mp4"
@@ -166,26 +363,18 @@ class Batch_Exporter(Plugin):
             else:
                 outfiles.add(out_file_path)
                 logger.info("Exporting to: %s"%out_file_path)
-
-                process = Export_Process(target=export, args=(should_terminate,frames_to_export,current_frame, export_dir,user_dir,start_frame,end_frame,plugins,out_file_path))
-                self.exports.append(process)
+                self.scheduler.add(export_dir,out_file_path,user_dir,plugins,self.encoder_preset,self.parallel)
+        self.new_exports = []
 
     def start(self):
-        self.active_exports = self.exports[:]
-        self.run = True
+        self.scheduler.start()
 
     def update(self,frame,events):
-        if self.run:
-            for i in range(len(self.workers)):
-                if self.workers[i] and self.workers[i].is_alive():
-                    pass
-                else:
-                    logger.info("starting new job")
-                    if self.active_exports:
-                        self.workers[i] = self.active_exports.pop(0)
-                        self.workers[i].start()
-                    else:
-                        self.run = False
+        # the scheduler runs in its own thread, we only refresh the menu here.
+        if self.scheduler.changed.is_set():
+            self.scheduler.changed.clear()
+            if self.menu:
+                self._update_gui()
 
     def gl_display(self):
         pass
@@ -194,7 +383,9 @@ class Batch_Exporter(Plugin):
         """ called when the plugin gets terminated.
         This happends either voluntary or forced.
         if you have an atb bar or glfw window destroy it here.
+        running exports are aborted and resume when the batch exporter is opened again.
         """
+        self.scheduler.stop()
         self.deinit_gui()
 
 
@@ -0,0 +1,223 @@
+'''
+(*)~----------------------------------------------------------------------------------
+ Pupil - eye tracking platform
+ Copyright (C) 2012-2016  Pupil Labs
+
+ Distributed under the terms of the GNU Lesser General Public License (LGPL v3.0).
+ License details are in the file license.txt, distributed as part of this software.
+----------------------------------------------------------------------------------~(*)
+'''
+
+"""
+Export a recording without a window or GL context.
+
+    python export_cli.py <rec_dir> [--start N] [--end N] [--plugins JSON] [--out PATH]
+                         [--parallel] [--preset NAME] [--no-copy] [--no-video] [--fixations] [--surfaces]
+                         [--raw-data {csv,npy,npz}]
+
+--plugins takes a list of plugin initializers like the ones saved in the player
+session settings: '[["Vis_Circle",{"radius":20}],["Vis_Polyline",{}]]'
+--preset selects one of the encoder presets in av_writer. If none of the plugins draws on
+the video and the section starts on a keyframe, it is copied without re-encoding unless --no-copy is given.
+--raw-data writes pupil and gaze positions and notifications of the section to raw_data_<start>-<end>
+in the recording directory.
+Progress is printed to stdout as one json object per line, the log goes to stderr.
+The exit code is non-zero if any export failed.
+"""
+
+if __name__ == '__main__':
+    # make shared modules available across pupil_src
+    from sys import path as syspath
+    from os import path as ospath
+    loc = ospath.abspath(__file__).rsplit('pupil_src', 1)
+    syspath.append(ospath.join(loc[0], 'pupil_src', 'shared_modules'))
+    del syspath, ospath
+
+import os,sys,platform
+import json
+import argparse
+from time import time,sleep
+from glob import glob
+from ctypes import c_bool, c_int
+import numpy as np
+
+if platform.system() == 'Darwin':
+    from billiard import Process,forking_enable
+    from billiard.sharedctypes import Value
+else:
+    from multiprocessing import Process
+    forking_enable = lambda x: x #dummy fn
+    from multiprocessing.sharedctypes import Value
+
+import logging
+logger = logging.getLogger(__name__)
+
+from exporter import export,export_parallel,run_export,check_recording,plugin_by_name,Global_Container
+from av_writer import encoder_presets
+from raw_data_exporter import export_raw_data,file_formats
+from video_capture import File_Capture
+from player_methods import correlate_data
+from pupil_data_columns import load_pupil_data
+
+
+def report(**kwargs):
+    sys.stdout.write(json.dumps(kwargs)+'\n')
+    sys.stdout.flush()
+
+
+class Trim_Range(object):
+    """
+    stand-in for the seek bar trim marks. out_mark is inclusive like in Trim_Marks.
+    """
+    def __init__(self,in_mark,out_mark):
+        self.in_mark = in_mark
+        self.out_mark = out_mark
+
+
+def headless_g_pool(rec_dir,user_dir,start_frame,end_frame):
+    rec_version,timestamps_path = check_recording(rec_dir)
+    if timestamps_path is None:
+        return None
+    g = Global_Container()
+    g.app = 'exporter'
+    g.rec_dir = rec_dir
+    g.user_dir = user_dir
+    g.rec_version = rec_version
+    g.timestamps = np.load(timestamps_path)
+    g.capture = File_Capture(glob(os.path.join(rec_dir,"world.*"))[0],timestamps=list(g.timestamps))
+    g.notifications = []
+    g.delayed_notifications = {}
+    g.trim_marks = Trim_Range(start_frame,min(end_frame,len(g.timestamps))-1)
+
+    pupil_data = load_pupil_data(rec_dir)
+    g.pupil_positions_by_frame = correlate_data(pupil_data['pupil_positions'],g.timestamps)
+    g.gaze_positions_by_frame = correlate_data(pupil_data['gaze_positions'],g.timestamps)
+    g.fixations_by_frame = [[] for x in g.timestamps]
+    return g
+
+
+def export_video(args,plugins):
+    forking_enable(0)
+    should_terminate = Value(c_bool,False)
+    frames_to_export = Value(c_int,0)
+    current_frame = Value(c_int,0)
+    target = export_parallel if args.parallel else export
+    process = Process(target=run_export,args=(target,should_terminate,frames_to_export,current_frame,args.rec_dir,args.user_dir,args.start,args.end,plugins,args.out),
+                      kwargs={'encoder_preset':args.preset,'stream_copy':args.copy})
+    start_time = time()
+    process.start()
+    try:
+        while process.is_alive():
+            process.join(1.)
+            elapsed = time()-start_time
+            fps = current_frame.value/elapsed if elapsed else 0.
+            eta = (frames_to_export.value-current_frame.value)/fps if fps else None
+            report(task='video',current=current_frame.value,total=frames_to_export.value,fps=round(fps,2),eta=eta)
+    except KeyboardInterrupt:
+        should_terminate.value = True
+        process.join()
+        return False
+    return process.exitcode == 0
+
+
+def export_surfaces(g):
+    from offline_marker_detector import Offline_Marker_Detector
+    detector = Offline_Marker_Detector(g)
+    if not detector.surfaces:
+        logger.error("No surfaces defined for this recording.")
+        detector.cleanup()
+        return False
+    total = len(detector.cache)
+    while detector.cacher_running:
+        detector.update_marker_cache()
+        report(task='surfaces',current=total-detector.cache.count(False),total=total)
+        sleep(1.)
+    detector.update_marker_cache()
+    if False in detector.cache:
+        logger.warning("Marker cache is incomplete. Frames that could not be searched count as not visible.")
+    # surface caches are built in Offline_Marker_Detector.update in the player, here we build them ourselves.
+    # their cachers read the marker cache from disk.
+    detector.cache_writer.flush()
+    for s in detector.surfaces:
+        if s.defined:
+            s.init_cache(detector.cache)
+    while any(s.cache_building for s in detector.surfaces):
+        for s in detector.surfaces:
+            s.collect_cache(detector.cache)
+        sleep(.1)
+    detector.recalculate()
+    ok = detector.save_surface_statsics_to_file()
+    detector.cleanup()
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export a Pupil recording without a display.')
+    parser.add_argument('rec_dir')
+    parser.add_argument('--start',type=int,default=None,help='first frame to export')
+    parser.add_argument('--end',type=int,default=None,help='frame after the last frame to export')
+    parser.add_argument('--plugins',default='[]',help='json list of plugin initializers or path to a json file')
+    parser.add_argument('--out',default=None,help='video out file path')
+    parser.add_argument('--user-dir',dest='user_dir',default=os.path.expanduser(os.path.join('~','pupil_player_settings')))
+    parser.add_argument('--parallel',action='store_true',help='export the video in parallel chunks')
+    parser.add_argument('--preset',default='mpeg4',choices=sorted(encoder_presets),help='encoder preset')
+    parser.add_argument('--no-copy',dest='copy',action='store_false',help='always re-encode the video')
+    parser.add_argument('--no-video',dest='video',action='store_false')
+    parser.add_argument('--fixations',action='store_true',help='export fixations (settings from the Dispersion_Duration_Fixation_Detector initializer)')
+    parser.add_argument('--surfaces',action='store_true',help='export surface metrics')
+    parser.add_argument('--raw-data',dest='raw_data',default=None,choices=file_formats,help='export raw pupil, gaze and notification data')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,stream=sys.stderr,format='%(processName)s - [%(levelname)s] %(name)s: %(message)s')
+
+    args.rec_dir = os.path.abspath(os.path.expanduser(args.rec_dir))
+    if os.path.isfile(args.plugins):
+        with open(args.plugins) as f:
+            plugins = json.load(f)
+    else:
+        plugins = json.loads(args.plugins)
+    plugins = [(str(name),dict((str(k),v) for k,v in init.items())) for name,init in plugins]
+    unknown = [name for name,_ in plugins if name not in plugin_by_name]
+    if unknown:
+        logger.error("Unknown plugins: %s"%', '.join(unknown))
+        return 2
+
+    ok = True
+    if args.video:
+        ok = export_video(args,plugins) and ok
+        report(task='video',done=True,success=ok)
+
+    if args.raw_data:
+        rec_version,timestamps_path = check_recording(args.rec_dir)
+        if timestamps_path is None:
+            return 1
+        timestamps = np.load(timestamps_path)
+        start,end = args.start or 0,min(args.end or len(timestamps),len(timestamps))
+        out_dir = os.path.join(args.rec_dir,'raw_data_%s-%s'%(start,end-1))
+        raw_ok = export_raw_data(args.rec_dir,timestamps,out_dir,start,end,args.raw_data)
+        report(task='raw_data',done=True,success=raw_ok)
+        ok = raw_ok and ok
+
+    if args.fixations or args.surfaces:
+        g = headless_g_pool(args.rec_dir,args.user_dir,args.start or 0,args.end or sys.maxint)
+        if g is None:
+            return 1
+        # the fixation detector fills g.fixations_by_frame, surface exports use them as well.
+        from fixation_detector import Dispersion_Duration_Fixation_Detector
+        fixation_detector = Dispersion_Duration_Fixation_Detector(g,**dict(plugins).get('Dispersion_Duration_Fixation_Detector',{}))
+        if args.fixations:
+            fixations_ok = fixation_detector.export_fixations()
+            report(task='fixations',done=True,success=fixations_ok)
+            ok = fixations_ok and ok
+        if args.surfaces:
+            surfaces_ok = export_surfaces(g)
+            report(task='surfaces',done=True,success=surfaces_ok)
+            ok = surfaces_ok and ok
+        g.capture.close()
+
+    report(done=True,success=ok)
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
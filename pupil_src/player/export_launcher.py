@@ -26,12 +26,15 @@ else:
     forking_enable = lambda x: x #dummy fn
     from multiprocessing.sharedctypes import Value
 
-from exporter import export
+from exporter import export,export_parallel,run_export
+from av_writer import encoder_presets
 
 class Export_Process(Process):
-    """small aditions to the process class"""
-    def __init__(self, target,args):
-        super(Export_Process, self).__init__(target=target,args=args)
+    """small aditions to the process class
+    the exit code is 0 if the export succeeded.
+    """
+    def __init__(self, target,args,kwargs={}):
+        super(Export_Process, self).__init__(target=run_export,args=(target,)+tuple(args),kwargs=kwargs)
         self.should_terminate,self.frames_to_export,self.current_frame,_,_,_,_,_,self.out_file_path = args
 
     def status(self):
@@ -73,8 +76,14 @@ class Export_Launcher(Plugin):
     """docstring for Export_Launcher
     this plugin can export the video in a seperate process using exporter
     """
-    def __init__(self, g_pool):
+    reads_image = False
+    writes_image = False
+    needs_events = False
+
+    def __init__(self, g_pool,parallel=False,encoder_preset='mpeg4'):
         super(Export_Launcher, self).__init__(g_pool)
+        self.parallel = parallel
+        self.encoder_preset = encoder_preset
         # initialize empty menu
         self.menu = None
         self.new_export = None
@@ -100,6 +109,9 @@ class Export_Launcher(Plugin):
         self.menu.append(ui.Text_Input('rec_name',self,label='export name'))
         self.menu.append(ui.Info_Text('Select your export frame range using the trim marks in the seek bar.'))
         self.menu.append(ui.Text_Input('in_mark',getter=self.g_pool.trim_marks.get_string,setter=self.g_pool.trim_marks.set_string,label='frame range to export'))
+        self.menu.append(ui.Switch('parallel',self,label='use all CPU cores'))
+        self.menu.append(ui.Selector('encoder_preset',self,selection=sorted(encoder_presets),label='encoder'))
+        self.menu.append(ui.Info_Text('Without plugins that draw on the video, a section that starts on a keyframe is copied without re-encoding.'))
         self.menu.append(ui.Button('new export',self.add_export))
 
         for job in self.exports[::-1]:
@@ -118,7 +130,7 @@ class Export_Launcher(Plugin):
 
 
     def get_init_dict(self):
-        return {}
+        return {'parallel':self.parallel,'encoder_preset':self.encoder_preset}
 
     def add_export(self):
         # on MacOS we will not use os.fork, elsewhere this does nothing.
@@ -140,7 +152,8 @@ class Export_Launcher(Plugin):
         plugins = self.g_pool.plugins.get_initializers()
 
         out_file_path=verify_out_file_path(self.rec_name,self.g_pool.rec_dir)
-        process = Export_Process(target=export, args=(should_terminate,frames_to_export,current_frame, rec_dir,user_dir,start_frame,end_frame,plugins,out_file_path))
+        target = export_parallel if self.parallel else export
+        process = Export_Process(target=target, args=(should_terminate,frames_to_export,current_frame, rec_dir,user_dir,start_frame,end_frame,plugins,out_file_path),kwargs={'encoder_preset':self.encoder_preset})
         self.new_export = process
 
     def launch_export(self, new_export):
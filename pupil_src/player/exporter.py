@@ -16,9 +16,18 @@ if __name__ == '__main__':
     syspath.append(ospath.join(loc[0], 'pupil_src', 'shared_modules'))
     del syspath, ospath
 
-import os
-from time import time
+import os,sys,platform
+from time import time,sleep
 from glob import glob
+from ctypes import c_int
+if platform.system() == 'Darwin':
+    from billiard import Process,forking_enable,cpu_count
+    from billiard.sharedctypes import Value
+else:
+    from multiprocessing import Process,cpu_count
+    forking_enable = lambda x: x #dummy fn
+    from multiprocessing.sharedctypes import Value
+import av
 import cv2
 import numpy as np
 from video_capture import File_Capture,EndofVideoFileError
@@ -26,7 +35,7 @@ from player_methods import correlate_data,update_recording_0v4_to_current,update
 from methods import denormalize
 from version_utils import VersionFormat, read_rec_version, get_version
 from av_writer import AV_Writer
-from file_methods import load_object
+from pupil_data_columns import load_pupil_data
 
 #logging
 import logging
@@ -57,8 +66,11 @@ plugin_by_name = dict(zip(name_by_index,available_plugins))
 class Global_Container(object):
         pass
 
-def export(should_terminate,frames_to_export,current_frame, rec_dir,user_dir,start_frame=None,end_frame=None,plugin_initializers=[],out_file_path=None):
-
+def check_recording(rec_dir,update_recording=True):
+    '''
+    returns the recording version and the path of the world timestamps, the path is None if the recording is too old.
+    recordings in older formats are updated unless update_recording is False.
+    '''
     logger = logging.getLogger(__name__+' with pid: '+str(os.getpid()) )
 
    #parse info.csv file
@@ -66,21 +78,30 @@ def export(should_terminate,frames_to_export,current_frame, rec_dir,user_dir,sta
     with open(meta_info_path) as info:
         meta_info = dict( ((line.strip().split('\t')) for line in info.readlines() ) )
 
-    video_path = glob(os.path.join(rec_dir,"world.*"))[0]
     timestamps_path = os.path.join(rec_dir, "world_timestamps.npy")
-    pupil_data_path = os.path.join(rec_dir, "pupil_data")
-
-
     rec_version = read_rec_version(meta_info)
     if rec_version >= VersionFormat('0.5'):
         pass
     elif rec_version >= VersionFormat('0.4'):
-        update_recording_0v4_to_current(rec_dir)
+        if update_recording:
+            update_recording_0v4_to_current(rec_dir)
     elif rec_version >= VersionFormat('0.3'):
-        update_recording_0v3_to_current(rec_dir)
+        if update_recording:
+            update_recording_0v3_to_current(rec_dir)
         timestamps_path = os.path.join(rec_dir, "timestamps.npy")
     else:
-        logger.Error("This recording is to old. Sorry.")
+        logger.error("This recording is to old. Sorry.")
+        timestamps_path = None
+    return rec_version,timestamps_path
+
+
+def export(should_terminate,frames_to_export,current_frame, rec_dir,user_dir,start_frame=None,end_frame=None,plugin_initializers=[],out_file_path=None,update_recording=True,encoder_preset='mpeg4',stream_copy=True):
+
+    logger = logging.getLogger(__name__+' with pid: '+str(os.getpid()) )
+
+    video_path = glob(os.path.join(rec_dir,"world.*"))[0]
+    rec_version,timestamps_path = check_recording(rec_dir,update_recording)
+    if timestamps_path is None:
         return
 
 
@@ -122,13 +143,6 @@ def export(should_terminate,frames_to_export,current_frame, rec_dir,user_dir,sta
     current_frame.value = 0
     logger.debug("Will export from frame %s to frame %s. This means I will export %s frames."%(start_frame,start_frame+frames_to_export.value,frames_to_export.value))
 
-    #setup of writer
-    writer = AV_Writer(out_file_path,fps=cap.frame_rate,use_timestamps=True)
-
-    cap.seek_to_frame(start_frame)
-
-    start_time = time()
-
     g = Global_Container()
     g.app = 'exporter'
     g.capture = cap
@@ -136,20 +150,48 @@ def export(should_terminate,frames_to_export,current_frame, rec_dir,user_dir,sta
     g.user_dir = user_dir
     g.rec_version = rec_version
     g.timestamps = timestamps
+    g.notifications = []
+    g.delayed_notifications = {}
 
 
     # load pupil_positions, gaze_positions
-    pupil_data = load_object(pupil_data_path)
-    pupil_list = pupil_data['pupil_positions']
-    gaze_list = pupil_data['gaze_positions']
+    pupil_data = load_pupil_data(rec_dir)
 
-    g.pupil_positions_by_frame = correlate_data(pupil_list,g.timestamps)
-    g.gaze_positions_by_frame = correlate_data(gaze_list,g.timestamps)
+    g.pupil_positions_by_frame = correlate_data(pupil_data['pupil_positions'],g.timestamps)
+    g.gaze_positions_by_frame = correlate_data(pupil_data['gaze_positions'],g.timestamps)
     g.fixations_by_frame = [[] for x in g.timestamps] #populated by the fixation detector plugin
 
     #add plugins
     g.plugins = Plugin_List(g,plugin_by_name,plugin_initializers)
 
+    if stream_copy and not plugins_write_image(plugin_initializers):
+        if cap.keyframe_indices is None:
+            logger.debug("No packet index for this video. Can not copy the video, will re-encode.")
+        elif cap.keyframe_for(start_frame) != start_frame:
+            #a copy has to start on a keyframe and would include frames before the trim mark.
+            logger.info("Frame %s is not a keyframe. Can not copy the video, will re-encode."%start_frame)
+        else:
+            end_frame = start_frame+frames_to_export.value
+            frame_pts = cap.frame_pts
+            cap.close()
+            return copy_section(should_terminate,current_frame,video_path,frame_pts,start_frame,end_frame,out_file_path)
+
+    #without plugins that touch pixels we can encode the decoded planes and skip the BGR conversion.
+    touches_image = g.plugins.uses('reads_image') or g.plugins.uses('writes_image')
+    if cap.pixel_format == 'yuv420p' and not touches_image and not (cap.frame_size[0]%2 or cap.frame_size[1]%2):
+        frame_format = 'yuv420p'
+    else:
+        frame_format = 'bgr24'
+    needs_events = g.plugins.uses('needs_events')
+    update_plugins = [p for p in g.plugins if not p.gl_only]
+
+    #setup of writer
+    writer = AV_Writer(out_file_path,fps=cap.frame_rate,video_stream=encoder_preset,use_timestamps=True,threaded=True,frame_format=frame_format)
+
+    cap.seek_to_frame(start_frame)
+
+    start_time = time()
+
     while frames_to_export.value - current_frame.value > 0:
 
         if should_terminate.value:
@@ -167,11 +209,12 @@ def export(should_terminate,frames_to_export,current_frame, rec_dir,user_dir,sta
 
         events = {}
         #new positons and events
-        events['gaze_positions'] = g.gaze_positions_by_frame[frame.index]
-        events['pupil_positions'] = g.pupil_positions_by_frame[frame.index]
+        if needs_events:
+            events['gaze_positions'] = g.gaze_positions_by_frame[frame.index]
+            events['pupil_positions'] = g.pupil_positions_by_frame[frame.index]
 
         # allow each Plugin to do its work.
-        for p in g.plugins:
+        for p in update_plugins:
             p.update(frame,events)
 
         writer.write_video_frame(frame)
@@ -185,3 +228,203 @@ def export(should_terminate,frames_to_export,current_frame, rec_dir,user_dir,sta
 
     logger.info("Export done: Exported %s frames to %s. This took %s seconds. Exporter ran at %s frames per second"%(current_frame.value,out_file_path,duration,effective_fps))
     return True
+
+
+def run_export(target,*args,**kwargs):
+    """
+    process target that runs an export function and reports its result as exit code.
+    The frame count is no proof of success: the video may be shorter than its timestamps.
+    """
+    sys.exit(0 if target(*args,**kwargs) else 1)
+
+
+def plugins_write_image(plugin_initializers):
+    """
+    True if any of the plugins given as (name,args) initializers may draw on the frame.
+    Plugins that decide this per instance (writes_image is a property) count as drawing.
+    This decides about stream copies in export and export_parallel alike.
+    """
+    for name,args in plugin_initializers:
+        plugin = plugin_by_name.get(name)
+        if plugin is None or (plugin.writes_image and not plugin.gl_only):
+            #we do not know what an unknown plugin does, assume the worst.
+            return True
+    return False
+
+
+def copy_section(should_terminate,current_frame,video_path,frame_pts,start_frame,end_frame,out_file_path):
+    """
+    export frames [start_frame,end_frame) without decoding by copying their packets.
+    start_frame has to be a keyframe.
+    frame_pts: packet pts of every frame from the packet index. pts/dts are shifted so the first dts is 0.
+    """
+    logger = logging.getLogger(__name__+' with pid: '+str(os.getpid()) )
+
+    end_frame = min(end_frame,len(frame_pts))
+    first_pts,last_pts = int(frame_pts[start_frame]),int(frame_pts[end_frame-1])
+
+    start_time = time()
+    in_container = av.open(video_path)
+    in_stream = next(s for s in in_container.streams if s.type=="video")
+    out_container = av.open(out_file_path,'w')
+    out_container.add_stream(template=in_stream)
+    in_stream.seek(first_pts,mode='time')
+    first_dts = None
+    for packet in in_container.demux(in_stream):
+        if packet.pts is None: #flush packet
+            continue
+        dts = packet.pts if packet.dts is None else packet.dts
+        if dts > last_pts:
+            break
+        if not first_pts <= packet.pts <= last_pts:
+            continue
+        if should_terminate.value:
+            logger.warning("User aborted export. Exported %s frames to %s."%(current_frame.value,out_file_path))
+            in_container.close()
+            out_container.close()
+            return False
+        if first_dts is None:
+            #with b-frames the dts of the keyframe is below its pts, shift both so neither gets negative.
+            first_dts = dts
+        packet.pts -= first_dts
+        packet.dts = dts-first_dts
+        out_container.mux(packet)
+        current_frame.value +=1
+    in_container.close()
+    out_container.close()
+
+    duration = time()-start_time
+    logger.info("Export done: Copied %s frames to %s without re-encoding. This took %s seconds."%(current_frame.value,out_file_path,duration))
+    return True
+
+
+def split_at_keyframes(keyframe_indices,start_frame,end_frame,chunk_count):
+    """
+    split [start_frame,end_frame) into up to chunk_count ranges that start on keyframes.
+    """
+    keyframes = np.asarray(keyframe_indices)
+    keyframes = keyframes[(keyframes > start_frame) & (keyframes < end_frame)]
+    bounds = [start_frame]
+    if len(keyframes):
+        targets = start_frame + (end_frame-start_frame)*np.arange(1,chunk_count)/float(chunk_count)
+        nearest = np.clip(np.searchsorted(keyframes,targets),0,len(keyframes)-1)
+        bounds += sorted(set(keyframes[nearest].tolist()))
+    bounds.append(end_frame)
+    return zip(bounds[:-1],bounds[1:])
+
+
+def concat_videos(chunk_paths,time_offsets,out_file_path):
+    """
+    losslessly join video files by remuxing their packets.
+    time_offsets: start of each chunk in seconds relative to the first one.
+    The output uses the time base of the first chunk, its first dts becomes 0.
+    """
+    out_container = None
+    first_dts = None
+    for chunk_path,offset in zip(chunk_paths,time_offsets):
+        in_container = av.open(chunk_path)
+        in_stream = next(s for s in in_container.streams if s.type=="video")
+        if out_container is None:
+            out_container = av.open(out_file_path,'w')
+            out_container.add_stream(template=in_stream)
+            time_base = in_stream.time_base
+        scale = in_stream.time_base/time_base
+        offset = int(round(offset/time_base))
+        for packet in in_container.demux(in_stream):
+            if packet.pts is None: #flush packet
+                continue
+            dts = packet.pts if packet.dts is None else packet.dts
+            if first_dts is None:
+                first_dts = int(dts*scale)
+            packet.pts = int(packet.pts*scale)+offset-first_dts
+            packet.dts = int(dts*scale)+offset-first_dts
+            out_container.mux(packet)
+        in_container.close()
+    out_container.close()
+
+
+def export_parallel(should_terminate,frames_to_export,current_frame, rec_dir,user_dir,start_frame=None,end_frame=None,plugin_initializers=[],out_file_path=None,chunk_count=None,encoder_preset='mpeg4',stream_copy=True):
+    """
+    same as export but splits the frame range at keyframes and exports the chunks in parallel.
+    every chunk runs in its own process with its own plugin instances, so plugins that
+    accumulate state across frames (e.g. Scan_Path) start fresh at every chunk.
+    """
+    logger = logging.getLogger(__name__+' with pid: '+str(os.getpid()) )
+
+    video_path = glob(os.path.join(rec_dir,"world.*"))[0]
+    #update the recording once here, not in every chunk process
+    rec_version,timestamps_path = check_recording(rec_dir)
+    if timestamps_path is None:
+        return
+
+    timestamps = np.load(timestamps_path)
+    if start_frame == None:
+        start_frame = 0
+    if end_frame == None:
+        end_frame = len(timestamps)
+    end_frame = min(end_frame,len(timestamps))
+    if end_frame <= start_frame:
+        logger.warn("Start and end frames are set such that no video will be exported.")
+        return False
+
+    if out_file_path is None:
+        out_file_path = os.path.join(rec_dir, "world_viz.mp4")
+    if os.path.isfile(out_file_path):
+        logger.warning("Video out file already exsists. I will overwrite!")
+        os.remove(out_file_path)
+
+    cap = File_Capture(video_path,timestamps=timestamps)
+    keyframe_indices = cap.keyframe_indices
+    cap.close()
+    if keyframe_indices is None:
+        logger.warning("No packet index for this video. Falling back to single process export.")
+        return export(should_terminate,frames_to_export,current_frame,rec_dir,user_dir,start_frame,end_frame,plugin_initializers,out_file_path,False,encoder_preset,stream_copy)
+    if stream_copy and not plugins_write_image(plugin_initializers) and start_frame in keyframe_indices:
+        #copying packets is faster than any parallel re-encode
+        return export(should_terminate,frames_to_export,current_frame,rec_dir,user_dir,start_frame,end_frame,plugin_initializers,out_file_path,False,encoder_preset,stream_copy)
+
+    chunks = split_at_keyframes(keyframe_indices,start_frame,end_frame,chunk_count or cpu_count())
+    logger.debug("Exporting frames %s to %s in %s chunks."%(start_frame,end_frame,len(chunks)))
+
+    frames_to_export.value = end_frame-start_frame
+    current_frame.value = 0
+    start_time = time()
+
+    forking_enable(0)
+    out_base = os.path.splitext(out_file_path)[0]
+    chunk_paths,chunk_progress,chunk_processes = [],[],[]
+    for i,(s,e) in enumerate(chunks):
+        chunk_path = '%s_chunk%03d.mp4'%(out_base,i)
+        progress = Value(c_int,0)
+        args = (should_terminate,Value(c_int,0),progress,rec_dir,user_dir,s,e,plugin_initializers,chunk_path,False,encoder_preset,False)
+        process = Process(target=run_export,args=(export,)+args)
+        process.start()
+        chunk_paths.append(chunk_path)
+        chunk_progress.append(progress)
+        chunk_processes.append(process)
+
+    while any(p.is_alive() for p in chunk_processes):
+        current_frame.value = sum(c.value for c in chunk_progress)
+        sleep(.1)
+    current_frame.value = sum(c.value for c in chunk_progress)
+
+    failed = [p for p in chunk_processes if p.exitcode != 0]
+    if should_terminate.value or failed:
+        if failed:
+            logger.error("%s export chunk(s) failed. No video was written."%len(failed))
+        else:
+            logger.warning("User aborted export. No video was written.")
+        for chunk_path in chunk_paths:
+            if os.path.isfile(chunk_path):
+                os.remove(chunk_path)
+        return False
+
+    time_offsets = [timestamps[s]-timestamps[start_frame] for s,e in chunks]
+    concat_videos(chunk_paths,time_offsets,out_file_path)
+    for chunk_path in chunk_paths:
+        os.remove(chunk_path)
+
+    duration = time()-start_time
+    effective_fps = float(current_frame.value)/duration
+    logger.info("Export done: Exported %s frames to %s using %s processes. This took %s seconds. Exporter ran at %s frames per second"%(current_frame.value,out_file_path,len(chunks),duration,effective_fps))
+    return True
@@ -122,6 +122,9 @@ class Eye_Video_Overlay(Plugin):
         show only 1 or 2 or both eyes
         features updated by Andrew June 2015
     """
+    writes_image = True
+    needs_events = False
+
     def __init__(self,g_pool,alpha=0.6,eye_scale_factor=.5,move_around=0,mirror={'0':False,'1':False}, flip={'0':False,'1':False},pos=[(640,10),(10,10)]):
         super(Eye_Video_Overlay, self).__init__(g_pool)
         self.order = .6
@@ -238,18 +241,18 @@ class Eye_Video_Overlay(Plugin):
             if self.drag_offset[eye_index] is not None:
                 pos = glfwGetCursorPos(glfwGetCurrentContext())
                 pos = normalize(pos,glfwGetWindowSize(glfwGetCurrentContext()))
-                pos = denormalize(pos,(frame.img.shape[1],frame.img.shape[0]) ) # Position in img pixels
+                pos = denormalize(pos,(frame.width,frame.height) ) # Position in img pixels
                 self.pos[eye_index][0] = pos[0]+self.drag_offset[eye_index][0]
                 self.pos[eye_index][1] = pos[1]+self.drag_offset[eye_index][1]
             else:
                 self.video_size = [round(self.eye_frames[eye_index].width*self.eye_scale_factor), round(self.eye_frames[eye_index].height*self.eye_scale_factor)]
 
             #3. keep in image bounds, do this even when not dragging because the image video_sizes could change.
-            self.pos[eye_index][1] = min(frame.img.shape[0]-self.video_size[1],max(self.pos[eye_index][1],0)) #frame.img.shape[0] is height, frame.img.shape[1] is width of screen
-            self.pos[eye_index][0] = min(frame.img.shape[1]-self.video_size[0],max(self.pos[eye_index][0],0))
+            self.pos[eye_index][1] = min(frame.height-self.video_size[1],max(self.pos[eye_index][1],0))
+            self.pos[eye_index][0] = min(frame.width-self.video_size[0],max(self.pos[eye_index][0],0))
 
             #4. flipping images, converting to greyscale
-            eye_gray = cv2.cvtColor(self.eye_frames[eye_index].img,cv2.COLOR_BGR2GRAY) #auto gray scaling
+            eye_gray = self.eye_frames[eye_index].gray
             eyeimage = cv2.resize(eye_gray,(0,0),fx=self.eye_scale_factor, fy=self.eye_scale_factor)
             if self.mirror[str(eye_index)]:
                 eyeimage = np.fliplr(eyeimage)
@@ -10,7 +10,6 @@
 
 import sys, os,platform
 from glob import glob
-from copy import deepcopy
 from time import time
 try:
     from billiard import freeze_support
@@ -73,7 +72,8 @@ else:
     y_scroll_factor = 1.0
 
 #imports
-from file_methods import Persistent_Dict,load_object
+from file_methods import Persistent_Dict
+from pupil_data_columns import load_pupil_data
 import numpy as np
 
 #display
@@ -114,12 +114,13 @@ from fixation_detector import Dispersion_Duration_Fixation_Detector
 from manual_gaze_correction import Manual_Gaze_Correction
 from show_calibration import Show_Calibration
 from batch_exporter import Batch_Exporter
+from raw_data_exporter import Raw_Data_Exporter
 from eye_video_overlay import Eye_Video_Overlay
 from log_display import Log_Display
 from annotations import Annotation_Player
 
 system_plugins = [Log_Display,Seek_Bar,Trim_Marks]
-user_launchable_plugins = [Export_Launcher, Vis_Circle,Vis_Cross, Vis_Polyline, Vis_Light_Points,Scan_Path,Dispersion_Duration_Fixation_Detector,Vis_Watermark, Manual_Gaze_Correction, Show_Calibration, Offline_Marker_Detector,Pupil_Server,Batch_Exporter,Eye_Video_Overlay,Annotation_Player] #,Marker_Auto_Trim_Marks
+user_launchable_plugins = [Export_Launcher, Vis_Circle,Vis_Cross, Vis_Polyline, Vis_Light_Points,Scan_Path,Dispersion_Duration_Fixation_Detector,Vis_Watermark, Manual_Gaze_Correction, Show_Calibration, Offline_Marker_Detector,Pupil_Server,Batch_Exporter,Raw_Data_Exporter,Eye_Video_Overlay,Annotation_Player] #,Marker_Auto_Trim_Marks
 user_launchable_plugins += import_runtime_plugins(os.path.join(user_dir,'plugins'))
 available_plugins = system_plugins + user_launchable_plugins
 name_by_index = [p.__name__ for p in available_plugins]
@@ -150,7 +151,7 @@ def session(rec_dir):
         g_pool.gui.update_button(button,action,mods)
         pos = glfwGetCursorPos(window)
         pos = normalize(pos,glfwGetWindowSize(window))
-        pos = denormalize(pos,(frame.img.shape[1],frame.img.shape[0]) ) # Position in img pixels
+        pos = denormalize(pos,(frame.width,frame.height) ) # Position in img pixels
         for p in g_pool.plugins:
             p.on_click(pos,button,action)
 
@@ -183,7 +184,6 @@ def session(rec_dir):
 
     video_path = [f for f in glob(os.path.join(rec_dir,"world.*")) if f[-3:] in ('mp4','mkv','avi')][0]
     timestamps_path = os.path.join(rec_dir, "world_timestamps.npy")
-    pupil_data_path = os.path.join(rec_dir, "pupil_data")
 
     #parse info.csv file
     meta_info_path = os.path.join(rec_dir,"info.csv")
@@ -205,7 +205,7 @@ def session(rec_dir):
 
     timestamps = np.load(timestamps_path)
     # Initialize capture
-    cap = File_Capture(video_path,timestamps=list(timestamps))
+    cap = File_Capture(video_path,timestamps=list(timestamps),prefetch_size=8)
 
     # load session persistent settings
     session_settings = Persistent_Dict(os.path.join(user_dir,"user_settings"))
@@ -213,6 +213,8 @@ def session(rec_dir):
         logger.info("Session setting are from older version of this app. I will not use those.")
         session_settings.clear()
 
+    cap.frame_cache_mb = session_settings.get('frame_cache_mb',256)
+
     width,height = session_settings.get('window_size',cap.frame_size)
     window_pos = session_settings.get('window_position',(0,0))
     main_window = glfwCreateWindow(width, height, "Pupil Player: "+meta_info["Recording Name"]+" - "+ rec_dir.split(os.path.sep)[-1], None, None)
@@ -221,9 +223,7 @@ def session(rec_dir):
     cygl.utils.init()
 
     # load pupil_positions, gaze_positions
-    pupil_data = load_object(pupil_data_path)
-    pupil_list = pupil_data['pupil_positions']
-    gaze_list = pupil_data['gaze_positions']
+    pupil_data = load_pupil_data(rec_dir)
 
     # create container for globally scoped vars
     g_pool = Global_Container()
@@ -238,8 +238,8 @@ def session(rec_dir):
     g_pool.rec_dir = rec_dir
     g_pool.rec_version = rec_version
     g_pool.meta_info = meta_info
-    g_pool.pupil_positions_by_frame = correlate_data(pupil_list,g_pool.timestamps)
-    g_pool.gaze_positions_by_frame = correlate_data(gaze_list,g_pool.timestamps)
+    g_pool.pupil_positions_by_frame = correlate_data(pupil_data['pupil_positions'],g_pool.timestamps)
+    g_pool.gaze_positions_by_frame = correlate_data(pupil_data['gaze_positions'],g_pool.timestamps)
     g_pool.fixations_by_frame = [[] for x in g_pool.timestamps] #populated by the fixation detector plugin
 
     def next_frame(_):
@@ -283,6 +283,8 @@ def session(rec_dir):
                                         setter= open_plugin, getter = lambda: "Select to load"))
     g_pool.main_menu.append(ui.Button('Close all plugins',purge_plugins))
     g_pool.main_menu.append(ui.Button('Reset window size',lambda: glfwSetWindowSize(main_window,cap.frame_size[0],cap.frame_size[1])) )
+    #the capture owns its settings menu, e.g. the frame cache size.
+    cap.init_gui(g_pool.main_menu)
     g_pool.quickbar = ui.Stretching_Menu('Quick Bar',(0,100),(120,-100))
     g_pool.play_button = ui.Thumb('play',g_pool,label='Play',hotkey=GLFW_KEY_SPACE)
     g_pool.play_button.on_color[:] = (0,1.,.0,.8)
@@ -347,6 +349,9 @@ def session(rec_dir):
 
     while not glfwWindowShouldClose(main_window):
 
+        #decode ahead while playing
+        cap.set_prefetch(g_pool.play)
+
         #grab new frame
         if g_pool.play or g_pool.new_seek:
             g_pool.new_seek = False
@@ -360,17 +365,22 @@ def session(rec_dir):
             update_graph = False
 
 
-        frame = new_frame.copy()
+        #plugins that draw need a fresh copy, otherwise the decoded frame and its BGR image are reused.
+        if g_pool.plugins.uses('writes_image'):
+            frame = new_frame.copy()
+        else:
+            frame = new_frame
         events = {}
         #report time between now and the last loop interation
         events['dt'] = get_dt()
-        #new positons we make a deepcopy just like the image is a copy.
-        events['gaze_positions'] = deepcopy(g_pool.gaze_positions_by_frame[frame.index])
-        events['pupil_positions'] = deepcopy(g_pool.pupil_positions_by_frame[frame.index])
+        if g_pool.plugins.uses('needs_events'):
+            #new positons: read-only data in a new list, plugins copy a datum before changing it.
+            events['gaze_positions'] = g_pool.gaze_positions_by_frame[frame.index]
+            events['pupil_positions'] = g_pool.pupil_positions_by_frame[frame.index]
 
         if update_graph:
             #update performace graphs
-            for p in  events['pupil_positions']:
+            for p in g_pool.pupil_positions_by_frame[frame.index]:
                 pupil_graph.add(p['confidence'])
 
             t = new_frame.timestamp
@@ -398,7 +408,8 @@ def session(rec_dir):
 
         # allow each Plugin to do its work.
         for p in g_pool.plugins:
-            p.update(frame,events)
+            if not p.gl_only:
+                p.update(frame,events)
 
         #check if a plugin need to be destroyed
         g_pool.plugins.clean()
@@ -408,7 +419,7 @@ def session(rec_dir):
         make_coord_system_norm_based()
         g_pool.image_tex.update_from_frame(frame)
         g_pool.image_tex.draw()
-        make_coord_system_pixel_based(frame.img.shape)
+        make_coord_system_pixel_based((frame.height,frame.width,3))
         # render visual feedback from loaded plugins
         for p in g_pool.plugins:
             p.gl_display()
@@ -432,7 +443,9 @@ def session(rec_dir):
     session_settings['window_size'] = glfwGetWindowSize(main_window)
     session_settings['window_position'] = glfwGetWindowPos(main_window)
     session_settings['version'] = g_pool.version
+    session_settings['frame_cache_mb'] = cap.frame_cache_mb
     session_settings.close()
+    logger.debug("Frame cache stats: %s"%cap.cache_stats)
 
     # de-init all running plugins
     for p in g_pool.plugins:
@@ -9,7 +9,6 @@
 '''
 
 import cv2
-from copy import deepcopy
 from plugin import Plugin
 import numpy as np
 from methods import denormalize,normalize
@@ -22,13 +21,15 @@ class Manual_Gaze_Correction(Plugin):
     correct gaze with manually set x and y offset
     """
 
+    gl_only = True
+
     def __init__(self, g_pool,x_offset=0.,y_offset=0.):
         super(Manual_Gaze_Correction, self).__init__(g_pool)
         #let the plugin work before most other plugins.
         self.order = .3
         self.menu = None
 
-        self.untouched_gaze_positions_by_frame = deepcopy(self.g_pool.gaze_positions_by_frame)
+        self.untouched_gaze_positions_by_frame = self.g_pool.gaze_positions_by_frame
         self.x_offset = float(x_offset)
         self.y_offset = float(y_offset)
         self._set_offset()
@@ -37,11 +38,11 @@ class Manual_Gaze_Correction(Plugin):
 
     def _set_offset(self):
         x,y = self.x_offset,self.y_offset
-        for f in range(len(self.g_pool.gaze_positions_by_frame)):
-            for i in range(len(self.g_pool.gaze_positions_by_frame[f])):
-                gaze_pos = self.untouched_gaze_positions_by_frame[f][i]['norm_pos']
-                gaze_pos = gaze_pos[0]+x, gaze_pos[1]+y
-                self.g_pool.gaze_positions_by_frame[f][i]['norm_pos'] =  gaze_pos
+        untouched_gaze = self.untouched_gaze_positions_by_frame.data
+        #in-memory copy of the gaze columns with corrected norm_pos
+        columns = np.array(untouched_gaze.columns)
+        columns['norm_pos'] += x,y
+        self.g_pool.gaze_positions_by_frame = self.untouched_gaze_positions_by_frame.with_data(untouched_gaze.with_columns(columns))
         self.notify_all_delayed({'subject':'gaze_positions_changed'})
 
 
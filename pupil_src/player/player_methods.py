@@ -15,49 +15,142 @@ import numpy as np
 import logging
 logger = logging.getLogger(__name__)
 from file_methods import save_object
+from pupil_data_columns import freeze_datum
+from collections import OrderedDict
+
+
+class Data_By_Frame(object):
+    """
+    CSR style lookup of correlated data per world frame.
+    The data of frame i are data[offsets[i]:offsets[i+1]] (through rows if data is not sorted).
+    Indexing returns a list of dicts with the 'index' field set, like the list of lists we used before.
+
+    Data materialized from columns are frozen (read-only) and recently used frames are cached.
+    Every access returns a new list so callers can add or remove items but not change the data.
+    """
+    cache_size = 120
+
+    def __init__(self,data,offsets,rows=None):
+        self.data = data
+        self.offsets = offsets
+        self.rows = rows
+        #list data are owned by the caller and may be changed by it. We only freeze our own.
+        self.frozen = not isinstance(data,list)
+        self._cache = OrderedDict()
+
+    def with_data(self,data):
+        """same frame correlation for a data sequence with the same length and order"""
+        return Data_By_Frame(data,self.offsets,self.rows)
+
+    def __len__(self):
+        return len(self.offsets)-1
+
+    def column(self,name,section=slice(None)):
+        '''
+        one field of the correlated data of the frames in section as an array in frame order.
+        For the whole recording rows offsets[i]:offsets[i+1] belong to frame i.
+        '''
+        start,stop,_ = section.indices(len(self))
+        first,last = self.offsets[start],self.offsets[max(start,stop)]
+        rows = np.arange(first,last) if self.rows is None else self.rows[first:last]
+        if hasattr(self.data,'columns'):
+            return np.asarray(self.data.columns[name])[rows]
+        return np.array([self.data[r][name] for r in rows.tolist()])
+
+    def frame_indices(self,section=slice(None)):
+        '''
+        the frame index of every row of column(name,section)
+        '''
+        start,stop,_ = section.indices(len(self))
+        stop = max(start,stop)
+        return np.repeat(np.arange(start,stop),np.diff(self.offsets[start:stop+1]))
+
+    def __iter__(self):
+        chunk_size = 1000
+        for start in xrange(0,len(self),chunk_size):
+            for data in self[start:start+chunk_size]:
+                yield data
+
+    def __getitem__(self,key):
+        if isinstance(key,slice):
+            start,stop,step = key.indices(len(self))
+            if step != 1:
+                return [self[i] for i in xrange(start,stop,step)]
+            if stop <= start:
+                return []
+            first = self.offsets[start]
+            data = self._materialize(first,self.offsets[stop])
+            return [self._set_index(data[self.offsets[i]-first:self.offsets[i+1]-first],i) for i in xrange(start,stop)]
+
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError('Data_By_Frame index out of range')
+        if not self.frozen:
+            return self._set_index(self._materialize(self.offsets[key],self.offsets[key+1]),key)
+
+        try:
+            data = self._cache.pop(key)
+        except KeyError:
+            data = self._set_index(self._materialize(self.offsets[key],self.offsets[key+1]),key)
+            if len(self._cache) >= self.cache_size:
+                self._cache.popitem(last=False)
+        self._cache[key] = data
+        return list(data)
+
+    def _materialize(self,start,stop):
+        if self.rows is None:
+            return self.data[start:stop]
+        return self.data.take(self.rows[start:stop])
+
+    def _set_index(self,data,frame_idx):
+        for datum in data:
+            datum['index'] = frame_idx
+        if self.frozen:
+            return [freeze_datum(d) for d in data]
+        return data
 
 
 def correlate_data(data,timestamps):
     '''
-    data:  list of data :
+    data:  list of data or Datum_Columns:
         each datum is a dict with at least:
             timestamp: float
 
     timestamps: timestamps list to correlate  data to
 
-    this takes a data list and a timestamps list and makes a new list
+    this takes a data list and a timestamps list and returns a Data_By_Frame
     with the length of the number of timestamps.
     Each slot contains a list that will have 0, 1 or more assosiated data points.
 
-    Finally we add an index field to the datum with the associated index
+    Every datum is assigned to the frame whose midpoint to the next frame it does not exceed.
+    Data after the last midpoint are dropped.
+    The datum gets an index field with the associated frame index when it is accessed.
     '''
-    timestamps = list(timestamps)
-    data_by_frame = [[] for i in timestamps]
-
-    frame_idx = 0
-    data_index = 0
-
-    data.sort(key=lambda d: d['timestamp'])
-
-    while True:
-        try:
-            datum = data[data_index]
-            # we can take the midpoint between two frames in time: More appropriate for SW timestamps
-            ts = ( timestamps[frame_idx]+timestamps[frame_idx+1] ) / 2.
-            # or the time of the next frame: More appropriate for Sart Of Exposure Timestamps (HW timestamps).
-            # ts = timestamps[frame_idx+1]
-        except IndexError:
-            # we might loose a data point at the end but we dont care
-            break
-
-        if datum['timestamp'] <= ts:
-            datum['index'] = frame_idx
-            data_by_frame[frame_idx].append(datum)
-            data_index +=1
-        else:
-            frame_idx+=1
-
-    return data_by_frame
+    timestamps = np.asarray(timestamps,dtype=np.float64)
+    if hasattr(data,'timestamps'):
+        data_ts = np.asarray(data.timestamps,dtype=np.float64)
+    else:
+        data_ts = np.fromiter((d['timestamp'] for d in data),dtype=np.float64,count=len(data))
+
+    rows = None
+    if np.any(data_ts[1:] < data_ts[:-1]):
+        rows = np.argsort(data_ts,kind='mergesort')
+        data_ts = data_ts[rows]
+        if not hasattr(data,'take'):
+            data = [data[i] for i in rows]
+            rows = None
+
+    # we can take the midpoint between two frames in time: More appropriate for SW timestamps
+    midpoints = (timestamps[:-1]+timestamps[1:])/2.
+    # or the time of the next frame: More appropriate for Sart Of Exposure Timestamps (HW timestamps).
+    # midpoints = timestamps[1:]
+    frame_idx = np.searchsorted(midpoints,data_ts,side='left')
+    # we might loose a data point at the end but we dont care
+    frame_idx = frame_idx[frame_idx < len(midpoints)]
+
+    offsets = np.searchsorted(frame_idx,np.arange(len(timestamps)+1),side='left')
+    return Data_By_Frame(data,offsets,rows)
 
 
 
@@ -0,0 +1,181 @@
+'''
+(*)~----------------------------------------------------------------------------------
+ Pupil - eye tracking platform
+ Copyright (C) 2012-2016  Pupil Labs
+
+ Distributed under the terms of the GNU Lesser General Public License (LGPL v3.0).
+ License details are in the file license.txt, distributed as part of this software.
+----------------------------------------------------------------------------------~(*)
+'''
+
+"""
+Low resolution, all intra proxy of the world video for scrubbing.
+Stored in the recording dir:
+    world_proxy.bin         concatenated jpeg images, one per frame
+    world_proxy_index.npy   int64 (frame_count,2): offset and length of the jpeg of each frame. Length 0: not built yet.
+    world_thumbnails.npy    uint8 (thumb_count,h,w,3): a thumbnail of every thumb_step-th frame
+
+Frames are built in order, so the built part is always a prefix of the video.
+An interrupted build resumes after the last frame that made it to disk.
+"""
+
+import os
+import numpy as np
+import cv2
+import logging
+logger = logging.getLogger(__name__)
+
+proxy_width = 320
+thumb_width = 96
+max_thumb_count = 500
+jpeg_quality = 70
+
+def proxy_paths(rec_dir):
+    return (os.path.join(rec_dir,'world_proxy_index.npy'),
+            os.path.join(rec_dir,'world_proxy.bin'),
+            os.path.join(rec_dir,'world_thumbnails.npy'))
+
+def proxy_layout(frame_count,frame_size):
+    '''
+    returns proxy size, thumbnail size (both width,height) and the number of frames per thumbnail
+    '''
+    width,height = frame_size
+    proxy_size = proxy_width, int(round(height*proxy_width/float(width)/2))*2
+    thumb_size = thumb_width, int(round(height*thumb_width/float(width)))
+    thumb_step = max(1,int(np.ceil(frame_count/float(max_thumb_count))))
+    return proxy_size,thumb_size,thumb_step
+
+def _open_array(path,shape,dtype):
+    try:
+        array = np.lib.format.open_memmap(path,mode='r+')
+        if array.shape == shape and array.dtype == dtype:
+            return array
+        del array
+    except (IOError,ValueError):
+        pass
+    return np.lib.format.open_memmap(path,mode='w+',shape=shape,dtype=dtype)
+
+def init_proxy_files(rec_dir,frame_count,frame_size):
+    '''
+    create the proxy files if needed and drop frames that did not make it to disk.
+    Returns the number of frames built.
+    '''
+    index_path,blob_path,thumbs_path = proxy_paths(rec_dir)
+    proxy_size,thumb_size,thumb_step = proxy_layout(frame_count,frame_size)
+    index = _open_array(index_path,(frame_count,2),np.int64)
+    thumbs = _open_array(thumbs_path,((frame_count-1)//thumb_step+1,thumb_size[1],thumb_size[0],3),np.uint8)
+    del thumbs
+
+    if not os.path.isfile(blob_path):
+        open(blob_path,'wb').close()
+    blob_size = os.path.getsize(blob_path)
+    valid = (index[:,1] > 0) & (index[:,0]+index[:,1] <= blob_size)
+    built = frame_count if valid.all() else int(np.argmin(valid))
+    index[built:] = 0
+    index.flush()
+    with open(blob_path,'r+b') as blob:
+        blob.truncate(index[built-1].sum() if built else 0)
+    return built
+
+
+def build_proxy(video_file_path,timestamps,rec_dir,progress,run):
+    '''
+    this function is part of the seek bar, it is run as a seperate process.
+    it must be kept in a seperate file for namespace sanatisation
+    progress: shared value with the number of frames built
+    '''
+    import os
+    import logging
+    logger = logging.getLogger(__name__+' with pid: '+str(os.getpid()) )
+    logger.debug('Started proxy builder process')
+    from video_capture import File_Capture, EndofVideoFileError,FileSeekError
+
+    frame_count = len(timestamps)
+    index_path,blob_path,thumbs_path = proxy_paths(rec_dir)
+    cap = File_Capture(video_file_path,timestamps=timestamps)
+    proxy_size,thumb_size,thumb_step = proxy_layout(frame_count,cap.frame_size)
+
+    built = init_proxy_files(rec_dir,frame_count,cap.frame_size)
+    progress.value = built
+    index = np.lib.format.open_memmap(index_path,mode='r+')
+    thumbs = np.lib.format.open_memmap(thumbs_path,mode='r+')
+    blob = open(blob_path,'r+b')
+    blob.seek(0,os.SEEK_END)
+
+    def flush():
+        blob.flush()
+        os.fsync(blob.fileno())
+        index.flush()
+        thumbs.flush()
+
+    if built:
+        try:
+            cap.seek_to_frame(built)
+        except FileSeekError:
+            logger.warning("Could not seek to frame %s. Proxy stays incomplete."%built)
+            built = frame_count
+
+    while run.value and built < frame_count:
+        try:
+            frame = cap.get_frame_nowait()
+        except EndofVideoFileError:
+            logger.debug("Video File's last frame(s) not accesible")
+            break
+        if frame.index < built:
+            continue
+
+        small = cv2.resize(frame.img,proxy_size,interpolation=cv2.INTER_AREA)
+        _,jpeg = cv2.imencode('.jpg',small,[int(cv2.IMWRITE_JPEG_QUALITY),jpeg_quality])
+        offset = blob.tell()
+        blob.write(jpeg.tostring())
+        for idx in range(built,frame.index+1):
+            if idx%thumb_step == 0:
+                thumbs[idx//thumb_step] = cv2.resize(small,thumb_size,interpolation=cv2.INTER_AREA)
+        #frames the decoder skipped show the next frame
+        index[built:frame.index+1] = offset,len(jpeg)
+        built = frame.index+1
+        if built%100 == 0:
+            flush()
+        else:
+            #readers only look at frames below progress, their jpeg has to be in the file by then.
+            #the index and thumbs are shared memory maps and need no flush for this.
+            blob.flush()
+        progress.value = built
+
+    flush()
+    blob.close()
+    logger.debug("Closing proxy builder process. %s of %s frames built."%(built,frame_count))
+    cap.close()
+
+
+class Proxy_Reader(object):
+    """
+    read access to the proxy while it is being built.
+    """
+    def __init__(self,rec_dir,frame_count,frame_size):
+        index_path,blob_path,thumbs_path = proxy_paths(rec_dir)
+        self.proxy_size,self.thumb_size,self.thumb_step = proxy_layout(frame_count,frame_size)
+        self.index = np.lib.format.open_memmap(index_path,mode='r')
+        self.thumbs = np.lib.format.open_memmap(thumbs_path,mode='r')
+        self.blob = open(blob_path,'rb')
+        self.built = 0
+
+    def get_frame(self,idx):
+        '''
+        BGR proxy image of frame idx or None if not built yet.
+        '''
+        if not 0 <= idx < self.built:
+            return None
+        offset,length = self.index[idx]
+        self.blob.seek(offset)
+        jpeg = np.frombuffer(self.blob.read(length),dtype=np.uint8)
+        return cv2.imdecode(jpeg,1)
+
+    def get_thumbnail(self,idx):
+        thumb_idx = idx//self.thumb_step
+        if not 0 <= thumb_idx*self.thumb_step < self.built:
+            return None
+        return np.array(self.thumbs[thumb_idx])
+
+    def close(self):
+        self.blob.close()
@@ -0,0 +1,263 @@
+'''
+(*)~----------------------------------------------------------------------------------
+ Pupil - eye tracking platform
+ Copyright (C) 2012-2016  Pupil Labs
+
+ Distributed under the terms of the GNU Lesser General Public License (LGPL v3.0).
+ License details are in the file license.txt, distributed as part of this software.
+----------------------------------------------------------------------------------~(*)
+'''
+
+"""
+Export the raw pupil, gaze and notification data of a trim section.
+
+The pupil data columns are read block by block from the memory mapped arrays
+and written as they are read, nothing is held in memory twice.
+Vector fields are split into one column per component (norm_pos_x, norm_pos_y).
+Every row gets the index of the world frame it belongs to (world_index), see correlate_data.
+
+file formats:
+    csv     pupil_positions.csv, gaze_positions.csv
+    npy     pupil_positions/<column>.npy, gaze_positions/<column>.npy
+    npz     pupil_positions.npz, gaze_positions.npz with one array per column
+
+The gaze base is written as base_data ('timestamp-id' of the pupil data, space separated) to csv.
+npy and npz get base_offsets and base_rows instead: the base of gaze row i is
+base_rows[base_offsets[i]:base_offsets[i+1]], the values are pupil rows as in the pupil `row` column.
+Notifications are always written to notifications.csv.
+"""
+
+import os
+import csv
+import shutil
+import zipfile
+from threading import Thread
+import numpy as np
+from file_methods import Csv_Writer,Npy_Appender
+from pupil_data_columns import load_pupil_columns,load_notifications
+from plugin import Plugin
+from pyglui import ui
+import logging
+logger = logging.getLogger(__name__)
+
+file_formats = ('csv','npy','npz')
+
+component_names = {2:('x','y'),3:('x','y','z')}
+
+
+def flat_columns(columns):
+    '''
+    (name,1d array) for every field of a structured array. Vector fields are split into components.
+    '''
+    flat = []
+    for name in columns.dtype.names:
+        column = columns[name]
+        if column.ndim == 1:
+            flat.append((name,column))
+        else:
+            suffixes = component_names.get(column.shape[1],range(column.shape[1]))
+            for i,suffix in enumerate(suffixes):
+                flat.append(('%s_%s'%(name,suffix),column[:,i]))
+    return flat
+
+
+def world_index(data_ts,timestamps):
+    '''
+    index of the world frame every timestamp belongs to. len(timestamps) for data after the last frame.
+    Uses the same rule as player_methods.correlate_data.
+    '''
+    midpoints = (timestamps[:-1]+timestamps[1:])/2.
+    idx = np.searchsorted(midpoints,data_ts,side='left')
+    idx[idx == len(midpoints)] = len(timestamps)
+    return idx
+
+
+class Column_Writer(object):
+    """
+    write flat columns as one .npy file per column into a directory.
+    """
+    def __init__(self,out_dir):
+        self.out_dir = out_dir
+        if os.path.isdir(out_dir):
+            shutil.rmtree(out_dir)
+        os.mkdir(out_dir)
+        self.appenders = {}
+
+    def append(self,names,columns):
+        for name,column in zip(names,columns):
+            column = np.asarray(column)
+            if name not in self.appenders:
+                self.appenders[name] = Npy_Appender(os.path.join(self.out_dir,name+'.npy'),column.dtype)
+            self.appenders[name].append(column)
+
+    def close(self):
+        for appender in self.appenders.values():
+            appender.close()
+
+    def zip(self,npz_path):
+        '''
+        pack the columns into an npz archive that np.load reads like one from np.savez.
+        '''
+        with zipfile.ZipFile(npz_path,'w',zipfile.ZIP_STORED,allowZip64=True) as npz:
+            for name in sorted(self.appenders):
+                npz.write(os.path.join(self.out_dir,name+'.npy'),name+'.npy')
+        shutil.rmtree(self.out_dir)
+
+
+def _section_rows(data_ts,timestamps,start_frame,end_frame):
+    idx = world_index(data_ts,timestamps)
+    keep = (idx >= start_frame) & (idx < end_frame)
+    return np.flatnonzero(keep),idx[keep]
+
+
+def _base_labels(pupil,rows):
+    ts,ids = pupil['timestamp'][rows].tolist(),pupil['id'][rows].tolist()
+    return ['%r-%d'%(t,i) for t,i in zip(ts,ids)]
+
+
+def export_raw_data(rec_dir,timestamps,out_dir,start_frame=None,end_frame=None,file_format='csv',block_size=100000):
+    '''
+    export frames [start_frame,end_frame) of the raw data to out_dir. Returns False if nothing was exported.
+    '''
+    if file_format not in file_formats:
+        logger.error("Unknown raw data format '%s'. Use one of %s."%(file_format,', '.join(file_formats)))
+        return False
+    timestamps = np.asarray(timestamps,dtype=np.float64)
+    start_frame = start_frame or 0
+    end_frame = len(timestamps) if end_frame is None else min(end_frame,len(timestamps))
+    if end_frame <= start_frame:
+        logger.warning("Start and end frames are set such that no data will be exported.")
+        return False
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    columns = load_pupil_columns(rec_dir)
+    pupil,gaze = columns['pupil_positions'],columns['gaze_positions']
+    base_offsets,base_index = columns['gaze_base_offsets'],columns['gaze_base_index']
+
+    pupil_count = _export_columns(pupil,timestamps,start_frame,end_frame,block_size,out_dir,'pupil_positions',file_format)
+    gaze_count = _export_columns(gaze,timestamps,start_frame,end_frame,block_size,out_dir,'gaze_positions',file_format,
+                                 base=(pupil,base_offsets,base_index))
+    notification_count = export_notifications(load_notifications(rec_dir),timestamps,start_frame,end_frame,
+                                              os.path.join(out_dir,'notifications.csv'))
+    logger.info("Exported %s pupil positions, %s gaze positions and %s notifications to %s"%(pupil_count,gaze_count,notification_count,out_dir))
+    return True
+
+
+def _export_columns(data,timestamps,start_frame,end_frame,block_size,out_dir,name,file_format,base=None):
+    names = ['row','world_index']+[n for n,c in flat_columns(data[:0])]
+    if file_format == 'csv':
+        header = names+['base_data'] if base else names
+        writer = Csv_Writer(os.path.join(out_dir,name+'.csv'),header)
+    else:
+        writer = Column_Writer(os.path.join(out_dir,name))
+        if base:
+            writer.append(['base_rows','base_offsets'],[np.zeros(0,dtype=np.int64),np.zeros(1,dtype=np.int64)])
+        exported_base = 0
+
+    count = 0
+    for start in xrange(0,len(data),block_size):
+        block = data[start:start+block_size]
+        rows,idx = _section_rows(block['timestamp'],timestamps,start_frame,end_frame)
+        block = block[rows]
+        rows += start
+        values = [rows,idx]+[c for n,c in flat_columns(block)]
+        if base:
+            pupil,base_offsets,base_index = base
+            starts,stops = base_offsets[rows],base_offsets[rows+1]
+            lengths = stops-starts
+            #flat positions into base_index of all base entries of the selected rows
+            flat = np.repeat(starts-np.cumsum(lengths)+lengths,lengths)+np.arange(lengths.sum())
+            base_rows = np.asarray(base_index[flat]) if len(flat) else np.zeros(0,dtype=np.int64)
+            #references beyond the pupil data can occur in recordings that were not closed properly
+            base_rows[base_rows >= len(pupil)] = -1
+            if file_format == 'csv':
+                valid = base_rows >= 0
+                labels = np.array(['']*len(base_rows),dtype=object)
+                labels[valid] = _base_labels(pupil,base_rows[valid])
+                bounds = np.concatenate(([0],np.cumsum(lengths))).tolist()
+                labels = labels.tolist()
+                values.append([' '.join(labels[b:e]) for b,e in zip(bounds[:-1],bounds[1:])])
+            else:
+                writer.append(['base_rows','base_offsets'],[base_rows,exported_base+np.cumsum(lengths)])
+                exported_base += len(base_rows)
+        if file_format == 'csv':
+            writer.append(values)
+        else:
+            writer.append(names,values)
+        count += len(rows)
+
+    writer.close()
+    if file_format == 'npz':
+        writer.zip(os.path.join(out_dir,name+'.npz'))
+    return count
+
+
+def export_notifications(notifications,timestamps,start_frame,end_frame,out_file_path):
+    '''
+    notifications have no fixed fields. Columns are the union of all keys, timestamp and subject first.
+    '''
+    notifications = [n for n in notifications if 'timestamp' in n]
+    if notifications:
+        idx = world_index(np.array([n['timestamp'] for n in notifications],dtype=np.float64),timestamps)
+        section = [(i,n) for i,n in zip(idx.tolist(),notifications) if start_frame <= i < end_frame]
+    else:
+        section = []
+    keys = set()
+    for i,n in section:
+        keys.update(n.keys())
+    keys = ['timestamp','subject']+sorted(keys-set(('timestamp','subject')))
+    with open(out_file_path,'wb') as csvfile:
+        csv_writer = csv.writer(csvfile)
+        csv_writer.writerow(['world_index']+keys)
+        for i,n in section:
+            csv_writer.writerow([i]+[n.get(k,'') for k in keys])
+    return len(section)
+
+
+class Raw_Data_Exporter(Plugin):
+    """
+    export the raw pupil, gaze and notification data of the trim section.
+    """
+    needs_events = False
+    gl_only = True
+
+    def __init__(self,g_pool,file_format='csv'):
+        super(Raw_Data_Exporter, self).__init__(g_pool)
+        self.file_format = file_format
+        self.menu = None
+        self.thread = None
+
+    def init_gui(self):
+        self.menu = ui.Scrolling_Menu('Raw Data Exporter')
+        self.menu.append(ui.Button('Close',self.close))
+        self.menu.append(ui.Info_Text('Export pupil and gaze positions and notifications of the trim section into the recording directory.'))
+        self.menu.append(ui.Selector('file_format',self,selection=list(file_formats),label='file format'))
+        self.menu.append(ui.Button('export raw data',self.export_data))
+        self.g_pool.gui.append(self.menu)
+
+    def deinit_gui(self):
+        if self.menu:
+            self.g_pool.gui.remove(self.menu)
+            self.menu = None
+
+    def export_data(self):
+        if self.thread and self.thread.is_alive():
+            logger.warning("Raw data export is still running.")
+            return
+        in_mark = self.g_pool.trim_marks.in_mark
+        out_mark = self.g_pool.trim_marks.out_mark
+        out_dir = os.path.join(self.g_pool.rec_dir,"raw_data_%s-%s"%(in_mark,out_mark))
+        self.thread = Thread(target=export_raw_data,args=(self.g_pool.rec_dir,self.g_pool.timestamps,out_dir,in_mark,out_mark+1,self.file_format))
+        self.thread.start()
+
+    def close(self):
+        self.alive = False
+
+    def get_init_dict(self):
+        return {'file_format':self.file_format}
+
+    def cleanup(self):
+        if self.thread:
+            self.thread.join()
+        self.deinit_gui()
@@ -22,6 +22,9 @@ class Scan_Path(Plugin):
     lock recent gaze points onto pixels.
     """
 
+    reads_image = True
+    writes_image = False
+
     def __init__(self, g_pool,timeframe=.5):
         super(Scan_Path, self).__init__(g_pool)
         #let the plugin work after most other plugins.
@@ -38,12 +41,11 @@ class Scan_Path(Plugin):
 
 
     def update(self,frame,events):
-        img = frame.img
-        img_shape = img.shape[:-1][::-1] # width,height
+        img_shape = frame.width,frame.height
 
         succeeding_frame = frame.index-self.prev_frame_idx == 1
         same_frame = frame.index == self.prev_frame_idx
-        gray_img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        gray_img = frame.gray
 
         #vars for calcOpticalFlowPyrLK
         lk_params = dict( winSize  = (90, 90),
@@ -59,6 +61,7 @@ class Scan_Path(Plugin):
             for gaze,new_gaze_pt,s,e in zip(self.past_gaze_positions,new_pts,status,err):
                 if s:
                     # print "norm,updated",gaze['norm_gaze'], normalize(new_gaze_pt,img_shape[:-1],flip_y=True)
+                    gaze = gaze.copy()
                     gaze['norm_pos'] = normalize(new_gaze_pt,img_shape,flip_y=True)
                     updated_past_gaze.append(gaze)
                     # logger.debug("updated gaze")
@@ -8,13 +8,24 @@
 ----------------------------------------------------------------------------------~(*)
 '''
 
-from pyglui.cygl.utils import draw_polyline,draw_points,RGBA
+import platform
+if platform.system() == 'Darwin':
+    from billiard import Process,forking_enable
+    from billiard.sharedctypes import Value
+else:
+    from multiprocessing import Process
+    forking_enable = lambda x: x #dummy fn
+    from multiprocessing.sharedctypes import Value
+from ctypes import c_bool
+
+from pyglui.cygl.utils import draw_polyline,draw_points,RGBA,Named_Texture
 
 from OpenGL.GL import *
 from OpenGL.GLU import gluOrtho2D
 
 from glfw import glfwGetWindowSize,glfwGetCurrentContext,glfwGetCursorPos,GLFW_RELEASE,GLFW_PRESS,glfwGetFramebufferSize
 from plugin import Plugin
+from proxy_builder import init_proxy_files,build_proxy,Proxy_Reader
 
 import logging
 logger = logging.getLogger(__name__)
@@ -23,7 +34,13 @@ class Seek_Bar(Plugin):
     """docstring for Seek_Bar
     seek bar displays a bar at the bottom of the screen when you hover close to it.
     it will show the current positon and allow you to drag to any postion in the video file.
+    while dragging frames are shown from a low resolution proxy that is built in the background,
+    the full resolution frame is decoded on release.
     """
+    reads_image = False
+    writes_image = False
+    needs_events = False
+
     def __init__(self, g_pool):
         super(Seek_Bar, self).__init__(g_pool)
         self.cap = g_pool.capture
@@ -36,8 +53,43 @@ class Seek_Bar(Plugin):
         self.padding = 20. #in sceen pixel
         self.window_size = 0,0
 
+        self.proxy = None
+        self.proxy_builder = None
+        self.preview_idx = None
+        self.thumb_idx = None
+        if g_pool.app == 'player':
+            self.init_proxy_builder()
+
+    def init_proxy_builder(self):
+        try:
+            built = init_proxy_files(self.g_pool.rec_dir,self.frame_count,self.cap.frame_size)
+            self.proxy = Proxy_Reader(self.g_pool.rec_dir,self.frame_count,self.cap.frame_size)
+        except (IOError,OSError) as e:
+            logger.warning("Could not create scrubbing proxy: %s"%e)
+            self.proxy = None
+            return
+        self.proxy_progress = Value('i',built)
+        self.proxy.built = built
+        if built >= self.frame_count:
+            return
+        forking_enable(0) #for MacOs only
+        self.proxy_run = Value(c_bool,True)
+        self.proxy_builder = Process(target=build_proxy, args=(self.cap.src,self.cap.timestamps,self.g_pool.rec_dir,self.proxy_progress,self.proxy_run))
+        self.proxy_builder.start()
+
+    def close_proxy_builder(self):
+        if self.proxy_builder:
+            self.proxy_run.value = False
+            self.proxy_builder.join()
+            self.proxy_builder = None
+        if self.proxy:
+            self.proxy.close()
+            self.proxy = None
+
     def init_gui(self):
         self.on_window_resize(glfwGetCurrentContext(),*glfwGetWindowSize(glfwGetCurrentContext()))
+        self.preview_texture = Named_Texture()
+        self.thumb_texture = Named_Texture()
 
     def on_window_resize(self,window,w,h):
         self.window_size = w,h
@@ -45,14 +97,25 @@ class Seek_Bar(Plugin):
         self.v_pad = self.padding * 1./h
 
     def update(self,frame,events):
-        self.current_frame_index = frame.index
+        if self.proxy:
+            self.proxy.built = self.proxy_progress.value
+        if self.preview_idx is None:
+            self.current_frame_index = frame.index
+
+        x,y = glfwGetCursorPos(glfwGetCurrentContext())
+        x,y = self.screen_to_seek_bar((x,y))
+        self.update_thumbnail(x,y)
 
         if self.drag_mode:
-            x,y = glfwGetCursorPos(glfwGetCurrentContext())
-            x,_ = self.screen_to_seek_bar((x,y))
             seek_pos = min(self.frame_count,max(0,x))
             if abs(seek_pos-self.current_frame_index) >=.002*self.frame_count:
                 seek_pos = int(min(seek_pos,self.frame_count-5)) #the last frames can be problematic to seek to
+                preview = self.proxy.get_frame(seek_pos) if self.proxy else None
+                if preview is not None:
+                    self.preview_texture.update_from_ndarray(preview)
+                    self.preview_idx = self.current_frame_index = seek_pos
+                    return
+                self.preview_idx = None
                 try:
                     self.cap.seek_to_frame_fast(seek_pos)
                     self.current_frame_index = self.cap.get_frame_index()
@@ -60,6 +123,18 @@ class Seek_Bar(Plugin):
                     pass
                 self.g_pool.new_seek = True
 
+    def update_thumbnail(self,x,y):
+        thumb_idx = None
+        if self.proxy and not self.drag_mode and 0 <= x < self.frame_count and y < self.v_pad*2:
+            thumb_idx = int(x)//self.proxy.thumb_step
+        if thumb_idx != self.thumb_idx:
+            thumb = self.proxy.get_thumbnail(thumb_idx*self.proxy.thumb_step) if thumb_idx is not None else None
+            if thumb is None:
+                thumb_idx = None
+            else:
+                self.thumb_texture.update_from_ndarray(thumb)
+            self.thumb_idx = thumb_idx
+
     def on_click(self,img_pos,button,action):
         """
         gets called when the user clicks in the window screen
@@ -85,6 +160,7 @@ class Seek_Bar(Plugin):
                 except:
                     pass
                 self.g_pool.new_seek = True
+                self.preview_idx = None
                 self.drag_mode=False
                 self.g_pool.play = self.was_playing
 
@@ -104,6 +180,9 @@ class Seek_Bar(Plugin):
         return x,1-y
 
     def gl_display(self):
+        if self.preview_idx is not None:
+            self.gl_display_preview()
+
         glMatrixMode(GL_PROJECTION)
         glPushMatrix()
         glLoadIdentity()
@@ -119,6 +198,11 @@ class Seek_Bar(Plugin):
             color1 = (.25,.8,.8,.5)
             color2 = (.25,.8,.8,1.)
 
+        if self.proxy and self.proxy.built < self.frame_count:
+            draw_polyline(verts=[(0,-.5*self.v_pad),(self.proxy.built,-.5*self.v_pad)],color=RGBA(.8,.6,.2,.8),thickness=4)
+        if self.thumb_idx is not None:
+            self.gl_display_thumbnail()
+
         draw_polyline(verts=[(0,0),(self.current_frame_index,0)],color=RGBA(*color1))
         draw_polyline(verts=[(self.current_frame_index,0),(self.frame_count,0)],color=RGBA(.5,.5,.5,.5))
         draw_points([(self.current_frame_index,0)],color=RGBA(*color1),size=40)
@@ -128,3 +212,34 @@ class Seek_Bar(Plugin):
         glPopMatrix()
         glMatrixMode(GL_MODELVIEW)
         glPopMatrix()
+
+    def gl_display_preview(self):
+        # proxy frame stretched over the whole window
+        glMatrixMode(GL_PROJECTION)
+        glPushMatrix()
+        glLoadIdentity()
+        glOrtho(0,1,0,1,-1,1)
+        glMatrixMode(GL_MODELVIEW)
+        glPushMatrix()
+        glLoadIdentity()
+        self.preview_texture.draw()
+        glMatrixMode(GL_PROJECTION)
+        glPopMatrix()
+        glMatrixMode(GL_MODELVIEW)
+        glPopMatrix()
+
+    def gl_display_thumbnail(self):
+        # called in seek bar coords: place the thumbnail above the bar at its native pixel size
+        width,height = self.window_size
+        t_w,t_h = self.proxy.thumb_size
+        x_scale = (self.frame_count+2*self.h_pad)/width
+        y_scale = (1+2*self.v_pad)/height
+        x = (self.thumb_idx+.5)*self.proxy.thumb_step
+        glPushMatrix()
+        glTranslatef(x-t_w*x_scale/2.,2*self.v_pad,0)
+        glScalef(t_w*x_scale,t_h*y_scale,1)
+        self.thumb_texture.draw()
+        glPopMatrix()
+
+    def cleanup(self):
+        self.close_proxy_builder()
@@ -19,6 +19,10 @@ logger = logging.getLogger(__name__)
 class Trim_Marks(Plugin):
     """docstring for Trim_Mark
     """
+    reads_image = False
+    writes_image = False
+    needs_events = False
+
     def __init__(self, g_pool):
         super(Trim_Marks, self).__init__(g_pool)
         g_pool.trim_marks = self #attach self for ease of access by others.
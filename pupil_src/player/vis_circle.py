@@ -20,6 +20,7 @@ from methods import denormalize
 
 class Vis_Circle(Plugin):
     uniqueness = "not_unique"
+    writes_image = True
 
     def __init__(self, g_pool,radius=20,color=(0.0,0.7,0.25,0.2),thickness=2,fill=True):
         super(Vis_Circle, self).__init__(g_pool)
@@ -42,7 +43,7 @@ class Vis_Circle(Plugin):
         else:
             thickness = self.thickness
 
-        pts = [denormalize(pt['norm_pos'],frame.img.shape[:-1][::-1],flip_y=True) for pt in events.get('gaze_positions',[])]
+        pts = [denormalize(pt['norm_pos'],(frame.width,frame.height),flip_y=True) for pt in events.get('gaze_positions',[])]
         for pt in pts:
             transparent_circle(frame.img, pt, radius=self.radius, color=(self.b, self.g, self.r, self.a), thickness=thickness)
 
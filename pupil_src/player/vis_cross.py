@@ -17,6 +17,7 @@ from methods import denormalize
 
 class Vis_Cross(Plugin):
     uniqueness = "not_unique"
+    writes_image = True
 
     def __init__(self, g_pool,inner=20,outer=100,color=(1.,0.0,0.0,1.0),thickness=1):
         super(Vis_Cross, self).__init__(g_pool)
@@ -32,7 +33,7 @@ class Vis_Cross(Plugin):
         self.thickness = thickness
 
     def update(self,frame,events):
-        pts = [denormalize(pt['norm_pos'],frame.img.shape[:-1][::-1],flip_y=True) for pt in events.get('gaze_positions',[])]
+        pts = [denormalize(pt['norm_pos'],(frame.width,frame.height),flip_y=True) for pt in events.get('gaze_positions',[])]
         bgra = (self.b*255,self.g*255,self.r*255,self.a*255)
         for pt in pts:
             lines =  np.array( [((pt[0]-self.inner,pt[1]),(pt[0]-self.outer,pt[1])),((pt[0]+self.inner,pt[1]),(pt[0]+self.outer,pt[1])) , ((pt[0],pt[1]-self.inner),(pt[0],pt[1]-self.outer)) , ((pt[0],pt[1]+self.inner),(pt[0],pt[1]+self.outer))],dtype=np.int32 )
@@ -23,6 +23,7 @@ class Vis_Light_Points(Plugin):
 
     """
     uniqueness = "not_unique"
+    writes_image = True
 
     def __init__(self, g_pool,falloff = 20):
         super(Vis_Light_Points, self).__init__(g_pool)
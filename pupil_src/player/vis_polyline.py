@@ -18,6 +18,7 @@ from methods import denormalize
 
 class Vis_Polyline(Plugin):
     uniqueness = "not_unique"
+    writes_image = True
     def __init__(self, g_pool,color=(1.0,0.0,0.4,1.0),thickness=2):
         super(Vis_Polyline, self).__init__(g_pool)
         self.order = .9
@@ -30,7 +31,7 @@ class Vis_Polyline(Plugin):
         self.thickness = thickness
 
     def update(self,frame,events):
-        pts = [denormalize(pt['norm_pos'],frame.img.shape[:-1][::-1],flip_y=True) for pt in events.get('gaze_positions',[])]
+        pts = [denormalize(pt['norm_pos'],(frame.width,frame.height),flip_y=True) for pt in events.get('gaze_positions',[])]
         bgra = (self.b*255,self.g*255,self.r*255,self.a*255)
         if pts:
             pts = np.array([pts],dtype=np.int32)
@@ -24,6 +24,8 @@ logger = logging.getLogger(__name__)
 
 class Vis_Watermark(Plugin):
     uniqueness = "not_unique"
+    writes_image = True
+    needs_events = False
 
     def __init__(self, g_pool,selected_watermark_path = None,pos = (20,20)):
         super(Vis_Watermark, self).__init__(g_pool)
@@ -63,15 +65,15 @@ class Vis_Watermark(Plugin):
         if self.drag_offset is not None:
             pos = glfwGetCursorPos(glfwGetCurrentContext())
             pos = normalize(pos,glfwGetWindowSize(glfwGetCurrentContext()))
-            pos = denormalize(pos,(frame.img.shape[1],frame.img.shape[0]) ) # Position in img pixels
+            pos = denormalize(pos,(frame.width,frame.height) ) # Position in img pixels
             self.pos[0] = pos[0]+self.drag_offset[0]
             self.pos[1] = pos[1]+self.drag_offset[1]
 
 
         if self.watermark is not None:
             #keep in image bounds, do this even when not dragging because the image sizes could change.
-            self.pos[1] = max(0,min(frame.img.shape[0]-self.watermark.shape[0],max(self.pos[1],0)))
-            self.pos[0] = max(0,min(frame.img.shape[1]-self.watermark.shape[1],max(self.pos[0],0)))
+            self.pos[1] = max(0,min(frame.height-self.watermark.shape[0],max(self.pos[1],0)))
+            self.pos[0] = max(0,min(frame.width-self.watermark.shape[1],max(self.pos[0],0)))
             pos = int(self.pos[0]),int(self.pos[1])
             img  = frame.img
             roi = slice(pos[1],pos[1]+self.watermark.shape[0]),slice(pos[0],pos[0]+self.watermark.shape[1])
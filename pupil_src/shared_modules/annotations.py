@@ -11,6 +11,7 @@ import os
 from pyglui import ui
 from plugin import Plugin
 from file_methods import load_object,save_object
+from pupil_data_columns import load_notifications
 
 import numpy as np
 from OpenGL.GL import *
@@ -26,6 +27,9 @@ logger = logging.getLogger(__name__)
 class Annotation_Capture(Plugin):
     """Describe your plugin here
     """
+    reads_image = False
+    writes_image = False
+
     def __init__(self,g_pool,annotations=[('My annotation','E')]):
         super(Annotation_Capture, self).__init__(g_pool)
         self.menu = None
@@ -139,7 +143,7 @@ class Annotation_Player(Annotation_Capture):
         except IOError as e:
             #if that fails we assume this is the first time this recording is played and we load annotations from pupil_data
             try:
-                notifications_list = load_object(os.path.join(self.g_pool.rec_dir, "pupil_data"))['notifications']
+                notifications_list = load_notifications(self.g_pool.rec_dir)
                 annotations_list = [n for n in notifications_list if n['subject']=='annotation']
             except (KeyError,IOError) as e:
                 annotations_list = []
@@ -149,7 +153,8 @@ class Annotation_Player(Annotation_Capture):
         else:
             logger.debug('loaded %s annotations from annotations file'%len(annotations_list))
 
-        self.annotations_by_frame = correlate_data(annotations_list, self.g_pool.timestamps)
+        #we add annotations in player, so we need a list for each frame
+        self.annotations_by_frame = list(correlate_data(annotations_list, self.g_pool.timestamps))
         self.annotations_list = annotations_list
 
     def init_gui(self):
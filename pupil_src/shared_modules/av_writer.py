@@ -27,6 +27,7 @@ logger = logging.getLogger(__name__)
 
 from threading import Thread
 from threading import Event
+from Queue import Queue,Empty
 
 
 
@@ -62,18 +63,41 @@ to be valid and should only now be accesed.
 
 """
 
+"""
+encoder presets for AV_Writer, the video_stream argument takes a name or a dict like these:
+    codec: ffmpeg encoder name
+    bit_rate: target bit rate in bit/s
+    crf, preset: encoder options (x264). crf is constant quality, lower is better.
+    thread_count: encoder threads, 0 lets the encoder decide
+    pix_fmt: pixel format of the encoded stream
+"""
+encoder_presets = {
+    'mpeg4':{'codec':'mpeg4','bit_rate': 15000*10e3,'thread_count':1},
+    'h264 high quality':{'codec':'libx264','crf':18,'preset':'medium','pix_fmt':'yuv420p','thread_count':0},
+    'h264 balanced':{'codec':'libx264','crf':23,'preset':'veryfast','pix_fmt':'yuv420p','thread_count':0},
+    'h264 small':{'codec':'libx264','crf':28,'preset':'slow','pix_fmt':'yuv420p','thread_count':0},
+    }
+
 class AV_Writer(object):
     """
     AV_Writer class
         - file_loc: path to file out
-        - video_stream:
+        - video_stream: name of an encoder preset or a dict, see encoder_presets
         - audio_stream:
+        - threaded: encode and mux on a seperate thread. Frames are copied into
+                    one of queue_size reusable buffers and handed to the encoder thread.
+        - drop_frames: only used when threaded. When all buffers are in use
+                    True: drop the frame. False: block until the encoder catches up.
+                    Dropped frames leave a gap in the pts, the timing of the others stays correct.
+        - frame_format: 'bgr24' encodes frame.img. 'yuv420p' encodes the decoded planes in frame.yuv
+                    and avoids the BGR conversion, use it when nothing draws on the frames.
+                    Frames with a yuv_buffer are always encoded from their yuv422 planes.
 
 
     We are creating a
     """
 
-    def __init__(self, file_loc,fps=30, video_stream={'codec':'mpeg4','bit_rate': 15000*10e3}, audio_stream=None,use_timestamps=False):
+    def __init__(self, file_loc,fps=30, video_stream='mpeg4', audio_stream=None,use_timestamps=False,threaded=False,queue_size=30,drop_frames=False,frame_format='bgr24'):
         super(AV_Writer, self).__init__()
         self.use_timestamps = use_timestamps
         # the approximate capture rate.
@@ -97,53 +121,149 @@ class AV_Writer(object):
         else:
             self.time_base = Fraction(1000,self.fps*1000) #timebase is fps
 
-        self.video_stream = self.container.add_stream(video_stream['codec'],1/self.time_base)
-        self.video_stream.bit_rate = video_stream['bit_rate']
-        self.video_stream.bit_rate_tolerance = video_stream['bit_rate']/20
-        self.video_stream.thread_count = 1
-        # self.video_stream.pix_fmt = "yuv420p"
+        if isinstance(video_stream,basestring):
+            try:
+                video_stream = encoder_presets[video_stream]
+            except KeyError:
+                logger.error("Unknown encoder preset '%s'. Using mpeg4."%video_stream)
+                video_stream = encoder_presets['mpeg4']
+
+        options = dict((k,str(video_stream[k])) for k in ('crf','preset') if k in video_stream)
+        if options:
+            try:
+                self.video_stream = self.container.add_stream(video_stream['codec'],1/self.time_base,options=options)
+            except TypeError:
+                logger.warning("This version of PyAV does not take encoder options. Ignoring %s."%options)
+                self.video_stream = self.container.add_stream(video_stream['codec'],1/self.time_base)
+        else:
+            self.video_stream = self.container.add_stream(video_stream['codec'],1/self.time_base)
+        if 'bit_rate' in video_stream:
+            self.video_stream.bit_rate = video_stream['bit_rate']
+            self.video_stream.bit_rate_tolerance = video_stream['bit_rate']/20
+        self.video_stream.thread_count = video_stream.get('thread_count',1)
+        if 'pix_fmt' in video_stream:
+            self.video_stream.pix_fmt = video_stream['pix_fmt']
         self.configured = False
+        self.frame_format = frame_format
         self.start_time = None
 
         self.current_frame_idx = 0
 
-    def write_video_frame(self, input_frame):
-        if not self.configured:
-            self.video_stream.height = input_frame.height
-            self.video_stream.width = input_frame.width
-            self.configured = True
-            self.start_time = input_frame.timestamp
-            if input_frame.yuv_buffer:
-                self.frame = av.VideoFrame(input_frame.width, input_frame.height,'yuv422p')
-            else:
-                self.frame = av.VideoFrame(input_frame.width,input_frame.height,'bgr24')
-            if self.use_timestamps:
-                self.frame.time_base = self.time_base
-            else:
-                self.frame.time_base = Fraction(1,self.fps)
-
+        self.threaded = threaded
+        self.queue_size = queue_size
+        self.drop_frames = drop_frames
+        self.frames_dropped = 0
+        self.frames_encoded = 0
+        self.encoder_latency = 0. #running average of the time from write_video_frame to mux in seconds
+        self.encoder_error = None
+        if self.threaded:
+            self.free_buffers = Queue()
+            self.frame_queue = Queue()
+            self.encoder_thread = Thread(target=self._encoder_loop)
+            self.encoder_thread.daemon = True
+            self.encoder_thread.start()
+
+    def _configure(self,input_frame):
+        self.video_stream.height = input_frame.height
+        self.video_stream.width = input_frame.width
+        self.configured = True
+        self.start_time = input_frame.timestamp
         if input_frame.yuv_buffer:
-            y,u,v = input_frame.yuv422
-            self.frame.planes[0].update(y)
-            self.frame.planes[1].update(u)
-            self.frame.planes[2].update(v)
+            self.frame = av.VideoFrame(input_frame.width, input_frame.height,'yuv422p')
         else:
-            self.frame.planes[0].update(input_frame.img)
+            self.frame = av.VideoFrame(input_frame.width,input_frame.height,self.frame_format)
+        if self.use_timestamps:
+            self.frame.time_base = self.time_base
+        else:
+            self.frame.time_base = Fraction(1,self.fps)
+        if self.threaded:
+            for x in range(self.queue_size):
+                self.free_buffers.put([np.empty_like(p) for p in self._planes(input_frame)])
+
+    def _planes(self,input_frame):
+        if input_frame.yuv_buffer:
+            return input_frame.yuv422
+        if self.frame_format == 'yuv420p':
+            return input_frame.yuv
+        return input_frame.img,
 
+    def _next_pts(self,input_frame):
         if self.use_timestamps:
-            self.frame.pts = int( (input_frame.timestamp-self.start_time)/self.time_base )
+            pts = int( (input_frame.timestamp-self.start_time)/self.time_base )
         else:
             # our timebase is 1/30  so a frame idx is the correct pts for an fps recorded video.
-            self.frame.pts = self.current_frame_idx
+            pts = self.current_frame_idx
+        self.current_frame_idx +=1
+        return pts
+
+    def _encode(self,planes,pts):
+        for plane,data in zip(self.frame.planes,planes):
+            plane.update(data)
+        self.frame.pts = pts
         #send frame of to encoder
         packet = self.video_stream.encode(self.frame)
         if packet:
             self.container.mux(packet)
-        self.current_frame_idx +=1
+        self.frames_encoded += 1
 
+    def write_video_frame(self, input_frame):
+        if not self.configured:
+            self._configure(input_frame)
+
+        planes = self._planes(input_frame)
+        pts = self._next_pts(input_frame)
+        if not self.threaded:
+            self._encode(planes,pts)
+            return
 
+        if self.encoder_error:
+            raise self.encoder_error
+        try:
+            buffers = self.free_buffers.get(block=not self.drop_frames)
+        except Empty:
+            self.frames_dropped += 1
+            return
+        for buf,data in zip(buffers,planes):
+            buf[:] = data
+        self.frame_queue.put((buffers,pts,time()))
+
+    def _encoder_loop(self):
+        while True:
+            item = self.frame_queue.get()
+            if item is None:
+                break
+            buffers,pts,submit_time = item
+            try:
+                self._encode(buffers,pts)
+            except Exception as e:
+                logger.error("Encoder failed: %s"%e)
+                self.encoder_error = e
+                self.free_buffers.put(buffers)
+                #keep consuming so a blocked writer can return and see the error
+                continue
+            self.free_buffers.put(buffers)
+            self.encoder_latency += (time()-submit_time-self.encoder_latency)*.05
+
+    @property
+    def queue_depth(self):
+        if self.threaded:
+            return self.frame_queue.qsize()
+        return 0
+
+    def metrics(self):
+        return {'queue_depth':self.queue_depth,'encoder_latency':self.encoder_latency,
+                'frames_encoded':self.frames_encoded,'frames_dropped':self.frames_dropped}
 
     def close(self):
+        if self.threaded and self.encoder_thread:
+            #drain the queue
+            self.frame_queue.put(None)
+            self.encoder_thread.join()
+            self.encoder_thread = None
+            logger.debug("Encoder thread done. %s"%self.metrics())
+            if self.frames_dropped:
+                logger.warning("Dropped %s frames because the encoder could not keep up."%self.frames_dropped)
+
         # flush encoder
         while 1:
             packet = self.video_stream.encode()
@@ -10,6 +10,8 @@
 
 import cPickle as pickle
 import os
+import struct
+import numpy as np
 import logging
 logger = logging.getLogger(__name__)
 
@@ -52,6 +54,145 @@ def save_object(object,file_path):
 	with open(file_path,'wb') as fh:
 		pickle.dump(object,fh,-1)
 
+
+class Npy_Appender(object):
+	"""
+	append rows to a .npy file that stays readable with np.load at any time.
+	The header has a fixed size and is rewritten with the new row count after
+	the rows are on disk. After a crash the file holds at least as many rows as its header says.
+	"""
+	def __init__(self, file_path, dtype, row_shape=(), append=False):
+		self.file_path = os.path.expanduser(file_path)
+		self.dtype = np.dtype(dtype)
+		self.row_shape = tuple(row_shape)
+		self.count = 0
+		#reserve enough room for the largest row count we could ever write.
+		self.header_size = len(self._header_dict(2**63)) + 16
+		self.header_size += 64 - self.header_size%64
+		if append and self._reopen():
+			return
+		self.fh = open(self.file_path,'wb')
+		self._write_header()
+
+	def _reopen(self):
+		'''
+		continue a file written by an Npy_Appender. Rows beyond the header count are cut off.
+		'''
+		try:
+			fh = open(self.file_path,'r+b')
+		except IOError:
+			return False
+		try:
+			np.lib.format.read_magic(fh)
+			shape,fortran_order,dtype = np.lib.format.read_array_header_1_0(fh)
+		except ValueError:
+			fh.close()
+			return False
+		if fh.tell() != self.header_size or dtype != self.dtype or tuple(shape[1:]) != self.row_shape:
+			fh.close()
+			return False
+		self.fh = fh
+		self.count = shape[0]
+		self.fh.truncate(self.header_size + self.count*self.dtype.itemsize*int(np.prod(self.row_shape)))
+		self.fh.seek(0,os.SEEK_END)
+		return True
+
+	def _header_dict(self,count):
+		return "{'descr': %r, 'fortran_order': False, 'shape': %r, }"%(np.lib.format.dtype_to_descr(self.dtype),(count,)+self.row_shape)
+
+	def _write_header(self):
+		preamble = np.lib.format.magic(1,0) + struct.pack('<H',self.header_size-10)
+		header = self._header_dict(self.count).ljust(self.header_size-len(preamble)-1) + '\n'
+		self.fh.seek(0)
+		self.fh.write(preamble+header)
+		self.fh.seek(0,os.SEEK_END)
+
+	def append(self, rows):
+		rows = np.ascontiguousarray(rows,dtype=self.dtype)
+		if rows.shape[1:] != self.row_shape:
+			rows = rows.reshape((-1,)+self.row_shape)
+		self.fh.write(rows.tostring())
+		self.count += rows.shape[0]
+
+	def flush(self):
+		"""make appended rows durable and visible to readers"""
+		self.fh.flush()
+		os.fsync(self.fh.fileno())
+		self._write_header()
+		self.fh.flush()
+
+	def close(self):
+		if self.fh:
+			self.flush()
+			self.fh.close()
+			self.fh = None
+
+
+class Csv_Writer(object):
+	"""
+	write equal length 1d columns to a csv file in blocks.
+	A block is formatted with one string operation instead of a csv.writer call per row.
+	Floats keep full precision (repr), missing floats are written as nan, bools as True/False.
+	Values are not quoted, use this only for numbers and strings without delimiters.
+	"""
+	def __init__(self, file_path, header, delimiter=','):
+		self.file_path = os.path.expanduser(file_path)
+		self.header = tuple(header)
+		self.delimiter = delimiter
+		self.row_format = None
+		self.count = 0
+		self.fh = open(self.file_path,'wb')
+		self.fh.write(delimiter.join(self.header)+'\n')
+
+	def _format_of(self,column):
+		kind = column.dtype.kind
+		if kind == 'f':
+			return '%r'
+		elif kind in 'iu':
+			return '%d'
+		return '%s'
+
+	def append(self, columns):
+		columns = [np.asarray(c) for c in columns]
+		assert len(columns) == len(self.header)
+		n = len(columns[0])
+		if n == 0:
+			return
+		if self.row_format is None:
+			self.row_format = self.delimiter.join(self._format_of(c) for c in columns)+'\n'
+		values = np.empty((n,len(columns)),dtype=object)
+		for i,c in enumerate(columns):
+			values[:,i] = c
+		self.fh.write((self.row_format*n)%tuple(values.ravel()))
+		self.count += n
+
+	def close(self):
+		if self.fh:
+			self.fh.close()
+			self.fh = None
+
+
+def append_object(object,file_path):
+	"""append a pickle record. Read all records back with load_appended_objects"""
+	file_path = os.path.expanduser(file_path)
+	with open(file_path,'ab') as fh:
+		pickle.dump(object,fh,-1)
+
+def load_appended_objects(file_path):
+	"""returns all pickle records in a file. A truncated last record is ignored."""
+	file_path = os.path.expanduser(file_path)
+	objects = []
+	with open(file_path,'rb') as fh:
+		while True:
+			try:
+				objects.append(pickle.load(fh))
+			except EOFError:
+				break
+			except Exception:
+				logger.warning("File '%s' ends with an incomplete record. Ignoring it."%file_path)
+				break
+	return objects
+
 if __name__ == '__main__':
 	logging.basicConfig(level=logging.DEBUG)
 	# settings = Persistent_Dict("~/Desktop/test")
@@ -19,6 +19,7 @@ from methods import denormalize
 from plugin import Plugin
 from pyglui import ui
 from player_methods import transparent_circle
+from file_methods import Csv_Writer
 # logging
 logger = logging.getLogger(__name__)
 
@@ -44,6 +45,12 @@ class Dispersion_Duration_Fixation_Detector(Fixation_Detector):
         + duration (temporal) = what is the minimum time required for gaze data to be within dispersion threshold?
 
     '''
+    reads_image = False
+
+    @property
+    def writes_image(self):
+        return self.show_fixations
+
     def __init__(self,g_pool,max_dispersion = 1.0,min_duration = 0.15,h_fov=78, v_fov=50,show_fixations = False):
         super(Dispersion_Duration_Fixation_Detector, self).__init__(g_pool)
         self.min_duration = min_duration
@@ -206,7 +213,7 @@ class Dispersion_Duration_Fixation_Detector(Fixation_Detector):
 
         if not self.fixations:
             logger.warning('No fixations in this recording nothing to export')
-            return
+            return False
 
         fixations_in_section = chain(*self.g_pool.fixations_by_frame[slice(in_mark,out_mark)])
         fixations_in_section = dict([(f['id'],f) for f in fixations_in_section]).values() #remove dublicates
@@ -220,15 +227,17 @@ class Dispersion_Duration_Fixation_Detector(Fixation_Detector):
                 os.mkdir(metrics_dir)
             except:
                 logger.warning("Could not make metrics dir %s!"%metrics_dir)
-                return
+                return False
 
 
-        with open(os.path.join(metrics_dir,'fixations.csv'),'wb') as csvfile:
-            csv_writer = csv.writer(csvfile, delimiter='\t',quotechar='|', quoting=csv.QUOTE_MINIMAL)
-            csv_writer.writerow(('id','start_timestamp','duration','start_frame','end_frame','norm_pos_x','norm_pos_y','dispersion','avg_pupil_size','confidence'))
-            for f in fixations_in_section:
-                csv_writer.writerow( ( f['id'],f['timestamp'],f['duration'],f['start_frame_index'],f['end_frame_index'],f['norm_pos'][0],f['norm_pos'][1],f['dispersion'],f['pupil_diameter'],f['confidence'] ) )
-            logger.info("Created 'fixations.csv' file.")
+        csv_writer = Csv_Writer(os.path.join(metrics_dir,'fixations.csv'),('id','start_timestamp','duration','start_frame','end_frame','norm_pos_x','norm_pos_y','dispersion','avg_pupil_size','confidence'),delimiter='\t')
+        columns = [np.array([f[key] for f in fixations_in_section]) for key in ('id','timestamp','duration','start_frame_index','end_frame_index')]
+        norm_pos = np.array([f['norm_pos'] for f in fixations_in_section],dtype=np.float64).reshape(-1,2)
+        columns += [norm_pos[:,0],norm_pos[:,1]]
+        columns += [np.array([f[key] for f in fixations_in_section],dtype=np.float64) for key in ('dispersion','pupil_diameter','confidence')]
+        csv_writer.append(columns)
+        csv_writer.close()
+        logger.info("Created 'fixations.csv' file.")
 
         with open(os.path.join(metrics_dir,'fixation_report.csv'),'wb') as csvfile:
             csv_writer = csv.writer(csvfile, delimiter='\t',quotechar='|', quoting=csv.QUOTE_MINIMAL)
@@ -238,6 +247,7 @@ class Dispersion_Duration_Fixation_Detector(Fixation_Detector):
             csv_writer.writerow((''))
             csv_writer.writerow(('fixation_count',len(fixations_in_section)))
             logger.info("Created 'fixation_report.csv' file.")
+        return True
 
 
 
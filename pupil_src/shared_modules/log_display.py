@@ -33,6 +33,10 @@ def duration_from_level(lvl):
 
 class Log_Display(Plugin):
     """docstring for DisplayGaze"""
+    reads_image = False
+    writes_image = False
+    needs_events = False
+
     def __init__(self, g_pool):
         super(Log_Display, self).__init__(g_pool)
         self.rendered_log = []
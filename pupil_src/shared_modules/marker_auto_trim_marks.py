@@ -40,6 +40,10 @@ class Marker_Auto_Trim_Marks(Plugin):
 
     """
 
+    reads_image = False
+    writes_image = False
+    needs_events = False
+
     def __init__(self, g_pool,man_in_marks=[],man_out_marks=[]):
         super(Marker_Auto_Trim_Marks, self).__init__(g_pool)
         self.menu = None
@@ -0,0 +1,201 @@
+'''
+(*)~----------------------------------------------------------------------------------
+ Pupil - eye tracking platform
+ Copyright (C) 2012-2016  Pupil Labs
+
+ Distributed under the terms of the GNU Lesser General Public License (LGPL v3.0).
+ License details are in the file license.txt, distributed as part of this software.
+----------------------------------------------------------------------------------~(*)
+'''
+
+"""
+Columnar storage for the offline square marker cache.
+
+The cache of a recording lives in the directory `marker_cache`:
+    markers.npy     structured array, one row per detected marker (see marker_dtype)
+    visited.npy     int64, indices of the frames that have been searched
+
+A frame that is in visited.npy but has no rows in markers.npy was searched and has no markers.
+Both files are appended while the cacher runs. Rows are flushed before the frames that
+reference them, so a reader (or the next session after a crash) sees every visited frame complete.
+Readers sort the rows by frame, the rows of a frame are then
+markers[searchsorted(frames,idx,'left'):searchsorted(frames,idx,'right')].
+Rows of frames that are not in visited.npy are left overs of a crash and are dropped on the next open.
+
+Recordings with the legacy pickled `square_marker_cache` are converted on first load.
+"""
+
+import os
+import shutil
+from time import time
+import numpy as np
+from file_methods import Npy_Appender,load_object
+import logging
+logger = logging.getLogger(__name__)
+
+cache_dir_name = 'marker_cache'
+legacy_file_name = 'square_marker_cache'
+
+marker_dtype = np.dtype([('frame',np.int64),
+                         ('id',np.int32),
+                         ('verts',np.float32,(4,2)),
+                         ('verts_norm',np.float32,(4,2)),
+                         ('centroid',np.float32,(2,)),
+                         ('perimeter',np.float32),
+                         ('frames_since_true_detection',np.int32)])
+
+
+def markers_to_rows(frame_idx,markers):
+    '''
+    turn the marker dicts of one frame into rows
+    '''
+    rows = np.empty(len(markers),dtype=marker_dtype)
+    if not markers:
+        return rows
+    rows['frame'] = frame_idx
+    rows['id'] = [m['id'] for m in markers]
+    rows['verts'] = [np.reshape(m['verts'],(4,2)) for m in markers]
+    rows['verts_norm'] = [np.reshape(m['verts_norm'],(4,2)) for m in markers]
+    rows['centroid'] = [np.reshape(m['centroid'],(2,)) for m in markers]
+    rows['frames_since_true_detection'] = [m.get('frames_since_true_detection',0) for m in markers]
+    verts = rows['verts']
+    rows['perimeter'] = np.sqrt(((np.roll(verts,1,axis=1)-verts)**2).sum(axis=2)).sum(axis=1)
+    return rows
+
+
+def rows_to_markers(rows):
+    '''
+    turn rows back into the marker dicts the detector and the surfaces use
+    '''
+    ids = rows['id'].tolist()
+    perimeters = rows['perimeter'].tolist()
+    frames_since = rows['frames_since_true_detection'].tolist()
+    verts = np.array(rows['verts']).reshape(-1,4,1,2)
+    verts_norm = np.array(rows['verts_norm']).reshape(-1,4,1,2)
+    centroids = np.array(rows['centroid'])
+    return [{'id':ids[i],'verts':verts[i],'verts_norm':verts_norm[i],'centroid':centroids[i],
+             'perimeter':perimeters[i],'frames_since_true_detection':frames_since[i]} for i in xrange(len(rows))]
+
+
+def _load_array(path,dtype):
+    try:
+        return np.load(path,mmap_mode='r')
+    except ValueError:
+        #empty arrays can not be memory mapped
+        return np.load(path)
+    except IOError:
+        return np.zeros(0,dtype=dtype)
+
+def load_columns(rec_dir):
+    '''
+    returns (markers,visited) of the cache as written so far, memory mapped.
+    Rows of frames that are not visited yet are dropped.
+    '''
+    cache_dir = os.path.join(rec_dir,cache_dir_name)
+    markers = _load_array(os.path.join(cache_dir,'markers.npy'),marker_dtype)
+    visited = np.unique(_load_array(os.path.join(cache_dir,'visited.npy'),np.int64))
+    if len(markers):
+        complete = np.in1d(markers['frame'],visited)
+        if not complete.all():
+            markers = markers[complete]
+    return markers,visited
+
+
+def load_marker_cache(rec_dir,frame_count):
+    '''
+    returns a list with one entry per frame: False if the frame was not searched,
+    else the list of marker dicts found in it.
+    '''
+    if not os.path.isdir(os.path.join(rec_dir,cache_dir_name)):
+        return _convert_legacy(rec_dir,frame_count)
+    markers,visited = load_columns(rec_dir)
+    order = np.argsort(markers['frame'],kind='mergesort')
+    frames = markers['frame'][order]
+    visited = visited[(visited >= 0) & (visited < frame_count)]
+    starts = np.searchsorted(frames,visited,side='left').tolist()
+    stops = np.searchsorted(frames,visited,side='right').tolist()
+    all_markers = rows_to_markers(markers[order]) if len(markers) else []
+    cache = [False]*frame_count
+    for frame_idx,start,stop in zip(visited.tolist(),starts,stops):
+        cache[frame_idx] = all_markers[start:stop]
+    return cache
+
+
+def _convert_legacy(rec_dir,frame_count):
+    legacy_path = os.path.join(rec_dir,legacy_file_name)
+    cache = [False]*frame_count
+    try:
+        legacy = load_object(legacy_path).get('marker_cache',[])
+    except (IOError,EOFError,KeyError,AttributeError):
+        return cache
+    logger.info("Converting the marker cache to columnar format. This only happens once.")
+    cache[:len(legacy)] = legacy[:frame_count]
+    save_marker_cache(cache,rec_dir)
+    return cache
+
+
+def save_marker_cache(cache,rec_dir):
+    '''
+    write a whole cache list
+    '''
+    visited = [i for i,markers in enumerate(cache) if markers is not False]
+    blocks = [markers_to_rows(i,cache[i]) for i in visited if cache[i]]
+    markers = np.concatenate(blocks) if blocks else np.zeros(0,dtype=marker_dtype)
+    _save_columns(markers,np.array(visited,dtype=np.int64),rec_dir)
+
+def _save_columns(markers,visited,rec_dir):
+    '''
+    We write into a tmp dir and rename so readers never see half a cache.
+    The files are written by Npy_Appender so Marker_Cache_Writer can continue them.
+    '''
+    cache_dir = os.path.join(rec_dir,cache_dir_name)
+    tmp_dir = cache_dir+'.tmp'
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.mkdir(tmp_dir)
+    for name,data,dtype in (('markers',markers,marker_dtype),('visited',visited,np.int64)):
+        writer = Npy_Appender(os.path.join(tmp_dir,name+'.npy'),dtype)
+        writer.append(data)
+        writer.close()
+    if os.path.isdir(cache_dir):
+        shutil.rmtree(cache_dir)
+    os.rename(tmp_dir,cache_dir)
+
+
+class Marker_Cache_Writer(object):
+    """
+    appends newly cached frames to the marker cache of a recording.
+    Appended rows are flushed at most every flush_interval seconds and on close.
+    """
+    def __init__(self,rec_dir,flush_interval=1.):
+        self.flush_interval = flush_interval
+        cache_dir = os.path.join(rec_dir,cache_dir_name)
+        markers,visited = load_columns(rec_dir)
+        written = len(_load_array(os.path.join(cache_dir,'markers.npy'),marker_dtype))
+        if not os.path.isdir(cache_dir) or len(markers) != written:
+            #rows of frames that never made it into visited.npy (after a crash). Drop them
+            #or they would be doubled when the frame is searched again.
+            order = np.argsort(markers['frame'],kind='mergesort')
+            _save_columns(np.array(markers[order]),np.array(visited),rec_dir)
+        #release the memory maps before the appenders truncate the files
+        del markers,visited
+        self.markers_writer = Npy_Appender(os.path.join(cache_dir,'markers.npy'),marker_dtype,append=True)
+        self.visited_writer = Npy_Appender(os.path.join(cache_dir,'visited.npy'),np.int64,append=True)
+        self.last_flush = time()
+
+    def append(self,frame_idx,markers):
+        if markers:
+            self.markers_writer.append(markers_to_rows(frame_idx,markers))
+        self.visited_writer.append([frame_idx])
+        if time()-self.last_flush > self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        #rows first so readers never see a visited frame without its markers
+        self.markers_writer.flush()
+        self.visited_writer.flush()
+        self.last_flush = time()
+
+    def close(self):
+        self.markers_writer.close()
+        self.visited_writer.close()
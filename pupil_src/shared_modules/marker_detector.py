@@ -21,7 +21,7 @@ from plugin import Plugin
 import logging
 logger = logging.getLogger(__name__)
 
-from square_marker_detect import detect_markers_robust,detect_markers, draw_markers,m_marker_to_screen
+from square_marker_detect import Marker_Tracker,detect_markers, draw_markers,m_marker_to_screen
 from reference_surface import Reference_Surface
 from math import sqrt
 
@@ -68,6 +68,7 @@ class Marker_Detector(Plugin):
 
 
         self.robust_detection = 1
+        self.tracker = Marker_Tracker(grid_size=5,true_detect_every_frame=3,roi_detection=True)
         self.aperture = 11
         self.min_marker_perimeter = min_marker_perimeter
         self.locate_3d = False
@@ -146,6 +147,7 @@ class Marker_Detector(Plugin):
         self.menu.append(ui.Button('Close',self.close))
         self.menu.append(ui.Info_Text('This plugin detects and tracks fiducial markers visible in the scene. You can define surfaces using 1 or more marker visible within the world view by clicking *add surface*. You can edit defined surfaces by selecting *Surface edit mode*.'))
         self.menu.append(ui.Switch('robust_detection',self,label='Robust detection'))
+        self.menu.append(ui.Switch('roi_detection',self.tracker,label='Search near known markers'))
         self.menu.append(ui.Slider('min_marker_perimeter',self,step=1,min=10,max=80))
         self.menu.append(ui.Switch('locate_3d',self,label='3D localization'))
         self.menu.append(ui.Selector('mode',self,label="Mode",selection=['Show markers and frames','Show marker IDs', 'Surface edit mode'] ))
@@ -179,14 +181,12 @@ class Marker_Detector(Plugin):
             gray = frame.gray
 
             if self.robust_detection:
-                self.markers = detect_markers_robust(gray,
-                                                    grid_size = 5,
-                                                    prev_markers=self.markers,
-                                                    min_marker_perimeter=self.min_marker_perimeter,
-                                                    aperture=self.aperture,
-                                                    visualize=0,
-                                                    true_detect_every_frame=3)
+                self.markers = self.tracker.track(gray,
+                                                  min_marker_perimeter=self.min_marker_perimeter,
+                                                  aperture=self.aperture,
+                                                  visualize=0)
             else:
+                self.tracker.reset()
                 self.markers = detect_markers(gray,
                                                 grid_size = 5,
                                                 min_marker_perimeter=self.min_marker_perimeter,
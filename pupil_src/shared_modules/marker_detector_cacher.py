@@ -11,10 +11,25 @@
 
 
 
-def fill_cache(visited_list,video_file_path,timestamps,q,seek_idx,run,min_marker_perimeter):
+def split_unvisited(visited_list,count):
+    '''
+    split the frame indices into up to count contiguous ranges [start,stop)
+    with about the same number of unvisited frames each. Returns [] if all frames are visited.
+    '''
+    unvisited = [i for i,visited in enumerate(visited_list) if not visited]
+    if not unvisited:
+        return []
+    count = max(1,min(count,len(unvisited)))
+    bounds = [0]+[unvisited[len(unvisited)*i//count] for i in range(1,count)]+[len(visited_list)]
+    return [(start,stop) for start,stop in zip(bounds[:-1],bounds[1:]) if stop > start]
+
+
+def fill_cache(visited_list,video_file_path,timestamps,q,seek_idx,run,min_marker_perimeter,frame_range=None):
     '''
     this function is part of marker_detector it is run as a seperate process.
     it must be kept in a seperate file for namespace sanatisation
+    frame_range: (start,stop) the frames this process is responsible for. Several processes can
+    fill one cache when each gets its own range. Seeks outside of the range are ignored.
     '''
     import os
     import logging
@@ -22,12 +37,15 @@ def fill_cache(visited_list,video_file_path,timestamps,q,seek_idx,run,min_marker
     logger.debug('Started cacher process for Marker Detector')
     import cv2
     from video_capture import File_Capture, EndofVideoFileError,FileSeekError
-    from square_marker_detect import detect_markers_robust
+    from square_marker_detect import Marker_Tracker
     aperture = 9
-    markers = []
+    tracker = Marker_Tracker(grid_size=5,true_detect_every_frame=1)
     cap = File_Capture(video_file_path,timestamps=timestamps)
+    range_start,range_stop = frame_range or (0,len(visited_list))
 
     def next_unvisited_idx(frame_idx):
+        if not range_start <= frame_idx < range_stop:
+            frame_idx = range_start
         try:
             visited = visited_list[frame_idx]
         except IndexError:
@@ -38,14 +56,14 @@ def fill_cache(visited_list,video_file_path,timestamps,q,seek_idx,run,min_marker
         else:
             # find next unvisited site in the future
             try:
-                next_unvisited = visited_list.index(False,frame_idx)
+                next_unvisited = visited_list.index(False,frame_idx,range_stop)
             except ValueError:
                 # any thing in the past?
                 try:
-                    next_unvisited = visited_list.index(False,0,frame_idx)
+                    next_unvisited = visited_list.index(False,range_start,frame_idx)
                 except ValueError:
                     #no unvisited sites left. Done!
-                    logger.debug("Caching completed.")
+                    logger.debug("Caching of frames %s to %s completed."%(range_start,range_stop))
                     next_unvisited = None
         return next_unvisited
 
@@ -62,7 +80,7 @@ def fill_cache(visited_list,video_file_path,timestamps,q,seek_idx,run,min_marker
                 q.put((next,[])) # we cannot look at the frame, report no detection
                 return
             #seeking invalidates prev markers for the detector
-            markers[:] = []
+            tracker.reset()
 
         try:
             frame = cap.get_frame_nowait()
@@ -74,16 +92,13 @@ def fill_cache(visited_list,video_file_path,timestamps,q,seek_idx,run,min_marker
             q.put((next,[])) # we cannot look at the frame, report no detection
             return
 
-        markers[:] = detect_markers_robust(frame.gray,
-                                        grid_size = 5,
-                                        prev_markers=markers,
-                                        min_marker_perimeter=min_marker_perimeter,
-                                        aperture=aperture,
-                                        visualize=0,
-                                        true_detect_every_frame=1)
+        markers = tracker.track(frame.gray,
+                                min_marker_perimeter=min_marker_perimeter,
+                                aperture=aperture,
+                                visualize=0)
 
         visited_list[frame.index] = True
-        q.put((frame.index,markers[:])) #object passed will only be pickeled when collected from other process! need to make a copy ot avoid overwrite!!!
+        q.put((frame.index,markers)) #the tracker never modifies markers it returned, no copy needed.
 
     while run.value:
         next = cap.get_frame_index()
@@ -15,20 +15,21 @@ import csv
 
 
 if platform.system() == 'Darwin':
-    from billiard import Process,Queue,forking_enable
+    from billiard import Process,Queue,forking_enable,cpu_count
     from billiard.sharedctypes import Value
 else:
-    from multiprocessing import Process, Queue
+    from multiprocessing import Process, Queue, cpu_count
     forking_enable = lambda x: x #dummy fn
     from multiprocessing.sharedctypes import Value
 from ctypes import c_bool
+from collections import OrderedDict
 
 
-from itertools import chain
 from OpenGL.GL import *
 from methods import normalize,denormalize
-from file_methods import Persistent_Dict,save_object
+from file_methods import Persistent_Dict,save_object,Csv_Writer
 from cache_list import Cache_List
+from marker_cache import load_marker_cache,Marker_Cache_Writer
 from glfw import *
 from pyglui import ui
 from pyglui.cygl.utils import *
@@ -39,7 +40,7 @@ import logging
 logger = logging.getLogger(__name__)
 
 from marker_detector import Marker_Detector
-from square_marker_detect import detect_markers_robust, draw_markers,m_marker_to_screen
+from square_marker_detect import draw_markers,m_marker_to_screen
 from offline_reference_surface import Offline_Reference_Surface
 from math import sqrt
 
@@ -54,6 +55,13 @@ class Offline_Marker_Detector(Marker_Detector):
     See marker_tracker.py for more info on this marker tracker.
     """
 
+    reads_image = True
+    needs_events = False
+
+    @property
+    def writes_image(self):
+        return self.mode == "Show marker IDs"
+
     def __init__(self,g_pool,mode="Show Markers and Frames"):
         super(Offline_Marker_Detector, self).__init__(g_pool)
         self.order = .2
@@ -78,8 +86,8 @@ class Offline_Marker_Detector(Marker_Detector):
 
 
         #check if marker cache is available from last session
-        self.persistent_cache = Persistent_Dict(os.path.join(g_pool.rec_dir,'square_marker_cache'))
-        self.cache = Cache_List(self.persistent_cache.get('marker_cache',[False for _ in g_pool.timestamps]))
+        self.cache = Cache_List(load_marker_cache(g_pool.rec_dir,len(g_pool.timestamps)))
+        self.cache_writer = Marker_Cache_Writer(g_pool.rec_dir)
         logger.debug("Loaded marker cache %s / %s frames had been searched before"%(len(self.cache)-self.cache.count(False),len(self.cache)) )
         self.init_marker_cacher()
 
@@ -87,7 +95,6 @@ class Offline_Marker_Detector(Marker_Detector):
         self.show_surface_idx = c_int(0)
 
         self.img_shape = None
-        self.img = None
 
     def load_surface_definitions_from_file(self):
         self.surface_definitions = Persistent_Dict(os.path.join(self.g_pool.rec_dir,'surface_definitions'))
@@ -138,6 +145,10 @@ class Offline_Marker_Detector(Marker_Detector):
             s_menu.append(ui.Text_Input('name',s))
             s_menu.append(ui.Text_Input('x',s.real_world_size,label='X size'))
             s_menu.append(ui.Text_Input('y',s.real_world_size,label='Y size'))
+            #closure to encapsulate the surface
+            def make_set_detail(s):
+                return lambda detail: self.set_heatmap_detail(s,detail)
+            s_menu.append(ui.Slider('heatmap_detail',s,min=.01,step=.01,max=1,label='Heatmap smoothing',setter=make_set_detail(s)))
             s_menu.append(ui.Button('Open Debug Window',s.open_close_window))
             #closure to encapsulate idx
             def make_remove_s(i):
@@ -162,6 +173,12 @@ class Offline_Marker_Detector(Marker_Detector):
 
 
 
+    def set_heatmap_detail(self,s,detail):
+        s.heatmap_detail = detail
+        if s.heatmap is not None:
+            #the gaze histograms are kept in the accumulator, this only redoes the section lookup and the blur
+            s.generate_heatmap(slice(self.g_pool.trim_marks.in_mark,self.g_pool.trim_marks.out_mark))
+
     def recalculate(self):
 
         in_mark = self.g_pool.trim_marks.in_mark
@@ -177,8 +194,8 @@ class Offline_Marker_Detector(Marker_Detector):
         results = []
         for s in self.surfaces:
             gaze_on_srf  = s.gaze_on_srf_in_section(section)
-            results.append(len(gaze_on_srf))
-            self.metrics_gazecount = len(gaze_on_srf)
+            results.append(len(gaze_on_srf['gaze_index']))
+            self.metrics_gazecount = len(gaze_on_srf['gaze_index'])
 
         if results == []:
             logger.warning("No surfaces defined.")
@@ -195,13 +212,12 @@ class Offline_Marker_Detector(Marker_Detector):
         for s,c_map in zip(self.surfaces,results_c_maps):
             heatmap = np.ones((1,1,4),dtype=np.uint8)*125
             heatmap[:,:,:3] = c_map
-            s.metrics_texture = Named_Texture()
-            s.metrics_texture.update_from_ndarray(heatmap)
+            s.metrics_heatmap = heatmap
+            s.metrics_texture = None
 
 
     def update(self,frame,events):
-        self.img = frame.img
-        self.img_shape = frame.img.shape
+        self.img_shape = frame.height,frame.width,3
         self.update_marker_cache()
         self.markers = self.cache[frame.index]
         if self.markers == False:
@@ -229,13 +245,20 @@ class Offline_Marker_Detector(Marker_Detector):
                 if s.detected:
                     new_pos =  s.img_to_ref_surface(np.array(pos))
                     s.move_vertex(v_idx,new_pos)
-                    s.cache = None
+                    s.invalidate_cache()
                     self.heatmap = None
-        else:
-            # update srf with no or invald cache:
-            for s in self.surfaces:
-                if s.cache == None:
-                    s.init_cache(self.cache)
+
+        # rebuild caches of surfaces that have not been edited for a moment:
+        # this frame first, then the trim section, then the rest.
+        outdated = [s for s in self.surfaces if s.needs_cache_rebuild]
+        if outdated:
+            #the surface cachers read the marker cache from disk
+            self.cache_writer.flush()
+            section = (self.g_pool.trim_marks.in_mark,self.g_pool.trim_marks.out_mark+1)
+            for s in outdated:
+                s.init_cache(self.cache,frame.index,section)
+        for s in self.surfaces:
+            s.collect_cache(self.cache)
 
 
         #allow surfaces to open/close windows
@@ -246,32 +269,53 @@ class Offline_Marker_Detector(Marker_Detector):
                 s.open_window()
 
 
-    def init_marker_cacher(self):
+    def init_marker_cacher(self,process_count=None):
+        """
+        start cacher processes, each fills a contiguous range of the cache with its own File_Capture.
+        By default we leave one core for the Player.
+        """
         forking_enable(0) #for MacOs only
-        from marker_detector_cacher import fill_cache
+        from marker_detector_cacher import fill_cache,split_unvisited
         visited_list = [False if x == False else True for x in self.cache]
         video_file_path =  self.g_pool.capture.src
         timestamps = self.g_pool.capture.timestamps
         self.cache_queue = Queue()
-        self.cacher_seek_idx = Value('i',0)
         self.cacher_run = Value(c_bool,True)
-        self.cacher = Process(target=fill_cache, args=(visited_list,video_file_path,timestamps,self.cache_queue,self.cacher_seek_idx,self.cacher_run,self.min_marker_perimeter))
-        self.cacher.start()
+        self.cacher_ranges = split_unvisited(visited_list,process_count or max(1,cpu_count()-1))
+        self.cacher_seek_idx = []
+        self.cachers = []
+        for frame_range in self.cacher_ranges:
+            seek_idx = Value('i',-1)
+            cacher = Process(target=fill_cache, args=(visited_list,video_file_path,timestamps,self.cache_queue,seek_idx,self.cacher_run,self.min_marker_perimeter,frame_range))
+            cacher.start()
+            self.cacher_seek_idx.append(seek_idx)
+            self.cachers.append(cacher)
+        logger.debug("Started %s marker cacher processes for frame ranges %s"%(len(self.cachers),self.cacher_ranges))
 
     def update_marker_cache(self):
         while not self.cache_queue.empty():
             idx,c_m = self.cache_queue.get()
+            if self.cache[idx] is False:
+                self.cache_writer.append(idx,c_m)
             self.cache.update(idx,c_m)
             for s in self.surfaces:
                 s.update_cache(self.cache,idx=idx)
 
     def seek_marker_cacher(self,idx):
-        self.cacher_seek_idx.value = idx
+        # only the process that owns idx jumps there, the others keep going.
+        for (start,stop),seek_idx in zip(self.cacher_ranges,self.cacher_seek_idx):
+            if start <= idx < stop:
+                seek_idx.value = idx
+
+    @property
+    def cacher_running(self):
+        return any(c.is_alive() for c in self.cachers)
 
     def close_marker_cacher(self):
         self.update_marker_cache()
         self.cacher_run.value = False
-        self.cacher.join()
+        for cacher in self.cachers:
+            cacher.join()
 
     def gl_display(self):
         """
@@ -316,13 +360,18 @@ class Offline_Marker_Detector(Marker_Detector):
             cached_ranges += (r[0],0),(r[1],0) #[(0,0),(1,0),(3,0),(4,0)]
 
         # Lines where surfaces have been found in video
+        # and while a surface cache is rebuilt, the frames that are done
         cached_surfaces = []
         for s in self.surfaces:
             found_at = []
+            searched = []
             if s.cache is not None:
                 for r in s.cache.positive_ranges: # [[0,1],[3,4]]
                     found_at += (r[0],0),(r[1],0) #[(0,0),(1,0),(3,0),(4,0)]
-                cached_surfaces.append(found_at)
+                if s.cache_building:
+                    for r in s.cache.visited_ranges:
+                        searched += (r[0],0),(r[1],0)
+                cached_surfaces.append((found_at,searched))
 
         glMatrixMode(GL_PROJECTION)
         glPushMatrix()
@@ -342,9 +391,13 @@ class Offline_Marker_Detector(Marker_Detector):
 
         color = RGBA(0,.7,.3,.8)
 
-        for s in cached_surfaces:
+        searched_color = RGBA(.5,.5,.5,.5)
+
+        for found_at,searched in cached_surfaces:
             glTranslatef(0,.02,0)
-            draw_polyline(s,color=color,line_type=GL_LINES,thickness=2)
+            if searched:
+                draw_polyline(searched,color=searched_color,line_type=GL_LINES,thickness=1)
+            draw_polyline(found_at,color=color,line_type=GL_LINES,thickness=2)
 
         glMatrixMode(GL_PROJECTION)
         glPopMatrix()
@@ -392,51 +445,89 @@ class Offline_Marker_Detector(Marker_Detector):
                 os.mkdir(metrics_dir)
             except:
                 logger.warning("Could not make metrics dir %s"%metrics_dir)
-                return
+                return False
+
+
+        for s in self.surfaces:
+            if s.cache == None or s.cache_building:
+                logger.warning("The surface is not cached. Please wait for the cacher to collect data.")
+                return False
+
+        # the reports cover [in_mark,out_mark), the per surface files [in_mark,out_mark]
+        timestamps = self.g_pool.timestamps
+        export_section = slice(in_mark,min(out_mark+1,len(timestamps)))
+        csv_args = {'delimiter':'\t','quotechar':'|','quoting':csv.QUOTE_MINIMAL}
+
+        # one pass over the section for all surfaces: positions, fixations and visibility
+        surface_names = ['_'+s.name.replace('/','')+'_'+s.uid for s in self.surfaces]
+        position_files = [open(os.path.join(metrics_dir,'srf_positons'+name+'.csv'),'wb') for name in surface_names]
+        position_writers = [csv.writer(f,**csv_args) for f in position_files]
+        for csv_writer in position_writers:
+            csv_writer.writerow(('frame_idx','timestamp','m_to_screen','m_from_screen','detected_markers'))
+        position_rows = [[] for s in self.surfaces]
+        fixations_on_surfaces = [OrderedDict() for s in self.surfaces]
+        visible_counts = [0 for s in self.surfaces]
+        for idx in xrange(export_section.start,export_section.stop):
+            ts = timestamps[idx]
+            for i,(s,rows,fixations_on_surface) in enumerate(zip(self.surfaces,position_rows,fixations_on_surfaces)):
+                ref_srf_data = s.cache[idx]
+                if ref_srf_data is None or ref_srf_data is False:
+                    continue
+                if idx < out_mark:
+                    visible_counts[i] += 1
+                rows.append((idx,ts,ref_srf_data['m_to_screen'],ref_srf_data['m_from_screen'],ref_srf_data['detected_markers']))
+                for f in s.fixations_on_srf_by_frame_idx(idx,ref_srf_data['m_from_screen']):
+                    fixations_on_surface[f['base']['id']] = f
+            if not idx%1000:
+                for csv_writer,rows in zip(position_writers,position_rows):
+                    csv_writer.writerows(rows)
+                    del rows[:]
+        for csv_writer,rows,f in zip(position_writers,position_rows,position_files):
+            csv_writer.writerows(rows)
+            f.close()
 
 
         with open(os.path.join(metrics_dir,'surface_visibility.csv'),'wb') as csvfile:
-            csv_writer = csv.writer(csvfile, delimiter='\t',quotechar='|', quoting=csv.QUOTE_MINIMAL)
+            csv_writer = csv.writer(csvfile,**csv_args)
 
             # surface visibility report
-            frame_count = len(self.g_pool.timestamps[section])
+            frame_count = len(timestamps[section])
 
             csv_writer.writerow(('frame_count',frame_count))
             csv_writer.writerow((''))
             csv_writer.writerow(('surface_name','visible_frame_count'))
-            for s in self.surfaces:
-                if s.cache == None:
-                    logger.warning("The surface is not cached. Please wait for the cacher to collect data.")
-                    return
-                visible_count  = s.visible_count_in_section(section)
+            for s,visible_count in zip(self.surfaces,visible_counts):
                 csv_writer.writerow( (s.name, visible_count) )
             logger.info("Created 'surface_visibility.csv' file")
 
 
+        # gaze of the section mapped onto every surface in one batch each
+        mappings = [s.gaze_mapping_in_section(export_section) for s in self.surfaces]
+
         with open(os.path.join(metrics_dir,'surface_gaze_distribution.csv'),'wb') as csvfile:
-            csv_writer = csv.writer(csvfile, delimiter='\t',quotechar='|', quoting=csv.QUOTE_MINIMAL)
+            csv_writer = csv.writer(csvfile,**csv_args)
 
             # gaze distribution report
-            gaze_in_section = list(chain(*self.g_pool.gaze_positions_by_frame[section]))
-            not_on_any_srf = set([gp['timestamp'] for gp in gaze_in_section])
+            offsets = self.g_pool.gaze_positions_by_frame.offsets
+            first_gaze,last_gaze = offsets[in_mark],offsets[min(out_mark,len(offsets)-1)]
+            on_any_srf = np.zeros(max(0,last_gaze-first_gaze),dtype=bool)
 
-            csv_writer.writerow(('total_gaze_point_count',len(gaze_in_section)))
+            csv_writer.writerow(('total_gaze_point_count',len(on_any_srf)))
             csv_writer.writerow((''))
             csv_writer.writerow(('surface_name','gaze_count'))
 
-            for s in self.surfaces:
-                gaze_on_srf  = s.gaze_on_srf_in_section(section)
-                gaze_on_srf = set([gp['base']['timestamp'] for gp in gaze_on_srf])
-                not_on_any_srf -= gaze_on_srf
+            for s,mapping in zip(self.surfaces,mappings):
+                gaze_on_srf = mapping['gaze_index'][mapping['on_srf'] & (mapping['frame'] < out_mark)]
+                on_any_srf[gaze_on_srf-first_gaze] = True
                 csv_writer.writerow( (s.name, len(gaze_on_srf)) )
 
-            csv_writer.writerow(('not_on_any_surface', len(not_on_any_srf) ) )
+            csv_writer.writerow(('not_on_any_surface', int((~on_any_srf).sum()) ) )
             logger.info("Created 'surface_gaze_distribution.csv' file")
 
 
 
         with open(os.path.join(metrics_dir,'surface_events.csv'),'wb') as csvfile:
-            csv_writer = csv.writer(csvfile, delimiter='\t',quotechar='|', quoting=csv.QUOTE_MINIMAL)
+            csv_writer = csv.writer(csvfile,**csv_args)
 
             # surface events report
             csv_writer.writerow(('frame_number','timestamp','surface_name','surface_uid','event_type'))
@@ -449,52 +540,35 @@ class Offline_Marker_Detector(Marker_Detector):
 
             events.sort(key=lambda x: x['frame_id'])
             for e in events:
-                csv_writer.writerow( ( e['frame_id'],self.g_pool.timestamps[e['frame_id']],e['srf_name'],e['srf_uid'],e['event'] ) )
+                csv_writer.writerow( ( e['frame_id'],timestamps[e['frame_id']],e['srf_name'],e['srf_uid'],e['event'] ) )
             logger.info("Created 'surface_events.csv' file")
 
 
-        for s in self.surfaces:
-            # per surface names:
-            surface_name = '_'+s.name.replace('/','')+'_'+s.uid
-
+        gaze_ts = self.g_pool.gaze_positions_by_frame.column('timestamp',export_section)
+        first_gaze = self.g_pool.gaze_positions_by_frame.offsets[export_section.start]
+        np_timestamps = np.asarray(timestamps)
+        for s,surface_name,mapping,fixations_on_surface in zip(self.surfaces,surface_names,mappings,fixations_on_surfaces):
 
-            # save surface_positions as pickle file
+            # save surface_positions as pickle file. Like before, it covers the whole recording, entry i belongs to frame i.
             save_object(s.cache.to_list(),os.path.join(metrics_dir,'srf_positions'+surface_name))
 
-            #save surface_positions as csv
-            with open(os.path.join(metrics_dir,'srf_positons'+surface_name+'.csv'),'wb') as csvfile:
-                csv_writer =csv.writer(csvfile, delimiter='\t',quotechar='|', quoting=csv.QUOTE_MINIMAL)
-                csv_writer.writerow(('frame_idx','timestamp','m_to_screen','m_from_screen','detected_markers'))
-                for idx,ts,ref_srf_data in zip(range(len(self.g_pool.timestamps)),self.g_pool.timestamps,s.cache):
-                    if in_mark <= idx <= out_mark:
-                        if ref_srf_data is not None and ref_srf_data is not False:
-                            csv_writer.writerow( (idx,ts,ref_srf_data['m_to_screen'],ref_srf_data['m_from_screen'],ref_srf_data['detected_markers']) )
-
-
             # save gaze on srf as csv.
-            with open(os.path.join(metrics_dir,'gaze_positions_on_surface'+surface_name+'.csv'),'wb') as csvfile:
-                csv_writer = csv.writer(csvfile, delimiter='\t',quotechar='|', quoting=csv.QUOTE_MINIMAL)
-                csv_writer.writerow(('world_timestamp','world_frame_idx','gaze_timestamp','x_norm','y_norm','x_scaled','y_scaled','on_srf'))
-                for idx,ts,ref_srf_data in zip(range(len(self.g_pool.timestamps)),self.g_pool.timestamps,s.cache):
-                    if in_mark <= idx <= out_mark:
-                        if ref_srf_data is not None and ref_srf_data is not False:
-                            for gp in s.gaze_on_srf_by_frame_idx(idx,ref_srf_data['m_from_screen']):
-                                csv_writer.writerow( (ts,idx,gp['base']['timestamp'],gp['norm_pos'][0],gp['norm_pos'][1],gp['norm_pos'][0]*s.real_world_size['x'],gp['norm_pos'][1]*s.real_world_size['y'],gp['on_srf']) )
+            csv_writer = Csv_Writer(os.path.join(metrics_dir,'gaze_positions_on_surface'+surface_name+'.csv'),
+                                    ('world_timestamp','world_frame_idx','gaze_timestamp','x_norm','y_norm','x_scaled','y_scaled','on_srf'),delimiter='\t')
+            block_size = 10000
+            for start in xrange(0,len(mapping['frame']),block_size):
+                block = slice(start,start+block_size)
+                frames,mapped = mapping['frame'][block],mapping['norm_pos'][block]
+                csv_writer.append((np_timestamps[frames],frames,gaze_ts[mapping['gaze_index'][block]-first_gaze],mapped[:,0],mapped[:,1],
+                                   mapped[:,0]*s.real_world_size['x'],mapped[:,1]*s.real_world_size['y'],mapping['on_srf'][block]))
+            csv_writer.close()
 
 
             # save fixation on srf as csv.
             with open(os.path.join(metrics_dir,'fixations_on_surface'+surface_name+'.csv'),'wb') as csvfile:
-                csv_writer = csv.writer(csvfile, delimiter='\t',quotechar='|', quoting=csv.QUOTE_MINIMAL)
+                csv_writer = csv.writer(csvfile,**csv_args)
                 csv_writer.writerow(('id','start_timestamp','duration','start_frame','end_frame','norm_pos_x','norm_pos_y','x_scaled','y_scaled','on_srf'))
-                fixations_on_surface = []
-                for idx,ref_srf_data in zip(range(len(self.g_pool.timestamps)),s.cache):
-                    if in_mark <= idx <= out_mark:
-                        if ref_srf_data is not None and ref_srf_data is not False:
-                            for f in s.fixations_on_srf_by_frame_idx(idx,ref_srf_data['m_from_screen']):
-                                fixations_on_surface.append(f)
-
-                removed_dublicates = dict([(f['base']['id'],f) for f in fixations_on_surface]).values()
-                for f_on_s in removed_dublicates:
+                for f_on_s in fixations_on_surface.values():
                     f = f_on_s['base']
                     f_x,f_y = f_on_s['norm_pos']
                     f_on_srf = f_on_s['on_srf']
@@ -509,6 +583,7 @@ class Offline_Marker_Detector(Marker_Detector):
 
 
         logger.info("Done exporting reference surface data.")
+        return True
         # if s.detected and self.img is not None:
         #     #let save out the current surface image found in video
 
@@ -545,10 +620,9 @@ class Offline_Marker_Detector(Marker_Detector):
         self.surface_definitions.close()
 
         self.close_marker_cacher()
-        self.persistent_cache["marker_cache"] = self.cache.to_list()
-        self.persistent_cache.close()
+        self.cache_writer.close()
 
         for s in self.surfaces:
-            s.close_window()
+            s.cleanup()
         self.deinit_gui()
 
@@ -8,14 +8,23 @@
 ----------------------------------------------------------------------------------~(*)
 '''
 
+import platform
 import numpy as np
 import cv2
+if platform.system() == 'Darwin':
+    from billiard import Process,Queue,forking_enable
+    from billiard.sharedctypes import Value
+else:
+    from multiprocessing import Process, Queue
+    forking_enable = lambda x: x #dummy fn
+    from multiprocessing.sharedctypes import Value
 from gl_utils import cvmat_to_glmat,clear_gl_screen
 from glfw import *
 from OpenGL.GL import *
 from pyglui.cygl.utils import Named_Texture, draw_points_norm, RGBA
 from methods import GetAnglesPolyline,normalize
 from cache_list import Cache_List
+from surface_cacher import fill_surface_cache,surface_entries
 
 #ctypes import for atb_vars:
 from ctypes import c_int,c_bool,create_string_buffer
@@ -28,16 +37,25 @@ from reference_surface import Reference_Surface
 
 class Offline_Reference_Surface(Reference_Surface):
     """docstring for Offline_Reference_Surface"""
+    # seconds without edits before the cache is rebuilt
+    rebuild_delay = .5
+
     def __init__(self,g_pool,name="unnamed",saved_definition=None):
         super(Offline_Reference_Surface, self).__init__(name,saved_definition)
         self.g_pool = g_pool
         self.cache = None
+        self.cacher = None
+        self.edited_at = 0.
+        self._gaze_mapping = None
+        self._gaze_mapping_key = None
+        self._heatmap_accumulator = None
         self.gaze_on_srf = [] # points on surface for realtime feedback display
 
         self.heatmap_detail = .2
         self.heatmap = None
         self.heatmap_texture = None
         self.metrics_gazecount = None
+        self.metrics_heatmap = None
         self.metrics_texture = None
 
     #cache fn for offline marker
@@ -95,10 +113,74 @@ class Offline_Reference_Surface(Reference_Surface):
 
 
 
-    def init_cache(self,marker_cache):
+    def init_cache(self,marker_cache,frame_idx=None,section=None):
+        """
+        start a full build of the cache. A cacher process locates the surface in the marker cache
+        on disk and streams its results, see collect_cache.
+        frame_idx: frame that is located right away (the one on screen)
+        section: (start,stop) frames the cacher does before all others
+        """
         if self.defined:
             logger.debug("Full update of surface '%s' positons cache"%self.name)
-            self.cache = Cache_List([self.answer_caching_request(marker_cache,i) for i in xrange(len(marker_cache))],positive_eval_fn=lambda x:  (x!=False) and (x!=None))
+            self.close_cacher()
+            self.cache = Cache_List([False]*len(marker_cache),positive_eval_fn=lambda x:  (x!=False) and (x!=None))
+            self._gaze_mapping = None
+            if frame_idx is not None and 0 <= frame_idx < len(marker_cache):
+                self.cache.update(frame_idx,self.answer_caching_request(marker_cache,frame_idx))
+            uv_by_id = dict([(m_id,m.uv_coords) for m_id,m in self.markers.iteritems()])
+            forking_enable(0) #for MacOs only
+            self.cache_queue = Queue()
+            self.cacher_run = Value(c_bool,True)
+            self.cacher = Process(target=fill_surface_cache, args=(self.g_pool.rec_dir,len(marker_cache),uv_by_id,self.cache_queue,self.cacher_run,section))
+            self.cacher.start()
+
+    def invalidate_cache(self):
+        """
+        the surface definition changed. The cache is rebuilt once the surface was left alone for rebuild_delay seconds.
+        """
+        self.close_cacher()
+        self.cache = None
+        self._gaze_mapping = None
+        self.edited_at = time()
+
+    @property
+    def needs_cache_rebuild(self):
+        return self.cache is None and self.defined and time()-self.edited_at > self.rebuild_delay
+
+    def collect_cache(self,marker_cache):
+        """
+        move results of the cacher process into the cache.
+        Frames that got an entry from update_cache in the meantime are kept.
+        """
+        if self.cacher is None:
+            return
+        while not self.cache_queue.empty():
+            result = self.cache_queue.get()
+            if result is None:
+                self.cacher.join()
+                self.cacher = None
+                #frames the marker cache got after the cacher read it
+                self.update_cache(marker_cache)
+                return
+            start,entries = result
+            for idx,entry in enumerate(entries,start):
+                if entry is not False and self.cache[idx] is False:
+                    self.cache.update(idx,entry)
+
+    @property
+    def cache_building(self):
+        return self.cacher is not None
+
+    def close_cacher(self):
+        if self.cacher is None:
+            return
+        self.cacher_run.value = False
+        while self.cacher.is_alive():
+            #a process can only exit once its queue is drained
+            while not self.cache_queue.empty():
+                self.cache_queue.get()
+            self.cacher.join(.1)
+        self.cacher = None
 
 
     def answer_caching_request(self,marker_cache,frame_index):
@@ -113,16 +195,13 @@ class Offline_Reference_Surface(Reference_Surface):
         overlap = visible_ids & requested_ids
         detected_markers = len(overlap)
         if len(overlap)>=min(2,len(requested_ids)):
-            yx = np.array( [marker_by_id[i]['verts_norm'] for i in overlap] )
-            uv = np.array( [self.markers[i].uv_coords for i in overlap] )
-            yx.shape=(-1,1,2)
-            uv.shape=(-1,1,2)
-            m_to_screen,mask = cv2.findHomography(uv,yx)
-            m_from_screen,mask = cv2.findHomography(yx,uv)
-
-            return {'m_to_screen':m_to_screen,
-                    'm_from_screen':m_from_screen,
-                    'detected_markers':len(overlap)}
+            overlap = list(overlap)
+            yx = np.array( [marker_by_id[i]['verts_norm'] for i in overlap] ,dtype=np.float64)
+            uv = np.array( [self.markers[i].uv_coords for i in overlap] ,dtype=np.float64)
+            yx.shape=(1,-1,2)
+            uv.shape=(-1,2)
+            # same homography as the surface cacher, None for degenerate marker configurations
+            return surface_entries(uv,yx,detected_markers)[0]
         else:
             #surface not found
             return None
@@ -137,18 +216,55 @@ class Offline_Reference_Surface(Reference_Surface):
 
 
     def _on_srf_by_frame_idx(self,frame_idx,m_from_screen,data_by_frame):
-        data_on_srf = []
-        for d in data_by_frame:
-            pos = np.array([d['norm_pos']]).reshape(1,1,2)
-            mapped_pos = cv2.perspectiveTransform(pos , m_from_screen )
-            mapped_pos.shape = (2)
-            on_srf = bool((0 <= mapped_pos[0] <= 1) and (0 <= mapped_pos[1] <= 1))
-            data_on_srf.append( {'norm_pos':(mapped_pos[0],mapped_pos[1]),'on_srf':on_srf,'base':d } )
-        return data_on_srf
+        if not data_by_frame:
+            return []
+        pos = np.array([d['norm_pos'] for d in data_by_frame],dtype=np.float64).reshape(-1,1,2)
+        mapped = cv2.perspectiveTransform(pos,m_from_screen).reshape(-1,2)
+        on_srf = ((mapped >= 0) & (mapped <= 1)).all(axis=1).tolist()
+        return [{'norm_pos':(x,y),'on_srf':o,'base':d} for (x,y),o,d in zip(mapped.tolist(),on_srf,data_by_frame)]
+
+
+    def gaze_mapping(self):
+        '''
+        all gaze of the frames the surface is visible in, mapped onto the surface in one batch.
+        Returns columns (arrays of equal length, sorted by frame):
+            gaze_index: row in g_pool.gaze_positions_by_frame.column()
+            frame: world frame index
+            norm_pos: (n,2) position on the surface
+            on_srf: position is inside the surface
+        The result is kept until the surface definition, its cache or the gaze data change.
+        '''
+        gaze = self.g_pool.gaze_positions_by_frame
+        if self.cache is None:
+            return _empty_mapping()
+        key = (gaze,self.cache.count(False))
+        if self._gaze_mapping is None or self._gaze_mapping_key != key:
+            self._gaze_mapping = _map_gaze(gaze,self.cache)
+            self._gaze_mapping_key = key
+        return self._gaze_mapping
+
+    def gaze_mapping_in_section(self,section):
+        '''
+        gaze_mapping of the frames in section. Uses the cached mapping if it is up to date,
+        else only the section is mapped.
+        '''
+        gaze = self.g_pool.gaze_positions_by_frame
+        if self.cache is None:
+            return _empty_mapping()
+        if self._gaze_mapping is None or self._gaze_mapping_key != (gaze,self.cache.count(False)):
+            return _map_gaze(gaze,self.cache,section)
+        mapping = self._gaze_mapping
+        start,stop,_ = section.indices(len(self.g_pool.timestamps))
+        first,last = np.searchsorted(mapping['frame'],(start,stop))
+        return dict([(name,column[first:last]) for name,column in mapping.iteritems()])
 
 
     def gl_display_heatmap(self):
-        if self.heatmap_texture and self.detected:
+        if self.heatmap is not None and self.detected:
+            # textures are made on first draw, generating the heatmap needs no GL context
+            if self.heatmap_texture is None:
+                self.heatmap_texture = Named_Texture()
+                self.heatmap_texture.update_from_ndarray(self.heatmap)
 
             # cv uses 3x3 gl uses 4x4 tranformation matricies
             m = cvmat_to_glmat(self.m_to_screen)
@@ -172,7 +288,10 @@ class Offline_Reference_Surface(Reference_Surface):
 
 
     def gl_display_metrics(self):
-        if self.metrics_texture and self.detected:
+        if self.metrics_heatmap is not None and self.detected:
+            if self.metrics_texture is None:
+                self.metrics_texture = Named_Texture()
+                self.metrics_texture.update_from_ndarray(self.metrics_heatmap)
 
 
             # cv uses 3x3 gl uses 4x4 tranformation matricies
@@ -252,30 +371,17 @@ class Offline_Reference_Surface(Reference_Surface):
         filter_size = (int(self.heatmap_detail * x)/2)*2 +1
         std_dev = filter_size /6.
         self.heatmap = np.ones((y,x,4),dtype=np.uint8)
-        all_gaze = []
-
-        for frame_idx,c_e in enumerate(self.cache[section]):
-            if c_e:
-                frame_idx+=section.start
-                for gp in self.gaze_on_srf_by_frame_idx(frame_idx,c_e['m_from_screen']):
-                    all_gaze.append(gp['norm_pos'])
 
-        if not all_gaze:
+        mapping = self.gaze_mapping()
+        if self._heatmap_accumulator is None or self._heatmap_accumulator.mapping is not mapping or self._heatmap_accumulator.shape != (y,x):
+            self._heatmap_accumulator = Heatmap_Accumulator(mapping,(y,x),len(self.g_pool.timestamps))
+        start,stop,_ = section.indices(len(self.g_pool.timestamps))
+        hist = self._heatmap_accumulator.histogram(start,stop).astype(np.float32)
+        if not hist.any():
             logger.warning("No gaze data on surface for heatmap found.")
-            all_gaze.append((-1.,-1.))
-        all_gaze = np.array(all_gaze)
-        all_gaze *= [self.real_world_size['x'],self.real_world_size['y']]
-        hist,xedge,yedge = np.histogram2d(all_gaze[:,0], all_gaze[:,1],
-                                            bins=[x,y],
-                                            range=[[0, self.real_world_size['x']], [0,self.real_world_size['y']]],
-                                            normed=False,
-                                            weights=None)
-
-
-        hist = np.rot90(hist)
 
         #smoothing..
-        hist = cv2.GaussianBlur(hist, (filter_size,filter_size),std_dev)
+        hist = _blur(hist,filter_size,std_dev)
         maxval = np.amax(hist)
         if maxval:
             scale = 255./maxval
@@ -289,8 +395,7 @@ class Offline_Reference_Surface(Reference_Surface):
 
         self.heatmap[:,:,:3] = c_map
         self.heatmap[:,:,3] = 125
-        self.heatmap_texture = Named_Texture()
-        self.heatmap_texture.update_from_ndarray(self.heatmap)
+        self.heatmap_texture = None
 
 
     def visible_count_in_section(self,section):
@@ -304,14 +409,120 @@ class Offline_Reference_Surface(Reference_Surface):
 
     def gaze_on_srf_in_section(self,section=slice(0,None)):
         #section is a slice
-        #return number of gazepoints that are on surface in section
+        #return the gaze mapping columns of gaze that is on the surface in section
         #If cache is not available on frames it is reported as not visible
-        if self.cache is None:
-            return []
-        gaze_on_srf = []
-        for frame_idx,c_e in enumerate(self.cache[section]):
-            frame_idx+=section.start
-            if c_e:
-                gaze_on_srf += [gp for gp in self.gaze_on_srf_by_frame_idx(frame_idx,c_e['m_from_screen']) if gp['on_srf']]
-        return gaze_on_srf
-
+        mapping = self.gaze_mapping_in_section(section)
+        on_srf = mapping['on_srf']
+        return dict([(name,column[on_srf]) for name,column in mapping.iteritems()])
+
+    def cleanup(self):
+        self.close_cacher()
+        super(Offline_Reference_Surface, self).cleanup()
+
+
+def _empty_mapping():
+    return {'gaze_index':np.zeros(0,dtype=np.int64),'frame':np.zeros(0,dtype=np.int64),
+            'norm_pos':np.zeros((0,2)),'on_srf':np.zeros(0,dtype=bool)}
+
+def _map_gaze(gaze_by_frame,surface_cache,section=slice(None)):
+    '''
+    apply the m_from_screen of every frame in section to its gaze, all frames at once.
+    '''
+    start,stop,_ = section.indices(len(surface_cache))
+    visible = [i for i,c_e in enumerate(surface_cache[start:stop],start) if c_e]
+    if not visible:
+        return _empty_mapping()
+    m_from_screen = np.array([surface_cache[i]['m_from_screen'] for i in visible],dtype=np.float64)
+    slot = np.full(stop-start,-1,dtype=np.int64)
+    slot[np.array(visible)-start] = np.arange(len(visible))
+
+    frames = gaze_by_frame.frame_indices(section)
+    gaze_slot = slot[frames-start]
+    in_view = np.flatnonzero(gaze_slot >= 0)
+    if not len(in_view):
+        return _empty_mapping()
+    pos = np.asarray(gaze_by_frame.column('norm_pos',section),dtype=np.float64).reshape(-1,2)[in_view]
+    M = m_from_screen[gaze_slot[in_view]]
+    x,y = pos[:,0],pos[:,1]
+    w = M[:,2,0]*x + M[:,2,1]*y + M[:,2,2]
+    mapped = np.empty_like(pos)
+    mapped[:,0] = (M[:,0,0]*x + M[:,0,1]*y + M[:,0,2])/w
+    mapped[:,1] = (M[:,1,0]*x + M[:,1,1]*y + M[:,1,2])/w
+    on_srf = ((mapped >= 0) & (mapped <= 1)).all(axis=1)
+    first_row = gaze_by_frame.offsets[start]
+    return {'gaze_index':in_view+first_row,'frame':frames[in_view],'norm_pos':mapped,'on_srf':on_srf}
+
+
+class Heatmap_Accumulator(object):
+    """
+    gaze histograms of one surface for any section of frames.
+    The recording is split into chunks of frames. We keep prefix sums of the chunk histograms,
+    a section is the difference of two prefix sums plus the partial chunks at its ends.
+    The number of chunks is limited so the prefix sums stay below max_cells counts.
+    """
+    max_cells = 2**24
+
+    def __init__(self,mapping,shape,frame_count):
+        self.mapping = mapping
+        self.shape = shape
+        h,w = shape
+        chunk_count = max(1,min(frame_count//100,self.max_cells//(h*w)))
+        self.chunk_size = max(1,-(-frame_count//chunk_count))
+        self.bins = _bin_index(mapping['norm_pos'],shape)
+        bounds = np.searchsorted(mapping['frame'],np.arange(chunk_count+1)*self.chunk_size)
+        self.prefix = np.zeros((chunk_count+1,h*w),dtype=np.int32)
+        for c in xrange(chunk_count):
+            self.prefix[c+1] = self.prefix[c] + self._count(bounds[c],bounds[c+1])
+
+    def _count(self,first,last):
+        bins = self.bins[first:last]
+        return np.bincount(bins[bins >= 0],minlength=self.shape[0]*self.shape[1])
+
+    def _rows(self,start_frame,stop_frame):
+        return np.searchsorted(self.mapping['frame'],(start_frame,stop_frame))
+
+    def histogram(self,start,stop):
+        """
+        gaze counts of frames [start,stop) as image, row 0 is the top of the surface.
+        """
+        first_chunk = -(-start//self.chunk_size)
+        last_chunk = min(stop//self.chunk_size,len(self.prefix)-1)
+        if first_chunk >= last_chunk:
+            counts = self._count(*self._rows(start,stop))
+        else:
+            counts = self.prefix[last_chunk] - self.prefix[first_chunk]
+            counts += self._count(*self._rows(start,first_chunk*self.chunk_size))
+            counts += self._count(*self._rows(last_chunk*self.chunk_size,stop))
+        return counts.reshape(self.shape)
+
+
+def _bin_index(norm_pos,shape):
+    '''
+    flat heatmap pixel of every surface position, -1 for positions outside of the surface.
+    Same binning as np.histogram2d over [0,1] followed by np.rot90.
+    '''
+    h,w = shape
+    bins = np.full(len(norm_pos),-1,dtype=np.int64)
+    inside = np.flatnonzero(((norm_pos >= 0) & (norm_pos <= 1)).all(axis=1))
+    u,v = norm_pos[inside,0],norm_pos[inside,1]
+    col = np.minimum((u*w).astype(np.int64),w-1)
+    row = h-1-np.minimum((v*h).astype(np.int64),h-1)
+    bins[inside] = row*w+col
+    return bins
+
+
+def _blur(img,filter_size,std_dev):
+    '''
+    GaussianBlur that stays fast for large kernels: wide blurs are done on a downscaled image
+    that is scaled back up afterwards.
+    '''
+    h,w = img.shape
+    scale = 1
+    while std_dev/(scale*2) >= 2 and min(h,w)/(scale*2) >= 16:
+        scale *= 2
+    if scale == 1:
+        return cv2.GaussianBlur(img,(filter_size,filter_size),std_dev)
+    small = cv2.resize(img,(w//scale,h//scale),interpolation=cv2.INTER_AREA)
+    small_filter = (int(filter_size/scale)/2)*2+1
+    small = cv2.GaussianBlur(small,(small_filter,small_filter),std_dev/scale)
+    return cv2.resize(small,(w,h),interpolation=cv2.INTER_LINEAR)
@@ -42,6 +42,18 @@ class Plugin(object):
     #you can change this in __init__ for your instance or in the class definition
     order = .5
 
+    # what your plugin does in update(). Player and exporter skip work no loaded plugin needs:
+    # reads_image:  update() uses frame pixels (img, gray or yuv).
+    # writes_image: update() draws on frame.img. The frame is only copied and re-encoded if a plugin does this.
+    #               Both default to True, set them to False if your plugin does not touch the pixels.
+    # needs_events: update() uses the pupil and gaze positions in events. events['dt'] is always there.
+    # gl_only:      all work happens in gl_display and the gui, update() is not called.
+    # these can be properties if they depend on the plugin state.
+    reads_image = True
+    writes_image = True
+    needs_events = True
+    gl_only = False
+
     def __init__(self,g_pool):
         self._alive = True
         self.g_pool = g_pool
@@ -60,6 +72,10 @@ class Plugin(object):
         gets called once every frame
         if you plan to update data inplace, note that this will affect all plugins executed after you.
         Use self.order to deal with this appropriately
+        In Player, pupil and gaze data in events are read-only. Use datum.copy() to change one.
+
+        frame.width, frame.height, frame.gray and frame.yuv are cheap and read-only.
+        frame.img (BGR) is converted on first access. Only use it if you need color or want to draw.
         """
         pass
 
@@ -295,6 +311,13 @@ class Plugin_List(object):
                 logger.debug("Unloaded Plugin: %s"%p)
                 self._plugins.remove(p)
 
+    def uses(self,capability):
+        '''
+        True if any loaded plugin declares capability, e.g. 'writes_image'.
+        gl_only plugins do not run update() and do not count.
+        '''
+        return any(getattr(p,capability) for p in self._plugins if not p.gl_only)
+
     def get_initializers(self):
         initializers = []
         for p in self._plugins:
@@ -0,0 +1,515 @@
+'''
+(*)~----------------------------------------------------------------------------------
+ Pupil - eye tracking platform
+ Copyright (C) 2012-2016  Pupil Labs
+
+ Distributed under the terms of the GNU Lesser General Public License (LGPL v3.0).
+ License details are in the file license.txt, distributed as part of this software.
+----------------------------------------------------------------------------------~(*)
+'''
+
+"""
+Columnar storage for pupil and gaze data.
+
+A recording keeps its pupil data in the directory `pupil_data_columns`:
+    pupil_positions.npy     structured array, one row per pupil datum
+    gaze_positions.npy      structured array, one row per gaze datum
+    gaze_base_offsets.npy   int64, len(gaze)+1 entries. The base of gaze row i
+                            is gaze_base_index[offsets[i]:offsets[i+1]]
+    gaze_base_index.npy     int64, row indices into pupil_positions (-1 == None)
+    notifications           appended pickle records, each a list of notification dicts
+
+All arrays are opened with np.load(mmap_mode='r'); dicts are only built for
+the rows that are actually accessed. Recordings that only have the legacy
+`pupil_data` pickle are converted on first load.
+
+Capture streams data into these files while recording (see Pupil_Data_Writer).
+Readers accept partially written recordings and drop incomplete tails.
+
+Fields that are not part of the dtypes below are not stored.
+"""
+
+import os
+import shutil
+from copy import deepcopy
+from collections import OrderedDict
+from threading import Thread
+from Queue import Queue,Empty
+from time import time
+import numpy as np
+from file_methods import load_object,save_object,Npy_Appender,append_object,load_appended_objects
+import logging
+logger = logging.getLogger(__name__)
+
+columns_dir_name = 'pupil_data_columns'
+legacy_file_name = 'pupil_data'
+
+nan = float('nan')
+
+pupil_dtype = np.dtype([('timestamp',np.float64),
+                        ('confidence',np.float64),
+                        ('id',np.int32),
+                        ('method','S16'),
+                        ('norm_pos',np.float64,(2,)),
+                        ('diameter',np.float64),
+                        ('ellipse_center',np.float64,(2,)),
+                        ('ellipse_axes',np.float64,(2,)),
+                        ('ellipse_angle',np.float64),
+                        ('diameter_3D',np.float64),
+                        ('model_confidence',np.float64),
+                        ('model_id',np.int32),
+                        ('theta',np.float64),
+                        ('phi',np.float64),
+                        ('sphere_center',np.float64,(3,)),
+                        ('sphere_radius',np.float64),
+                        ('circle3D_center',np.float64,(3,)),
+                        ('circle3D_normal',np.float64,(3,)),
+                        ('circle3D_radius',np.float64)])
+
+gaze_dtype = np.dtype([('timestamp',np.float64),
+                       ('confidence',np.float64),
+                       ('norm_pos',np.float64,(2,))])
+
+# column name -> key path into the datum dict
+pupil_fields = (('timestamp',('timestamp',)),
+                ('confidence',('confidence',)),
+                ('id',('id',)),
+                ('method',('method',)),
+                ('norm_pos',('norm_pos',)),
+                ('diameter',('diameter',)),
+                ('ellipse_center',('ellipse','center')),
+                ('ellipse_axes',('ellipse','axes')),
+                ('ellipse_angle',('ellipse','angle')),
+                ('diameter_3D',('diameter_3D',)),
+                ('model_confidence',('modelConfidence',)),
+                ('model_id',('modelID',)),
+                ('theta',('theta',)),
+                ('phi',('phi',)),
+                ('sphere_center',('sphere','center')),
+                ('sphere_radius',('sphere','radius')),
+                ('circle3D_center',('circle3D','center')),
+                ('circle3D_normal',('circle3D','normal')),
+                ('circle3D_radius',('circle3D','radius')))
+
+gaze_fields = (('timestamp',('timestamp',)),
+               ('confidence',('confidence',)),
+               ('norm_pos',('norm_pos',)))
+
+
+def _missing_value(dtype):
+    if dtype.kind == 'f':
+        return nan
+    elif dtype.kind in 'iu':
+        return -1
+    else:
+        return ''
+
+def _present(column):
+    '''
+    bool array: True where the column holds a value and not the missing marker
+    '''
+    kind = column.dtype.kind
+    if kind == 'f':
+        present = ~np.isnan(column)
+    elif kind in 'iu':
+        present = column != -1
+    else:
+        present = column != ''
+    if present.ndim > 1:
+        present = present.any(axis=tuple(range(1,present.ndim)))
+    return present
+
+
+def _lookup(datum,path):
+    for key in path:
+        if datum is None:
+            return None
+        datum = datum.get(key)
+    return datum
+
+def _to_structured(data,dtype,fields):
+    '''
+    turn a list of datum dicts into a structured array
+    '''
+    columns = np.empty(len(data),dtype=dtype)
+    if not data:
+        return columns
+    for name,path in fields:
+        missing = _missing_value(dtype[name].base)
+        if dtype[name].shape:
+            missing = (missing,)*dtype[name].shape[0]
+        values = [_lookup(d,path) for d in data]
+        columns[name] = [missing if v is None else v for v in values]
+    return columns
+
+
+def _from_structured(columns,fields):
+    '''
+    turn (a selection of) a structured array back into a list of datum dicts
+    '''
+    values = []
+    for name,path in fields:
+        column = columns[name]
+        v = column.tolist()
+        if column.ndim > 1:
+            v = map(tuple,v)
+        values.append((path,v,_present(column).tolist()))
+
+    data = []
+    for i in xrange(len(columns)):
+        d = {}
+        for path,v,present in values:
+            if present[i]:
+                if len(path) == 1:
+                    d[path[0]] = v[i]
+                else:
+                    d.setdefault(path[0],{})[path[1]] = v[i]
+        data.append(d)
+    return data
+
+
+class Frozen_Datum(dict):
+    """
+    Read-only datum dict. Frozen data are shared between frames and plugins
+    without copying. Use datum.copy() to get a mutable dict.
+    Copies and pickles of a Frozen_Datum are plain dicts.
+    """
+    __slots__ = ()
+
+    def _read_only(self,*args,**kwargs):
+        raise TypeError("Datum is read-only. Use datum.copy() to modify it.")
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _read_only
+
+    def copy(self):
+        return dict(self)
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self,memo):
+        return dict((key,deepcopy(value,memo)) for key,value in self.iteritems())
+
+    def __reduce__(self):
+        return (dict,(dict(self),))
+
+def freeze_datum(datum):
+    '''
+    freeze a datum and its nested dicts. Lists of dicts (like `base`) become tuples.
+    '''
+    if isinstance(datum,Frozen_Datum) or datum is None:
+        return datum
+    frozen = {}
+    for key,value in datum.iteritems():
+        if isinstance(value,dict):
+            value = freeze_datum(value)
+        elif isinstance(value,list) and value and isinstance(value[0],(dict,type(None))):
+            value = tuple(freeze_datum(v) for v in value)
+        frozen[key] = value
+    return Frozen_Datum(frozen)
+
+
+class Datum_Columns(object):
+    """
+    Read-only sequence view on a structured array.
+    Items are materialized as the dicts plugins expect on access.
+    Gaze columns resolve their variable length `base` through an offset table.
+    """
+    def __init__(self,columns,fields,base=None,base_offsets=None,base_index=None):
+        self.columns = columns
+        self.fields = fields
+        self.base = base
+        self.base_offsets = base_offsets
+        self.base_index = base_index
+
+    def with_columns(self,columns):
+        """same sequence with replaced columns, e.g. a corrected in-memory copy"""
+        return Datum_Columns(columns,self.fields,self.base,self.base_offsets,self.base_index)
+
+    @property
+    def timestamps(self):
+        return self.columns['timestamp']
+
+    def __len__(self):
+        return len(self.columns)
+
+    def __iter__(self):
+        chunk_size = 4096
+        for start in xrange(0,len(self),chunk_size):
+            for datum in self.take(np.arange(start,min(start+chunk_size,len(self)))):
+                yield datum
+
+    def __getitem__(self,key):
+        if isinstance(key,slice):
+            return self.take(np.arange(*key.indices(len(self))))
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError('Datum_Columns index out of range')
+        return self.take(np.array([key]))[0]
+
+    def take(self,rows):
+        '''
+        materialize the given row indices as a list of dicts
+        '''
+        rows = np.asarray(rows,dtype=np.int64)
+        data = _from_structured(self.columns[rows],self.fields)
+        if self.base is not None:
+            starts = self.base_offsets[rows]
+            stops = self.base_offsets[rows+1]
+            base_rows = [self.base_index[start:stop] for start,stop in zip(starts,stops)]
+            flat = np.concatenate(base_rows) if base_rows else np.zeros(0,dtype=np.int64)
+            #rows beyond the pupil data can occur in recordings that were not closed properly
+            valid = (flat >= 0) & (flat < len(self.base))
+            base_data = self.base.take(flat[valid]) if len(flat) else []
+            base_data.reverse()
+            for datum,b in zip(data,base_rows):
+                datum['base'] = [base_data.pop() if 0 <= r < len(self.base) else None for r in b]
+        return data
+
+    def to_list(self):
+        return self.take(np.arange(len(self)))
+
+
+def pupil_data_to_columns(pupil_data):
+    '''
+    convert the dict based pupil_data into arrays. gaze `base` entries are
+    matched to pupil rows by identity, falling back to (timestamp,id).
+    '''
+    pupil_list = pupil_data.get('pupil_positions',[])
+    gaze_list = pupil_data.get('gaze_positions',[])
+
+    row_by_obj = dict((id(p),i) for i,p in enumerate(pupil_list))
+    row_by_key = dict(((p['timestamp'],p.get('id')),i) for i,p in enumerate(pupil_list))
+
+    base_offsets = np.zeros(len(gaze_list)+1,dtype=np.int64)
+    base_index = []
+    for i,g in enumerate(gaze_list):
+        for p in g.get('base',[]):
+            if p is None:
+                base_index.append(-1)
+            elif id(p) in row_by_obj:
+                base_index.append(row_by_obj[id(p)])
+            else:
+                base_index.append(row_by_key.get((p['timestamp'],p.get('id')),-1))
+        base_offsets[i+1] = len(base_index)
+
+    return {'pupil_positions':_to_structured(pupil_list,pupil_dtype,pupil_fields),
+            'gaze_positions':_to_structured(gaze_list,gaze_dtype,gaze_fields),
+            'gaze_base_offsets':base_offsets,
+            'gaze_base_index':np.array(base_index,dtype=np.int64),
+            'notifications':list(pupil_data.get('notifications',[]))}
+
+
+def save_pupil_data(pupil_data,rec_dir):
+    '''
+    write dict based pupil_data as columns into rec_dir.
+    We write into a tmp dir and rename so readers never see half a dataset.
+    '''
+    save_columns(pupil_data_to_columns(pupil_data),rec_dir)
+
+def save_columns(columns,rec_dir):
+    columns_dir = os.path.join(rec_dir,columns_dir_name)
+    tmp_dir = columns_dir+'.tmp'
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.mkdir(tmp_dir)
+    for name in ('pupil_positions','gaze_positions','gaze_base_offsets','gaze_base_index'):
+        np.save(os.path.join(tmp_dir,name+'.npy'),columns[name])
+    save_object(columns['notifications'],os.path.join(tmp_dir,'notifications'))
+    if os.path.isdir(columns_dir):
+        shutil.rmtree(columns_dir)
+    os.rename(tmp_dir,columns_dir)
+
+
+def _load_array(path):
+    try:
+        return np.load(path,mmap_mode='r')
+    except ValueError:
+        #empty arrays can not be memory mapped
+        return np.load(path)
+
+def _load_notifications(columns_dir):
+    try:
+        blocks = load_appended_objects(os.path.join(columns_dir,'notifications'))
+    except IOError:
+        return []
+    return [n for block in blocks for n in block]
+
+def _trim_partial(columns):
+    '''
+    a recording that was not closed properly can have files of different lengths.
+    Cut gaze data to the rows that have a complete base.
+    '''
+    gaze,offsets,base_index = columns['gaze_positions'],columns['gaze_base_offsets'],columns['gaze_base_index']
+    if len(offsets) == 0:
+        offsets = np.zeros(1,dtype=np.int64)
+    gaze_count = min(len(gaze),len(offsets)-1)
+    gaze_count = min(gaze_count,np.searchsorted(offsets,len(base_index),side='right')-1)
+    if gaze_count < len(gaze):
+        logger.warning("Recording was not closed properly. Dropping %s incomplete gaze positions."%(len(gaze)-gaze_count))
+    columns['gaze_positions'] = gaze[:gaze_count]
+    columns['gaze_base_offsets'] = offsets[:gaze_count+1]
+    return columns
+
+def _load_columns(columns_dir):
+    columns = {}
+    for name in ('pupil_positions','gaze_positions','gaze_base_offsets','gaze_base_index'):
+        columns[name] = _load_array(os.path.join(columns_dir,name+'.npy'))
+    columns['notifications'] = _load_notifications(columns_dir)
+    return _trim_partial(columns)
+
+def _needs_conversion(rec_dir):
+    columns_dir = os.path.join(rec_dir,columns_dir_name)
+    legacy_path = os.path.join(rec_dir,legacy_file_name)
+    if not os.path.isdir(columns_dir):
+        return True
+    #the legacy file was rewritten after conversion (e.g. by a recording updater)
+    if os.path.isfile(legacy_path):
+        return os.path.getmtime(legacy_path) > os.path.getmtime(columns_dir)
+    return False
+
+def load_pupil_columns(rec_dir):
+    '''
+    returns a dict of arrays as written by save_columns.
+    Legacy pickles are converted and written as columns when possible.
+    '''
+    if _needs_conversion(rec_dir):
+        logger.info("Converting pupil_data to columnar format. This only happens once.")
+        columns = pupil_data_to_columns(load_object(os.path.join(rec_dir,legacy_file_name)))
+        try:
+            save_columns(columns,rec_dir)
+        except (IOError,OSError) as e:
+            logger.warning("Could not save converted pupil data: %s. Will use it from memory."%e)
+            return columns
+    return _load_columns(os.path.join(rec_dir,columns_dir_name))
+
+def load_pupil_data(rec_dir):
+    '''
+    load the pupil data of a recording. Returns a dict just like the legacy pupil_data
+    but pupil and gaze positions are Datum_Columns backed by memory mapped arrays.
+    '''
+    columns = load_pupil_columns(rec_dir)
+    pupil = Datum_Columns(columns['pupil_positions'],pupil_fields)
+    gaze = Datum_Columns(columns['gaze_positions'],gaze_fields,
+                         base=pupil,
+                         base_offsets=columns['gaze_base_offsets'],
+                         base_index=columns['gaze_base_index'])
+    return {'pupil_positions':pupil,'gaze_positions':gaze,'notifications':columns['notifications']}
+
+def load_notifications(rec_dir):
+    '''
+    load only the notifications without touching pupil and gaze data
+    '''
+    columns_dir = os.path.join(rec_dir,columns_dir_name)
+    if os.path.isdir(columns_dir) and not _needs_conversion(rec_dir):
+        return _load_notifications(columns_dir)
+    return load_object(os.path.join(rec_dir,legacy_file_name)).get('notifications',[])
+
+
+class Pupil_Data_Writer(object):
+    """
+    Streams the data of a running recording into the columnar format.
+    The world loop only queues data. A background thread converts and writes
+    them in blocks of block_size rows or every flush_interval seconds.
+    Everything written up to the last flush survives a crash.
+    A failed write is kept in error, close() raises it.
+    """
+    def __init__(self,rec_dir,block_size=1000,flush_interval=1.):
+        self.block_size = block_size
+        self.flush_interval = flush_interval
+        self.columns_dir = os.path.join(rec_dir,columns_dir_name)
+        if not os.path.isdir(self.columns_dir):
+            os.mkdir(self.columns_dir)
+
+        self.pupil_writer = Npy_Appender(os.path.join(self.columns_dir,'pupil_positions.npy'),pupil_dtype)
+        self.gaze_writer = Npy_Appender(os.path.join(self.columns_dir,'gaze_positions.npy'),gaze_dtype)
+        self.base_offsets_writer = Npy_Appender(os.path.join(self.columns_dir,'gaze_base_offsets.npy'),np.int64)
+        self.base_index_writer = Npy_Appender(os.path.join(self.columns_dir,'gaze_base_index.npy'),np.int64)
+        self.timestamps_writer = Npy_Appender(os.path.join(rec_dir,'world_timestamps.npy'),np.float64)
+        self.notifications_path = os.path.join(self.columns_dir,'notifications')
+        open(self.notifications_path,'wb').close()
+        self.base_offsets_writer.append([0])
+
+        #row of recent pupil data by (timestamp,id) to resolve gaze base references
+        self.pupil_rows = OrderedDict()
+        #first exception raised by the writer thread
+        self.error = None
+
+        self.queue = Queue()
+        self.thread = Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def append(self,pupil_positions,gaze_positions,timestamp):
+        self.queue.put(('data',pupil_positions,gaze_positions,timestamp))
+
+    def append_notification(self,notification):
+        self.queue.put(('notification',notification))
+
+    def close(self):
+        """write all queued data and close the files"""
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        pupil,gaze,timestamps,notifications = [],[],[],[]
+        last_flush = time()
+        while True:
+            try:
+                item = self.queue.get(timeout=self.flush_interval)
+            except Empty:
+                item = ()
+            if item is None:
+                break
+            elif item and item[0] == 'data':
+                pupil += item[1]
+                gaze += item[2]
+                timestamps.append(item[3])
+            elif item:
+                notifications.append(item[1])
+
+            if len(pupil)+len(gaze) >= self.block_size or time()-last_flush >= self.flush_interval:
+                self._write_block(pupil,gaze,timestamps,notifications)
+                pupil,gaze,timestamps,notifications = [],[],[],[]
+                last_flush = time()
+
+        self._write_block(pupil,gaze,timestamps,notifications)
+        for writer in (self.pupil_writer,self.base_index_writer,self.gaze_writer,self.base_offsets_writer,self.timestamps_writer):
+            writer.close()
+
+    def _write_block(self,pupil,gaze,timestamps,notifications):
+        try:
+            if pupil:
+                for row,p in enumerate(pupil,self.pupil_writer.count):
+                    self.pupil_rows[p['timestamp'],p.get('id')] = row
+                while len(self.pupil_rows) > 10*self.block_size:
+                    self.pupil_rows.popitem(last=False)
+                self.pupil_writer.append(_to_structured(pupil,pupil_dtype,pupil_fields))
+
+            if gaze:
+                base_index,base_offsets = [],[]
+                for g in gaze:
+                    for p in g.get('base',[]):
+                        if p is None:
+                            base_index.append(-1)
+                        else:
+                            base_index.append(self.pupil_rows.get((p['timestamp'],p.get('id')),-1))
+                    base_offsets.append(self.base_index_writer.count+len(base_index))
+                self.base_index_writer.append(base_index)
+                self.gaze_writer.append(_to_structured(gaze,gaze_dtype,gaze_fields))
+                self.base_offsets_writer.append(base_offsets)
+
+            if timestamps:
+                self.timestamps_writer.append(timestamps)
+            if notifications:
+                append_object(notifications,self.notifications_path)
+
+            #referenced data first so readers never see a dangling reference
+            for writer in (self.pupil_writer,self.base_index_writer,self.gaze_writer,self.base_offsets_writer,self.timestamps_writer):
+                writer.flush()
+        except Exception as e:
+            logger.exception("Could not write recording data.")
+            if self.error is None:
+                self.error = e
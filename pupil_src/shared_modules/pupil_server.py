@@ -23,6 +23,9 @@ logger = logging.getLogger(__name__)
 
 class Pupil_Server(Plugin):
     """pupil server plugin"""
+    reads_image = False
+    writes_image = False
+
     def __init__(self, g_pool,address="tcp://127.0.0.1:5000"):
         super(Pupil_Server, self).__init__(g_pool)
         self.order = .9
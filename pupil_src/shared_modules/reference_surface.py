@@ -89,10 +89,7 @@ class Reference_Surface(object):
 
         self.gaze_on_srf = [] # points on surface for realtime feedback display
 
-        self.glfont = fontstash.Context()
-        self.glfont.add_font('opensans',get_opensans_font_path())
-        self.glfont.set_size(22)
-        self.glfont.set_color_float((0.2,0.5,0.9,1.0))
+        self.glfont = None # created on first draw, so surfaces can be used without a GL context
 
 
         if saved_definition is not None:
@@ -339,6 +336,12 @@ class Reference_Surface(object):
             m.uv_coords = cv2.perspectiveTransform(m.uv_coords,transform)
 
 
+    def init_glfont(self):
+        self.glfont = fontstash.Context()
+        self.glfont.add_font('opensans',get_opensans_font_path())
+        self.glfont.set_size(22)
+        self.glfont.set_color_float((0.2,0.5,0.9,1.0))
+
     def marker_status(self):
         return "%s   %s/%s" %(self.name,self.detected_markers,len(self.markers))
 
@@ -361,6 +364,8 @@ class Reference_Surface(object):
             text_anchor = frame.reshape((5,-1))[2]
             text_anchor[1] = 1-text_anchor[1]
             text_anchor *=img_size[1],img_size[0]
+            if self.glfont is None:
+                self.init_glfont()
             self.glfont.draw_text(text_anchor[0],text_anchor[1],self.marker_status())
 
     def gl_draw_corners(self):
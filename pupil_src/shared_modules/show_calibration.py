@@ -26,6 +26,8 @@ logger = logging.getLogger(__name__)
 
 class Show_Calibration(Plugin):
     """Calibration results visualization plugin"""
+    gl_only = True
+
     def __init__(self,g_pool):
         super(Show_Calibration, self).__init__(g_pool)
 
@@ -125,6 +125,9 @@ def detect_markers(gray_img,grid_size,min_marker_perimeter=40,aperture=11,visual
                                     mode=cv2.RETR_TREE,
                                     method=cv2.CHAIN_APPROX_SIMPLE,offset=(0,0)) #TC89_KCOS
 
+    if hierarchy is None:
+        #no contours at all (e.g. a uniform image region)
+        return []
     # remove extra encapsulation
     hierarchy = hierarchy[0]
     contours = np.array(contours)
@@ -236,49 +239,134 @@ def m_screen_to_marker(marker):
 
 
 
-#persistent vars for detect_markers_robust
 lk_params = dict( winSize  = (45, 45),
                   maxLevel = 1,
                   criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03))
-prev_img = None
-tick = 0
 
-def detect_markers_robust(gray_img,grid_size,prev_markers,min_marker_perimeter=40,aperture=11,visualize=False,true_detect_every_frame = 1):
-    global prev_img
 
-    global tick
-    if not tick:
-        tick = true_detect_every_frame
-        new_markers = detect_markers(gray_img,grid_size,min_marker_perimeter,aperture,visualize)
-    else:
-        new_markers = []
-    tick -=1
-
-
-    if prev_img is not None and prev_markers:
-
-        new_ids = [m['id'] for m in new_markers]
-
-        #any old markers not found in the new list?
-        not_found = [m for m in prev_markers if m['id'] not in new_ids and m['id'] >=0]
-        if not_found:
-            prev_pts = np.array([m['centroid'] for m in not_found])
-            # new_pts, flow_found, err = cv2.calcOpticalFlowPyrLK(prev_img, gray_img,prev_pts,winSize=(100,100))
-            new_pts, flow_found, err = cv2.calcOpticalFlowPyrLK(prev_img, gray_img,prev_pts,minEigThreshold=0.01,**lk_params)
-            for pt,s,e,m in zip(new_pts,flow_found,err,not_found):
-                if s: #ho do we ensure that this is a good move?
-                    m['verts'] += pt-m['centroid'] #uniformly translate verts by optlical flow offset
-                    r_norm = m['verts']/np.float32((gray_img.shape[1],gray_img.shape[0]))
-                    r_norm[:,:,1] = 1-r_norm[:,:,1]
-                    m['verts_norm'] = r_norm
-                    m["frames_since_true_detection"] +=1
-                else:
-                    m["frames_since_true_detection"] =100
-
-
-        #cocatenating like this will favour older markers in the doublication deletion process
-        markers = [m for m in not_found if m["frames_since_true_detection"] < 10 ]+new_markers
-        if 1: #del double detected markers
+def detect_markers_in_rois(gray_img,rois,grid_size,min_marker_perimeter=40,aperture=11):
+    '''
+    detect_markers restricted to image regions. rois: list of (x0,y0,x1,y1).
+    Returned markers are in full image coordinates.
+    '''
+    markers = []
+    img_size = np.float32((gray_img.shape[1],gray_img.shape[0]))
+    for x0,y0,x1,y1 in rois:
+        for m in detect_markers(gray_img[y0:y1,x0:x1],grid_size,min_marker_perimeter,aperture):
+            m['verts'] += np.float32((x0,y0))
+            m['centroid'] += np.float32((x0,y0))
+            r_norm = m['verts']/img_size
+            r_norm[:,:,1] = 1-r_norm[:,:,1]
+            m['verts_norm'] = r_norm
+            markers.append(m)
+    return markers
+
+
+def marker_rois(markers,img_shape,padding=1.):
+    '''
+    bounding boxes of the markers padded by padding*marker size on every side,
+    clipped to the image and merged where they overlap.
+    '''
+    h,w = img_shape[:2]
+    rects = []
+    for m in markers:
+        verts = np.reshape(m['verts'],(-1,2))
+        (x0,y0),(x1,y1) = verts.min(axis=0),verts.max(axis=0)
+        pad = padding*max(x1-x0,y1-y0)
+        rects.append([max(0,int(x0-pad)),max(0,int(y0-pad)),min(w,int(x1+pad)+1),min(h,int(y1+pad)+1)])
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(rects)):
+            for j in range(i+1,len(rects)):
+                a,b = rects[i],rects[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    rects[i] = [min(a[0],b[0]),min(a[1],b[1]),max(a[2],b[2]),max(a[3],b[3])]
+                    del rects[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return [tuple(r) for r in rects if r[2]>r[0] and r[3]>r[1]]
+
+
+class Marker_Tracker(object):
+    """
+    detect markers and follow the ones that are lost between true detections with optical flow.
+    Every tracker keeps its own state (previous image pyramid, previous markers, redetection schedule)
+    so several trackers can run side by side. Call reset() after a seek.
+
+    roi_detection: true detections only search padded regions around the known markers.
+    The whole frame is searched when there are no known markers, when a known marker is not found
+    in its region and at least every full_scan_every true detections. New markers are therefore
+    found after at most full_scan_every*true_detect_every_frame frames.
+    """
+    def __init__(self,grid_size=5,true_detect_every_frame=1,roi_detection=False,full_scan_every=10):
+        self.grid_size = grid_size
+        self.true_detect_every_frame = true_detect_every_frame
+        self.roi_detection = roi_detection
+        self.full_scan_every = full_scan_every
+        self.reset()
+
+    def reset(self):
+        self.prev_pyramid = None
+        self.prev_markers = []
+        self.tick = 0
+        self.detections_since_full_scan = 0
+
+    def detect(self,gray_img,min_marker_perimeter,aperture,visualize):
+        if self.roi_detection and self.prev_markers and not visualize and self.detections_since_full_scan < self.full_scan_every:
+            rois = marker_rois(self.prev_markers,gray_img.shape)
+            markers = detect_markers_in_rois(gray_img,rois,self.grid_size,min_marker_perimeter,aperture)
+            found_ids = set(m['id'] for m in markers)
+            #markers the last true detection found. Older ones were already missed by a full scan.
+            expected = [m['id'] for m in self.prev_markers if m['frames_since_true_detection'] < self.true_detect_every_frame]
+            if all(i in found_ids for i in expected):
+                self.detections_since_full_scan += 1
+                return markers
+            #a known marker got lost, it may have jumped further than the padding.
+        self.detections_since_full_scan = 0
+        return detect_markers(gray_img,self.grid_size,min_marker_perimeter,aperture,visualize)
+
+    def _pyramid(self,gray_img):
+        #built once per frame: next image of this call and previous image of the next call.
+        return cv2.buildOpticalFlowPyramid(gray_img,lk_params['winSize'],lk_params['maxLevel'])[1]
+
+    def track(self,gray_img,min_marker_perimeter=40,aperture=11,visualize=False):
+        if not self.tick:
+            self.tick = self.true_detect_every_frame
+            new_markers = self.detect(gray_img,min_marker_perimeter,aperture,visualize)
+        else:
+            new_markers = []
+        self.tick -=1
+
+        pyramid = None
+        if self.prev_pyramid is not None and self.prev_markers:
+            new_ids = [m['id'] for m in new_markers]
+
+            #any old markers not found in the new list?
+            not_found = [m for m in self.prev_markers if m['id'] not in new_ids and m['id'] >=0]
+            tracked = []
+            if not_found:
+                pyramid = self._pyramid(gray_img)
+                prev_pts = np.array([m['centroid'] for m in not_found])
+                new_pts, flow_found, err = cv2.calcOpticalFlowPyrLK(self.prev_pyramid, pyramid,prev_pts,minEigThreshold=0.01,**lk_params)
+                img_size = np.float32((gray_img.shape[1],gray_img.shape[0]))
+                for pt,s,e,m in zip(new_pts,flow_found,err,not_found):
+                    if s: #ho do we ensure that this is a good move?
+                        #new dicts: the markers of the last frame may still be in use (e.g. waiting in a queue).
+                        m = dict(m)
+                        m['verts'] = m['verts'] + (pt-m['centroid']) #uniformly translate verts by optlical flow offset
+                        r_norm = m['verts']/img_size
+                        r_norm[:,:,1] = 1-r_norm[:,:,1]
+                        m['verts_norm'] = r_norm
+                        m["frames_since_true_detection"] +=1
+                        if m["frames_since_true_detection"] < 10:
+                            tracked.append(m)
+
+            #cocatenating like this will favour older markers in the doublication deletion process
+            markers = tracked+new_markers
+            #del double detected markers
             min_distace = min_marker_perimeter/4.
             if len(markers)>1:
                 remove = set()
@@ -290,21 +378,25 @@ def detect_markers_robust(gray_img,grid_size,prev_markers,min_marker_perimeter=4
                 remove.sort(reverse=True)
                 for i in remove:
                     del markers[i]
-    else:
-        markers = new_markers
-
+        else:
+            markers = new_markers
 
-    prev_img = gray_img.copy()
-    return markers
+        if markers:
+            self.prev_pyramid = pyramid if pyramid is not None else self._pyramid(gray_img)
+        else:
+            #nothing to follow into the next frame
+            self.prev_pyramid = None
+        self.prev_markers = markers
+        return markers
 
 
 
 def bench():
     cap = cv2.VideoCapture('/Users/mkassner/Pupil/datasets/markers/many.mov')
     status,img = cap.read()
-    markers = []
+    tracker = Marker_Tracker(grid_size=5,true_detect_every_frame=1)
     while status:
-        markers = detect_markers_robust(img,5,markers,true_detect_every_frame=1)
+        markers = tracker.track(cv2.cvtColor(img,cv2.COLOR_BGR2GRAY))
         status,img = cap.read()
         if markers:
             return
@@ -0,0 +1,163 @@
+'''
+(*)~----------------------------------------------------------------------------------
+ Pupil - eye tracking platform
+ Copyright (C) 2012-2016  Pupil Labs
+
+ Distributed under the terms of the GNU Lesser General Public License (LGPL v3.0).
+ License details are in the file license.txt, distributed as part of this software.
+----------------------------------------------------------------------------------~(*)
+'''
+
+import numpy as np
+
+
+def batch_homographies(src,dst):
+    '''
+    least squares homographies mapping src to dst for a stack of point sets.
+    src: (n,2) points shared by all sets, dst: (count,n,2)
+    returns (count,3,3), normalized DLT solved with one batched eigen decomposition.
+    '''
+    def normalization(pts):
+        # move the centroid to the origin and scale the mean distance to sqrt(2)
+        mean = pts.mean(axis=-2)
+        dist = np.sqrt(((pts-mean[...,None,:])**2).sum(axis=-1)).mean(axis=-1)
+        scale = np.sqrt(2)/np.maximum(dist,1e-12)
+        T = np.zeros(pts.shape[:-2]+(3,3))
+        T[...,0,0] = T[...,1,1] = scale
+        T[...,:2,2] = -mean*scale[...,None]
+        T[...,2,2] = 1
+        return T,(pts-mean[...,None,:])*scale[...,None,None]
+
+    src = np.asarray(src,dtype=np.float64)
+    dst = np.asarray(dst,dtype=np.float64)
+    count,n = dst.shape[:2]
+    T_src,src_n = normalization(src)
+    T_dst,dst_n = normalization(dst)
+    x,y = np.broadcast_to(src_n[:,0],(count,n)),np.broadcast_to(src_n[:,1],(count,n))
+    u,v = dst_n[...,0],dst_n[...,1]
+    zero,one = np.zeros((count,n)),np.ones((count,n))
+    A = np.empty((count,2*n,9))
+    A[:,0::2] = np.stack((-x,-y,-one,zero,zero,zero,u*x,u*y,u),axis=-1)
+    A[:,1::2] = np.stack((zero,zero,zero,-x,-y,-one,v*x,v*y,v),axis=-1)
+    # the solution is the eigenvector of A'A with the smallest eigenvalue
+    w,vecs = np.linalg.eigh(np.einsum('kij,kil->kjl',A,A))
+    H = vecs[:,:,0].reshape(count,3,3)
+    # undo the normalization: inv(T_dst).H.T_src
+    H = np.einsum('kij,kjl,lm->kim',np.linalg.inv(T_dst),H,T_src)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        H /= H[:,2:,2:]
+    return H
+
+
+def surface_entries(uv,yx,detected_markers):
+    '''
+    surface cache entries for a stack of marker configurations.
+    uv: (n,2) marker verts on the surface, yx: (count,n,2) the same verts in the image
+    returns a list of count entries, None where the homography is degenerate.
+    Offline_Reference_Surface.answer_caching_request uses this as well, so both paths give the same result.
+    '''
+    m_to_screen = batch_homographies(uv,yx)
+    valid = np.isfinite(m_to_screen).all(axis=(1,2)) & (np.abs(np.linalg.det(m_to_screen)) > 1e-12)
+    m_from_screen = np.full_like(m_to_screen,np.nan)
+    if valid.any():
+        m_from_screen[valid] = np.linalg.inv(m_to_screen[valid])
+    return [{'m_to_screen':m_to_screen[i],'m_from_screen':m_from_screen[i],'detected_markers':int(detected_markers)} if valid[i] else None
+            for i in xrange(len(yx))]
+
+
+def locate_surface(markers,visited,uv_by_id,frames):
+    '''
+    locate a surface in a block of frames of a columnar marker cache.
+    markers,visited: see marker_cache.load_columns
+    uv_by_id: {marker id: uv coords of the marker verts on the surface}
+    frames: (start,stop)
+    returns the surface cache entries for these frames, see Offline_Reference_Surface.update_cache
+
+    Frames are grouped by the set of surface markers they show. Each group shares the surface side
+    of the correspondence and gets its homographies in one batch. Frames with identical marker verts
+    share one result. m_from_screen is the inverse of m_to_screen.
+    '''
+    start,stop = frames
+    results = [False]*(stop-start)
+    for idx in visited[(visited >= start) & (visited < stop)].tolist():
+        results[idx-start] = None
+
+    ids = sorted(uv_by_id)
+    if not ids:
+        return results
+    m = markers[(markers['frame'] >= start) & (markers['frame'] < stop)]
+    m = m[np.in1d(m['id'],ids)]
+    m = m[np.in1d(m['frame'],visited)]
+    if not len(m):
+        return results
+    # sort by frame and id, the last detection of an id in a frame wins (as in a dict)
+    order = np.lexsort((np.arange(len(m)),m['id'],m['frame']))
+    m = m[order]
+    last = np.ones(len(m),dtype=bool)
+    last[:-1] = (m['frame'][1:] != m['frame'][:-1]) | (m['id'][1:] != m['id'][:-1])
+    m = m[last]
+
+    frame_idx,first_row,per_frame = np.unique(m['frame'],return_index=True,return_counts=True)
+    id_pos = np.searchsorted(ids,m['id'])
+    if len(ids) <= 62:
+        keys = np.add.reduceat(np.left_shift(np.int64(1),id_pos.astype(np.int64)),first_row)
+    else:
+        bounds = np.append(first_row,len(m)).tolist()
+        id_pos_list = id_pos.tolist()
+        codes = {}
+        keys = np.array([codes.setdefault(tuple(id_pos_list[b:e]),len(codes)) for b,e in zip(bounds[:-1],bounds[1:])])
+
+    min_markers = min(2,len(ids))
+    uv_all = np.array([np.reshape(uv_by_id[i],(4,2)) for i in ids],dtype=np.float64)
+    for key in np.unique(keys):
+        group = np.flatnonzero(keys == key)
+        k = per_frame[group[0]]
+        if k < min_markers:
+            continue
+        rows = (first_row[group][:,None]+np.arange(k)).ravel()
+        uv = uv_all[id_pos[rows[:k]]].reshape(-1,2)
+        yx = np.array(m['verts_norm'][rows],dtype=np.float64).reshape(len(group),-1,2)
+        # identical marker configurations are computed once
+        flat = np.ascontiguousarray(yx.reshape(len(group),-1))
+        _,unique_idx,inverse = np.unique(flat.view(np.dtype((np.void,flat.dtype.itemsize*flat.shape[1]))).ravel(),
+                                         return_index=True,return_inverse=True)
+        entries = surface_entries(uv,yx[unique_idx],k)
+        for frame,i in zip(frame_idx[group].tolist(),inverse.tolist()):
+            results[frame-start] = entries[i]
+    return results
+
+
+def cache_blocks(frame_count,block_size,section=None):
+    '''
+    (start,stop) blocks covering all frames. The blocks of section come first.
+    '''
+    if section is None:
+        section = (0,0)
+    first,last = max(0,min(section[0],frame_count)),max(0,min(section[1],frame_count))
+    blocks = [(start,min(start+block_size,last)) for start in xrange(first,last,block_size)]
+    blocks += [(start,min(start+block_size,first)) for start in xrange(0,first,block_size)]
+    blocks += [(start,min(start+block_size,frame_count)) for start in xrange(last,frame_count,block_size)]
+    return blocks
+
+
+def fill_surface_cache(rec_dir,frame_count,uv_by_id,q,run,section=None,block_size=5000):
+    '''
+    this function is part of Offline_Reference_Surface it is run as a seperate process.
+    it must be kept in a seperate file for namespace sanatisation
+    Reads the marker cache from disk and streams (start index,entries) blocks into q. Ends with None.
+    section: (start,stop) frames to do first, e.g. the trim section
+    '''
+    import os
+    import logging
+    logger = logging.getLogger(__name__+' with pid: '+str(os.getpid()) )
+    from marker_cache import load_columns
+    markers,visited = load_columns(rec_dir)
+    markers = markers[np.argsort(markers['frame'],kind='mergesort')]
+    for start,stop in cache_blocks(frame_count,block_size,section):
+        if not run.value:
+            break
+        first,last = np.searchsorted(markers['frame'],(start,stop))
+        q.put((start,locate_surface(markers[first:last],visited,uv_by_id,(start,stop))))
+    else:
+        logger.debug('Surface cache of %s frames built.'%frame_count)
+    q.put(None)
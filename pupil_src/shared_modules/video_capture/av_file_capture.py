@@ -14,9 +14,13 @@ import av
 assert av.__version__ >= '0.2.5'
 
 import numpy as np
+import cv2
 from time import time,sleep
 from fractions import Fraction
+from collections import OrderedDict
 from  multiprocessing import cpu_count
+from threading import Thread,Event
+from Queue import Queue,Empty,Full
 #logging
 import logging
 logger = logging.getLogger(__name__)
@@ -43,44 +47,157 @@ class FileSeekError(Exception):
         super(FileSeekError, self).__init__()
 
 
+#one row per video packet, sorted by pts. The row number is the frame index.
+packet_index_dtype = np.dtype([('pts',np.int64),('keyframe',np.bool_),('pos',np.int64)])
+
+def packet_index_path(src):
+    return os.path.splitext(src)[0]+'_packet_index.npy'
+
+def build_packet_index(src):
+    """
+    demux (but do not decode) all video packets and note pts, keyframe flag and byte offset.
+    """
+    container = av.open(src)
+    stream = next(s for s in container.streams if s.type=="video")
+    rows = []
+    for packet in container.demux(stream):
+        if packet.pts is None:
+            #flushing packet at the end of the stream
+            continue
+        try:
+            keyframe = packet.is_keyframe
+        except AttributeError:
+            #older pyav: ask the decoder
+            keyframe = any(f.key_frame for f in packet.decode())
+        rows.append((packet.pts,keyframe,getattr(packet,'pos',-1)))
+    index = np.array(rows,dtype=packet_index_dtype)
+    index.sort(order='pts')
+    return index
+
+def load_packet_index(src):
+    """
+    load the packet index sidecar of a video file or build and save it.
+    Returns None if the video can not be indexed.
+    """
+    index_path = packet_index_path(src)
+    try:
+        if os.path.getmtime(index_path) >= os.path.getmtime(src):
+            return np.load(index_path)
+    except (IOError,OSError,ValueError):
+        pass
+
+    logger.info("Building packet index for '%s'. This only happens once."%src)
+    try:
+        index = build_packet_index(src)
+    except Exception as e:
+        logger.warning("Could not index '%s': %s. Will seek by time."%(src,e))
+        return None
+    try:
+        np.save(index_path,index)
+    except (IOError,OSError) as e:
+        logger.warning("Could not save packet index: %s"%e)
+    return index
+
+
+class Buffer_Pool(object):
+    """
+    hands out arrays for image conversions and reuses an array once nobody references it anymore.
+    """
+    def __init__(self,max_buffers=8):
+        self.max_buffers = max_buffers
+        self.buffers = []
+
+    def get(self,shape,dtype=np.uint8):
+        for buf in self.buffers:
+            #references: self.buffers, buf and the argument of getrefcount. Views of buf count as well.
+            if buf.shape == shape and buf.dtype == dtype and sys.getrefcount(buf) <= 3:
+                return buf
+        buf = np.empty(shape,dtype=dtype)
+        if len(self.buffers) >= self.max_buffers:
+            self.buffers.pop(0)
+        self.buffers.append(buf)
+        return buf
+
+bgr_pool = Buffer_Pool()
+i420_pool = Buffer_Pool(max_buffers=2)
+
+
 class Frame(object):
-    """docstring of Frame"""
+    """
+    A decoded video frame. Conversions happen on first access only:
+        width, height   no conversion
+        gray            luma plane of the decoded frame, no conversion. Read-only.
+        yuv             tuple of the decoded planes, no conversion. Read-only.
+        img, bgr        BGR image in a pooled buffer. Writable: drawing on it changes what is displayed and exported.
+    """
     def __init__(self, timestamp,av_frame,index):
         self._av_frame = av_frame
         self.timestamp = timestamp
         self.index = index
         self._img = None
         self._gray = None
+        self._yuv = None
         self.jpeg_buffer = None
         self.yuv_buffer = None
         self.height,self.width = av_frame.height,av_frame.width
 
     def copy(self):
-        return Frame(self.timestamp,self._av_frame,self.index)
+        frame = Frame(self.timestamp,self._av_frame,self.index)
+        #read-only data can be shared
+        frame._gray,frame._yuv = self._gray,self._yuv
+        return frame
 
     @property
     def img(self):
         if self._img is None:
-            self._img = self._av_frame.to_nd_array(format='bgr24')
+            self._img = self._to_bgr()
         return self._img
 
     @property
     def bgr(self):
         return self.img
 
+    @property
+    def yuv(self):
+        if self._yuv is None:
+            planes = []
+            for plane in self._av_frame.planes:
+                #rows can be padded to line_size
+                buf = np.frombuffer(plane,np.uint8).reshape(plane.height,plane.line_size)
+                planes.append(buf[:,:plane.width])
+            self._yuv = tuple(planes)
+        return self._yuv
+
     @property
     def gray(self):
         if self._gray is None:
-            self._gray = np.frombuffer(self._av_frame.planes[0],np.uint8).reshape(self.height,self.width)
+            if self._av_frame.format.name.startswith(('yuv','nv','gray')):
+                self._gray = np.ascontiguousarray(self.yuv[0])
+            else:
+                self._gray = cv2.cvtColor(self.img,cv2.COLOR_BGR2GRAY)
         return self._gray
 
+    def _to_bgr(self):
+        if self._av_frame.format.name != 'yuv420p' or self.width%2 or self.height%2:
+            return self._av_frame.to_nd_array(format='bgr24')
+        y,u,v = self.yuv
+        w,h = self.width,self.height
+        i420 = i420_pool.get((h*3/2,w))
+        i420[:h] = y
+        flat = i420.reshape(-1)
+        flat[w*h:w*h*5/4] = u.ravel()
+        flat[w*h*5/4:] = v.ravel()
+        bgr = bgr_pool.get((h,w,3))
+        cv2.cvtColor(i420,cv2.COLOR_YUV2BGR_I420,bgr)
+        return bgr
+
 
 
 class File_Capture(object):
     """
     simple file capture.
     """
-    def __init__(self,src,timestamps=None):
+    def __init__(self,src,timestamps=None,use_packet_index=True,frame_cache_mb=0,prefetch_size=0):
         self.menu = None
         self.display_time = 0.
         self.target_frame_idx = 0
@@ -129,7 +246,32 @@ class File_Capture(object):
         else:
             logger.debug('using timestamps from list')
             self.timestamps = timestamps
+
+        #pts of every frame and the frame indices of keyframes for frame accurate seeking
+        self.frame_pts = None
+        self.keyframe_indices = None
+        if use_packet_index:
+            index = load_packet_index(src)
+            if index is not None and len(index) and index['keyframe'].any():
+                self.frame_pts = index['pts']
+                self.keyframe_indices = np.flatnonzero(index['keyframe'])
+
         self.next_frame = self._next_frame()
+        #index of the frame the decoder yields next, None if unknown
+        self.decoder_idx = 0
+        #without packet index we decode forward up to this many frames instead of seeking
+        self.max_decode_ahead = 30
+
+        #LRU cache of decoded frames by index
+        self.frame_cache_mb = frame_cache_mb
+        self.frame_cache = OrderedDict()
+        self.cache_bytes = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        #decode ahead thread, see set_prefetch
+        self.prefetch_size = prefetch_size
+        self.prefetch_thread = None
 
     @property
     def name(self):
@@ -147,6 +289,10 @@ class File_Capture(object):
     def frame_rate(self):
         return self.video_stream.average_rate
 
+    @property
+    def pixel_format(self):
+        return self.video_stream.format.name
+
     @property
     def settings(self):
         logger.warning("File capture has no settings.")
@@ -171,6 +317,12 @@ class File_Capture(object):
         raise EndofVideoFileError("end of file.")
 
     def pts_to_idx(self,pts):
+        if self.frame_pts is not None:
+            idx = np.searchsorted(self.frame_pts,pts)
+            #pick the nearest pts in case the decoder does not return the packet pts
+            if idx == len(self.frame_pts) or (idx > 0 and pts-self.frame_pts[idx-1] < self.frame_pts[idx]-pts):
+                idx -= 1
+            return int(idx)
         # some older mkv did not use perfect timestamping so we are doing int(round()) to clear that.
         # With properly spaced pts (any v0.6.100+ recording) just int() would suffice.
         # print float(pts*self.video_stream.time_base*self.video_stream.average_rate),round(pts*self.video_stream.time_base*self.video_stream.average_rate)
@@ -181,32 +333,179 @@ class File_Capture(object):
         return int(pts*self.video_stream.time_base)
 
     def idx_to_pts(self,idx):
+        if self.frame_pts is not None:
+            return int(self.frame_pts[min(max(idx,0),len(self.frame_pts)-1)])
         return int(idx/self.video_stream.average_rate/self.video_stream.time_base)
 
+    def keyframe_for(self,idx):
+        """index of the last keyframe at or before frame idx"""
+        return int(self.keyframe_indices[max(0,np.searchsorted(self.keyframe_indices,idx,side='right')-1)])
+
+    def _seek_to_keyframe(self,seek_pos):
+        if not 0 <= seek_pos < len(self.frame_pts):
+            raise FileSeekError()
+        key_idx = self.keyframe_for(seek_pos)
+        self.video_stream.seek(int(self.frame_pts[key_idx]),mode='time')
+        self.next_frame = self._next_frame()
+        return key_idx
+
     def get_frame_nowait(self):
-        frame = None
-        for frame in self.next_frame:
-            index = self.pts_to_idx(frame.pts)
-            if index == self.target_frame_idx:
-                break
-            elif index < self.target_frame_idx:
-                pass
-                # print 'skip frame to seek','now at:',index
-            else:
-                logger.error('Frame index not consistent.')
+        if self.prefetch_thread:
+            frame = self._get_prefetched()
+            if frame is not None:
+                self.show_time = frame.timestamp
+                self.target_frame_idx = frame.index+1
+                return frame.copy()
+
+        frame = self._get_cached(self.target_frame_idx)
+        if frame is None:
+            frame = self._decode(self.target_frame_idx)
+        self.show_time = frame.timestamp
+        self.target_frame_idx = frame.index+1
+        # a copy: the cached frame must not carry images changed by plugins
+        return frame.copy()
+
+    def set_prefetch(self,active):
+        """
+        start or stop decoding ahead on a worker thread. Only the worker uses the decoder while it runs.
+        """
+        if active and self.prefetch_size and not self.prefetch_thread:
+            self.prefetch_queue = Queue(maxsize=self.prefetch_size)
+            self.prefetch_stop = Event()
+            self.prefetch_thread = Thread(target=self._prefetch,args=(self.target_frame_idx,))
+            self.prefetch_thread.daemon = True
+            self.prefetch_thread.start()
+        elif not active and self.prefetch_thread:
+            self._stop_prefetch()
+
+    def _stop_prefetch(self):
+        if self.prefetch_thread:
+            self.prefetch_stop.set()
+            #unblock a worker waiting for space in the queue
+            while self.prefetch_thread.is_alive():
+                try:
+                    self.prefetch_queue.get(timeout=.01)
+                except Empty:
+                    pass
+            self.prefetch_thread = None
+
+    def _prefetch(self,idx):
+        while not self.prefetch_stop.is_set():
+            try:
+                frame = self._get_cached(idx) or self._decode(idx)
+            except EndofVideoFileError as e:
+                frame = e
+            except FileSeekError:
+                frame = EndofVideoFileError('Reached end of videofile')
+            while not self.prefetch_stop.is_set():
+                try:
+                    self.prefetch_queue.put(frame,timeout=.05)
+                    break
+                except Full:
+                    pass
+            if isinstance(frame,EndofVideoFileError):
+                return
+            idx = frame.index+1
+
+    def _get_prefetched(self):
+        """next frame from the worker or None if it does not have the one we want."""
+        while True:
+            try:
+                frame = self.prefetch_queue.get(timeout=.05)
                 break
-        if not frame:
-            raise EndofVideoFileError('Reached end of videofile')
+            except Empty:
+                if not self.prefetch_thread.is_alive():
+                    frame = None
+                    break
+        if isinstance(frame,EndofVideoFileError):
+            self._stop_prefetch()
+            raise frame
+        if frame is None or frame.index != self.target_frame_idx:
+            self._stop_prefetch()
+            return None
+        return frame
 
-        try:
-            timestamp = self.timestamps[index]
-        except IndexError:
-            logger.warning("Reached end of timestamps list.")
+    def _decoder_needs_seek(self,idx):
+        if self.decoder_idx is None:
+            #position unknown right after a seek: decode forward like we always did
+            return False
+        if idx < self.decoder_idx:
+            return True
+        if self.frame_pts is not None:
+            return self.keyframe_for(idx) > self.decoder_idx
+        return idx - self.decoder_idx > self.max_decode_ahead
+
+    def _decode(self,target_idx):
+        self.cache_misses += 1
+        if target_idx >= len(self.timestamps):
             raise EndofVideoFileError("Reached end of timestamps list.")
+        if self._decoder_needs_seek(target_idx):
+            try:
+                self._seek_decoder(target_idx)
+            except FileSeekError:
+                #target is beyond the last frame of the video
+                self.decoder_idx = sys.maxint
+                raise EndofVideoFileError('Reached end of videofile')
 
-        self.show_time = timestamp
-        self.target_frame_idx = index+1
-        return Frame(timestamp,frame,index=index)
+        frame = None
+        try:
+            for av_frame in self.next_frame:
+                index = self.pts_to_idx(av_frame.pts)
+                self.decoder_idx = index+1
+                try:
+                    frame = Frame(self.timestamps[index],av_frame,index=index)
+                except IndexError:
+                    logger.warning("Reached end of timestamps list.")
+                    raise EndofVideoFileError("Reached end of timestamps list.")
+                #frames we decode on the way are kept as well, this makes stepping backwards cheap.
+                self._cache_put(frame)
+                if index == target_idx:
+                    break
+                elif index < target_idx:
+                    pass
+                    # print 'skip frame to seek','now at:',index
+                else:
+                    logger.error('Frame index not consistent.')
+                    break
+            if not frame:
+                raise EndofVideoFileError('Reached end of videofile')
+        except EndofVideoFileError:
+            #the decoder is done, any further decode needs a seek first.
+            self.decoder_idx = sys.maxint
+            raise
+        return frame
+
+    def _get_cached(self,idx):
+        try:
+            frame = self.frame_cache.pop(idx)
+        except KeyError:
+            return None
+        self.frame_cache[idx] = frame
+        self.cache_hits += 1
+        return frame
+
+    def _cache_put(self,frame):
+        budget = self.frame_cache_mb*1024*1024
+        size = frame.width*frame.height*3/2 #decoded yuv420 frame
+        if size > budget:
+            return
+        if frame.index in self.frame_cache:
+            self.cache_bytes -= size
+            del self.frame_cache[frame.index]
+        self.frame_cache[frame.index] = frame
+        self.cache_bytes += size
+        while self.cache_bytes > budget:
+            #all frames of a video have the same size
+            self.frame_cache.popitem(last=False)
+            self.cache_bytes -= size
+
+    def clear_cache(self):
+        self.frame_cache.clear()
+        self.cache_bytes = 0
+
+    @property
+    def cache_stats(self):
+        return {'hits':self.cache_hits,'misses':self.cache_misses,'frames':len(self.frame_cache),'bytes':self.cache_bytes}
 
     def wait(self,frame):
         if self.display_time:
@@ -221,20 +520,49 @@ class File_Capture(object):
         self.wait(frame)
         return frame
 
+    def _seek_decoder(self,seek_pos):
+        if self.frame_pts is not None:
+            # jump to the keyframe, _decode decodes forward seek_pos-keyframe frames.
+            self.decoder_idx = self._seek_to_keyframe(seek_pos)
+        else:
+            self.video_stream.seek(self.idx_to_pts(seek_pos),mode='time')
+            self.next_frame = self._next_frame()
+            self.decoder_idx = None
+
+    def _clamp_seek_pos(self,seek_pos):
+        #like idx_to_pts, seeks outside of the video go to the first or last frame.
+        if self.frame_pts is not None:
+            return min(max(seek_pos,0),len(self.frame_pts)-1)
+        return seek_pos
+
     def seek_to_frame(self, seek_pos):
         ###frame accurate seeking
-        self.video_stream.seek(self.idx_to_pts(seek_pos),mode='time')
-        self.next_frame = self._next_frame()
+        self._stop_prefetch()
+        seek_pos = self._clamp_seek_pos(seek_pos)
+        if seek_pos not in self.frame_cache:
+            self._seek_decoder(seek_pos)
         self.display_time = 0
         self.target_frame_idx = seek_pos
 
     def seek_to_frame_fast(self, seek_pos):
         ###best effort seeking to closest keyframe
+        self._stop_prefetch()
+        seek_pos = self._clamp_seek_pos(seek_pos)
+        if seek_pos in self.frame_cache:
+            self.target_frame_idx = seek_pos
+            self.display_time = 0
+            return
+        if self.frame_pts is not None:
+            self.target_frame_idx = self._seek_to_keyframe(seek_pos)
+            self.decoder_idx = self.target_frame_idx
+            self.display_time = 0
+            return
         self.video_stream.seek(self.idx_to_pts(seek_pos),mode='time')
         self.next_frame = self._next_frame()
         frame = self.next_frame.next()
         index = self.pts_to_idx(frame.pts)
         self.target_frame_idx = index+1
+        self.decoder_idx = index+1
         self.display_time = 0
 
 
@@ -254,6 +582,7 @@ class File_Capture(object):
         self.menu = ui.Growing_Menu(label='File Capture Settings')
         self.menu.append(ui.Info_Text("Running Capture with '%s' as src"%self.src))
         self.menu.append(ui.Slider('slowdown',self,min=0,max=1.0))
+        self.menu.append(ui.Slider('frame_cache_mb',self,min=0,step=16,max=4096,label='Frame cache (MB)'))
         self.sidebar = sidebar
         self.sidebar.append(self.menu)
 
@@ -263,6 +592,7 @@ class File_Capture(object):
             self.menu = None
 
     def close(self):
+        self._stop_prefetch()
         self.deinit_gui()
 if __name__ == '__main__':
     import os